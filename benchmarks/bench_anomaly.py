@@ -0,0 +1,103 @@
+"""
+Per-batch scoring latency and throughput of common.anomaly.AnomalyEngine,
+with and without NumPy, against the original one-dict-at-a-time
+DroneGUI.is_anomaly check.
+
+Every batch size is run twice: with readings spread over --sensors
+sensors, and over only --few-sensors sensors (a drone serving a handful of
+fast sensors, or replaying a backlog), where each sensor has many readings
+in the batch and the NumPy engine has few readings per vectorised round.
+
+Usage:
+python benchmarks/bench_anomaly.py --sensors 5000 --few-sensors 4 --batch 10000 --batches 20
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.anomaly import AnomalyEngine, np
+from common.protocol import Reading
+
+
+# Baseline: the original static-threshold check, building strings for every hit
+def is_anomaly(data):
+    temp = data.get("temperature")
+    hum = data.get("humidity")
+    anomalies = []
+    if temp is not None:
+        if temp > 60.0 or temp < -10.0:
+            anomalies.append(f"Temperature anomaly: {temp}°C")
+    if hum is not None:
+        if hum > 90.0 or hum < 10.0:
+            anomalies.append(f"Humidity anomaly: {hum}%")
+    return anomalies
+
+
+def make_batches(sensors, batch, batches, anomaly_rate):
+    rng = random.Random(42)
+    ts = 1_700_000_000_000_000
+    out = []
+    for _ in range(batches):
+        readings = []
+        for j in range(batch):
+            temp = 20 + rng.gauss(0, 0.5)
+            if rng.random() < anomaly_rate:
+                temp = 100.0
+            readings.append(Reading(f"sensor{j % sensors}", temp, 50 + rng.gauss(0, 1), ts + j * 1000))
+        ts += 2_000_000
+        out.append(readings)
+    return out
+
+
+def run(sensors, args):
+    batches = make_batches(sensors, args.batch, args.batches, args.anomaly_rate)
+    total = args.batch * args.batches
+    print(f"{args.batches} batches of {args.batch} readings from {sensors} sensors")
+    print(f"{'engine':<24}{'readings/sec':>14}{'avg ms/batch':>14}{'max ms/batch':>14}")
+
+    dicts = [[{"sensor_id": r.sensor_id, "temperature": r.temperature, "humidity": r.humidity}
+              for r in readings] for readings in batches]
+    start = time.perf_counter()
+    worst = 0.0
+    for readings in dicts:
+        t = time.perf_counter()
+        for data in readings:
+            is_anomaly(data)
+        worst = max(worst, time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    print(f"{'is_anomaly (static)':<24}{total / elapsed:>14.0f}{elapsed / args.batches * 1000:>14.2f}{worst * 1000:>14.2f}")
+
+    modes = [False] + ([True] if np is not None else [])
+    for use_numpy in modes:
+        engine = AnomalyEngine(use_numpy=use_numpy)
+        start = time.perf_counter()
+        for readings in batches:
+            engine.score(readings)
+        elapsed = time.perf_counter() - start
+        stats = engine.stats()
+        name = "engine (numpy)" if use_numpy else "engine (python)"
+        print(f"{name:<24}{total / elapsed:>14.0f}{stats['avg_ms']:>14.2f}{stats['max_ms']:>14.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sensors", type=int, default=5000)
+    parser.add_argument("--few-sensors", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=10000)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--anomaly-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    run(args.sensors, args)
+    print()
+    run(args.few_sensors, args)
+    if np is None:
+        print("NumPy is not installed; only the pure-Python engine was measured.")
+
+
+if __name__ == "__main__":
+    main()
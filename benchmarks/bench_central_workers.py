@@ -0,0 +1,197 @@
+"""
+Central server throughput with 1..N worker processes (common/workers.py).
+
+For every worker count, server/central_server.py --workers N is started in a
+temporary working directory and --drones load generator processes each keep
+one uplink (common.uplink.Uplink) busy for --duration seconds, sending
+batches of --batch readings and waiting for every ack, exactly like the
+drone. Batches are JSON by default, the expensive case for the server;
+--protocol binary sends binary frames instead.
+
+Reported per worker count: acknowledged readings per second, the speedup
+over a single process, the share of readings each worker handled and, on
+Linux, the CPU time the server's parent process and its workers used per
+reading. The parent's share is the serial part (merging every batch into
+the query engine) that bounds how far more workers can scale. With
+--workers 1 the server runs the classic single-process loop. The load
+generators run on the same machine, so they compete with the server for the
+cores: numbers beyond os.cpu_count() / 2 workers mostly measure that.
+
+Usage:
+python benchmarks/bench_central_workers.py --drones 16 --duration 10
+python benchmarks/bench_central_workers.py --workers 1,2,4,8 --protocol binary
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common.protocol import Reading
+from common.uplink import Uplink
+
+CENTRAL_PORT = 6000
+METRICS_PORT = 6200
+
+# Distinct sensors per simulated drone
+SENSORS = 50
+
+
+def wait_for_port(port, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process in seconds (Linux /proc), or None."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def children(pid):
+    """Pids of the direct children of a process (Linux /proc)."""
+    found = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return found
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    found.append(int(entry))
+        except (OSError, ValueError, IndexError):
+            pass
+    return found
+
+
+def server_cpu(pid):
+    """(parent, workers) CPU seconds of the central server, or None."""
+    parent = cpu_seconds(pid)
+    if parent is None:
+        return None
+    return parent, sum(cpu_seconds(child) or 0.0 for child in children(pid))
+
+
+def drone(index, batch, binary, start_at, stop_at, results):
+    """One simulated drone: send batches back to back until stop_at."""
+    uplink = Uplink("127.0.0.1", CENTRAL_PORT, binary=binary)
+    sent = 0
+    time.sleep(max(0.0, start_at - time.time()))
+    ts = int(time.time() * 1000000)
+    while time.time() < stop_at:
+        readings = []
+        for i in range(batch):
+            ts += 1
+            readings.append(Reading(f"drone{index}-s{i % SENSORS}", 20.0 + i % 7, 45.0, ts, 0))
+        acked = uplink.send(readings, batch_size=batch)
+        if acked < len(readings):
+            time.sleep(0.1)  # the server is not up (yet) or dropped us
+        sent += acked
+    uplink.close()
+    results.put(sent)
+
+
+def per_worker(workers):
+    # Readings handled by each worker process, from the server's metrics
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{METRICS_PORT}/metrics", timeout=5) as response:
+            stats = json.load(response)["gauges"].get("workers")
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stats, dict):
+        return None
+    return [w.get("records", 0) for w in stats["per_worker"]]
+
+
+def run(workers, args, workdir):
+    central = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "server", "central_server.py"), "--workers", str(workers)],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(CENTRAL_PORT)
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        # Give every generator time to start before the clock runs
+        start_at = time.time() + 2.0
+        stop_at = start_at + args.duration
+        generators = [context.Process(target=drone, args=(i, args.batch, args.protocol == "binary",
+                                                          start_at, stop_at, results))
+                      for i in range(args.drones)]
+        for p in generators:
+            p.start()
+        time.sleep(max(0.0, start_at - time.time()))
+        cpu_before = server_cpu(central.pid)
+        sent = sum(results.get() for _p in generators)
+        cpu_after = server_cpu(central.pid)
+        elapsed = max(time.time(), stop_at) - start_at
+        for p in generators:
+            p.join()
+        cpu = None
+        if cpu_before and cpu_after and sent:
+            cpu = tuple((after - before) / sent * 1000000 for before, after in zip(cpu_before, cpu_after))
+        # Worker statistics are reported once a second
+        time.sleep(1.5)
+        shares = per_worker(workers) if workers > 1 else None
+    finally:
+        central.terminate()
+        central.wait()
+    return sent / elapsed, shares, cpu
+
+
+def main():
+    cores = os.cpu_count() or 1
+    default_workers = sorted({1, 2, 4, cores} if cores > 1 else {1, 2})
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=str, default=",".join(map(str, default_workers)),
+                        help="comma separated worker counts")
+    parser.add_argument("--drones", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=500, help="readings per batch")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per worker count")
+    parser.add_argument("--protocol", choices=["json", "binary"], default="json")
+    args = parser.parse_args()
+
+    counts = [int(n) for n in args.workers.split(",")]
+    print(f"{cores} CPUs, {args.drones} drones, {args.batch} readings per {args.protocol} batch, "
+          f"{args.duration:g}s per run")
+    print(f"{'workers':>8}{'readings/s':>14}{'speedup':>10}{'parent us/rd':>14}{'workers us/rd':>15}  per worker")
+    base = None
+    for workers in counts:
+        workdir = tempfile.mkdtemp(prefix="central-workers-bench-")
+        try:
+            rate, shares, cpu = run(workers, args, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if base is None:
+            base = rate
+        split = ""
+        if shares:
+            total = sum(shares) or 1
+            split = " / ".join(f"{100 * n / total:.0f}%" for n in shares)
+        parent, children_cpu = (f"{cpu[0]:.1f}", f"{cpu[1]:.1f}") if cpu else ("-", "-")
+        print(f"{workers:>8}{rate:>14,.0f}{rate / base:>9.2f}x{parent:>14}{children_cpu:>15}  {split}")
+
+
+if __name__ == "__main__":
+    main()
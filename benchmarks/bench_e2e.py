@@ -0,0 +1,297 @@
+"""
+End-to-end throughput/latency benchmark: thousands of simulated sensors ->
+drone/drone.py -> server/central_server.py, all headless on localhost.
+
+The central server and the drone are started as subprocesses in a temporary
+working directory (so their data/ and spool/ directories are thrown away).
+One asyncio process then simulates --sensors sensors, each on its own
+connection, sending the same JSON message as sensor.get_sensor_data() (or
+its binary encoding with --protocol binary) every --interval seconds for
+--duration seconds. After the senders stop, the drone gets --drain seconds
+to forward what it still holds.
+
+Reported:
+- messages/sec sent by the sensors and received by the central server
+- end-to-end latency percentiles: sensor timestamp -> the moment the central
+  server printed the reading (read from its unbuffered stdout)
+- drops: readings sent but never received, and drops the drone reported
+- peak and final RSS of the drone, the central server and the generator
+
+Results are written to --output as JSON. With --baseline, the run is
+compared with an earlier results file and the script exits with status 1
+if throughput, p99 latency, drops or RSS regressed by more than
+--tolerance.
+
+Usage:
+python benchmarks/bench_e2e.py --sensors 2000 --interval 1 --duration 30 --output e2e.json
+python benchmarks/bench_e2e.py --sensors 2000 --baseline e2e.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from array import array
+from datetime import datetime, timezone, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common.protocol import BinaryEncoder, negotiate, reading_from_dict
+
+DRONE_PORT = 5000
+CENTRAL_PORT = 6000
+TURKEY_TZ = timezone(timedelta(hours=3))
+
+RECEIVED = re.compile(rb"\[CENTRAL\] Received: Reading\(.*?ts_us=(\d+)")
+DROPPED = re.compile(r"\[DRONE\] Buffer full, (\d+) readings dropped")
+
+
+# Same message as sensor.get_sensor_data() (normal operation variant)
+def get_sensor_data(sensor_id, rng):
+    return {
+        "sensor_id": sensor_id,
+        "temperature": round(20 + rng.uniform(-2.5, 2.5), 2),
+        "humidity": round(50 + rng.uniform(-5, 5), 2),
+        "timestamp": datetime.now(TURKEY_TZ).isoformat(),
+    }
+
+
+def rss_mb(pid):
+    """Resident set size of a process in MB (Linux /proc), or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+class Run:
+    def __init__(self, args):
+        self.args = args
+        self.sent = 0
+        self.received = 0
+        self.latencies = array("d")
+        self.rss = {"drone": [], "central": [], "loadgen": []}
+        self.started = None
+        self.last_received = None
+        self.connect_failures = 0
+
+    async def sensor(self, n, stop_at):
+        args = self.args
+        rng = random.Random(n)
+        sensor_id = f"load{n}"
+        # Spread connects and sends over one interval
+        await asyncio.sleep(rng.uniform(0, args.interval))
+        encoder = None
+        try:
+            if args.protocol == "binary":
+                # The handshake is short and blocking; do it before handing the socket to asyncio
+                sock = socket.create_connection(("127.0.0.1", DRONE_PORT))
+                if negotiate(sock):
+                    encoder = BinaryEncoder()
+                sock.setblocking(False)
+                reader, writer = await asyncio.open_connection(sock=sock)
+            else:
+                reader, writer = await asyncio.open_connection("127.0.0.1", DRONE_PORT)
+        except OSError:
+            self.connect_failures += 1
+            return
+        next_send = time.monotonic()
+        try:
+            while time.monotonic() < stop_at:
+                data = get_sensor_data(sensor_id, rng)
+                if encoder:
+                    writer.write(encoder.encode([reading_from_dict(data)]))
+                else:
+                    writer.write(json.dumps(data).encode() + b"\n")
+                self.sent += 1
+                await writer.drain()
+                next_send += args.interval
+                await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def read_central(self, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            match = RECEIVED.search(line)
+            if match:
+                now = time.time()
+                self.received += 1
+                self.latencies.append((now * 1000000 - int(match.group(1))) / 1000)
+                self.last_received = now
+
+    async def sample_rss(self, pids):
+        while True:
+            for name, pid in pids.items():
+                value = rss_mb(pid)
+                if value is not None:
+                    self.rss[name].append(value)
+            await asyncio.sleep(0.5)
+
+    async def main(self, workdir):
+        args = self.args
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        central = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, "server", "central_server.py"),
+            cwd=workdir, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        drone_log = open(os.path.join(workdir, "drone.out"), "wb")
+        drone = None
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, wait_for_port, CENTRAL_PORT)
+            drone = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(ROOT, "drone", "drone.py"),
+                cwd=workdir, env=env, stdout=drone_log, stderr=asyncio.subprocess.STDOUT)
+            await asyncio.get_running_loop().run_in_executor(None, wait_for_port, DRONE_PORT)
+
+            reader = asyncio.ensure_future(self.read_central(central.stdout))
+            sampler = asyncio.ensure_future(self.sample_rss(
+                {"drone": drone.pid, "central": central.pid, "loadgen": os.getpid()}))
+
+            self.started = time.time()
+            start = time.monotonic()
+            stop_at = start + args.duration
+            await asyncio.gather(*(self.sensor(n, stop_at) for n in range(args.sensors)))
+            send_elapsed = time.monotonic() - start
+
+            # Let the drone forward what it still holds
+            deadline = time.monotonic() + args.drain
+            while self.received < self.sent and time.monotonic() < deadline:
+                await asyncio.sleep(0.2)
+            sampler.cancel()
+            reader.cancel()
+        finally:
+            for proc in (drone, central):
+                if proc is not None and proc.returncode is None:
+                    proc.terminate()
+                    await proc.wait()
+            drone_log.close()
+        return send_elapsed
+
+    def report(self, send_elapsed, workdir):
+        args = self.args
+        drone_drops = 0
+        with open(os.path.join(workdir, "drone.out"), errors="replace") as f:
+            for line in f:
+                match = DROPPED.search(line)
+                if match:
+                    drone_drops = int(match.group(1))
+        latencies = sorted(self.latencies)
+        # From the first send to the last reading the central server printed
+        receive_span = (self.last_received - self.started) if self.received else 0
+        return {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "config": {
+                "sensors": args.sensors,
+                "interval": args.interval,
+                "duration": args.duration,
+                "protocol": args.protocol,
+            },
+            "sent": self.sent,
+            "received": self.received,
+            "lost": self.sent - self.received,
+            "drone_reported_drops": drone_drops,
+            "connect_failures": self.connect_failures,
+            "msgs_per_sec": {
+                "sent": round(self.sent / send_elapsed, 1) if send_elapsed else 0,
+                "received": round(self.received / receive_span, 1) if receive_span else 0,
+            },
+            "latency_ms": {
+                name: None if percentile(latencies, q) is None else round(percentile(latencies, q), 2)
+                for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999), ("max", 1.0))
+            },
+            "rss_mb": {
+                name: {"peak": round(max(values), 1), "last": round(values[-1], 1)} if values else None
+                for name, values in self.rss.items()
+            },
+        }
+
+
+def compare(result, baseline, tolerance):
+    """Return a list of regressions of result against baseline."""
+    problems = []
+    old, new = baseline["msgs_per_sec"]["received"], result["msgs_per_sec"]["received"]
+    if old and new < old * (1 - tolerance):
+        problems.append(f"received msgs/sec {new} < {old}")
+    old, new = baseline["latency_ms"]["p99"], result["latency_ms"]["p99"]
+    if old is not None and (new is None or new > old * (1 + tolerance)):
+        problems.append(f"p99 latency {new} ms > {old} ms")
+    old, new = baseline["lost"], result["lost"]
+    if new > old * (1 + tolerance):
+        problems.append(f"lost readings {new} > {old}")
+    for name, usage in result["rss_mb"].items():
+        before = baseline["rss_mb"].get(name)
+        if usage and before and usage["peak"] > before["peak"] * (1 + tolerance):
+            problems.append(f"{name} peak RSS {usage['peak']} MB > {before['peak']} MB")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sensors", type=int, default=2000)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between messages of one sensor")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=15.0, help="seconds to wait for in-flight readings")
+    parser.add_argument("--protocol", choices=["json", "binary"], default="json")
+    parser.add_argument("--output", default="bench_e2e.json", help="results file")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="e2e-bench-")
+    try:
+        run = Run(args)
+        send_elapsed = asyncio.run(run.main(workdir))
+        result = run.report(send_elapsed, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(result, indent=2))
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        problems = compare(result, baseline, args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        if problems:
+            sys.exit(1)
+        print(f"No regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
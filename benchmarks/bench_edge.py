@@ -0,0 +1,136 @@
+"""
+Uplink volume and central-server CPU with and without edge reduction
+(common.edge.EdgeReducer) on the drone.
+
+Simulates --sensors sensors reporting every --interval seconds for
+--minutes minutes (slow random walk plus a few anomalous readings), runs the
+readings through the reducer in 5 second forwarding cycles, encodes what
+would be sent exactly as the uplink does, and then measures the CPU time the
+central server spends decoding and storing it (QueryEngine.write into a
+temporary TimeSeriesStore).
+
+Usage:
+python benchmarks/bench_edge.py --sensors 200 --interval 1 --minutes 10
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.edge import EdgeReducer, load_config, MODE_RAW, MODE_DEADBAND, MODE_SUMMARY
+from common.protocol import (Reading, Summary, BinaryEncoder, BinaryDecoder, FLAG_TEMPERATURE,
+                             record_to_dict)
+from common.query import QueryEngine
+from common.tsdb import TimeSeriesStore, FSYNC_NEVER
+from common.uplink import BATCH_SIZE
+
+CYCLE_US = 5 * 1000000
+
+
+def simulate(sensors, interval, minutes, anomaly_rate):
+    """Readings grouped per 5 second forwarding cycle."""
+    rng = random.Random(42)
+    temperature = [rng.uniform(15, 30) for _ in range(sensors)]
+    humidity = [rng.uniform(30, 70) for _ in range(sensors)]
+    start = 1_700_000_000_000_000
+    step = int(interval * 1000000)
+    cycles = []
+    current = []
+    cycle_end = start + CYCLE_US
+    for tick in range(int(minutes * 60 / interval)):
+        ts = start + tick * step
+        if ts >= cycle_end:
+            cycles.append((cycle_end, current))
+            current = []
+            cycle_end += CYCLE_US
+        for i in range(sensors):
+            temperature[i] += rng.gauss(0, 0.05)
+            humidity[i] += rng.gauss(0, 0.1)
+            if rng.random() < anomaly_rate:
+                current.append(Reading(f"sensor{i}", 100.0, humidity[i], ts + i, FLAG_TEMPERATURE))
+            else:
+                current.append(Reading(f"sensor{i}", round(temperature[i], 2), round(humidity[i], 2), ts + i))
+    cycles.append((cycle_end, current))
+    return cycles
+
+
+def batches(records):
+    # Same split as Uplink.send: at most BATCH_SIZE records, never mixed
+    start = 0
+    while start < len(records):
+        end = min(start + BATCH_SIZE, len(records))
+        kind = type(records[start]) is Summary
+        for i in range(start + 1, end):
+            if (type(records[i]) is Summary) != kind:
+                end = i
+                break
+        yield records[start:end]
+        start = end
+
+
+def run(mode, cycles, directory):
+    config = load_config()
+    config["mode"] = mode
+    reducer = EdgeReducer(config)
+    encoder = BinaryEncoder()
+    frames = []
+    sent = []
+    drone_cpu = time.process_time()
+    for now_us, readings in cycles:
+        sent.extend(batches(reducer.reduce(readings, now_us)))
+    sent.extend(batches(reducer.flush()))
+    for batch_id, batch in enumerate(sent):
+        frames.append(encoder.encode_batch(batch_id, batch))
+    drone_cpu = time.process_time() - drone_cpu
+    forwarded = sum(len(batch) for batch in sent)
+    # Size of the same batches on the JSON uplink
+    json_bytes = sum(len(json.dumps({"batch": batch_id, "records": [record_to_dict(r) for r in batch]})) + 1
+                     for batch_id, batch in enumerate(sent))
+
+    # Central server: split frames, decode and store
+    engine = QueryEngine(TimeSeriesStore(directory, fsync=FSYNC_NEVER))
+    decoder = BinaryDecoder()
+    server_cpu = time.process_time()
+    for data in frames:
+        pos = 0
+        while pos < len(data):
+            length = int.from_bytes(data[pos:pos + 4], "little")
+            _kind, _batch_id, records = decoder.decode(memoryview(data)[pos + 4:pos + 4 + length])
+            if records:
+                engine.write(records)
+            pos += 4 + length
+    engine.store.close()
+    server_cpu = time.process_time() - server_cpu
+    return forwarded, sum(len(f) for f in frames), json_bytes, drone_cpu, server_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sensors", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between readings of one sensor")
+    parser.add_argument("--minutes", type=float, default=10)
+    parser.add_argument("--anomaly-rate", type=float, default=0.002)
+    args = parser.parse_args()
+
+    cycles = simulate(args.sensors, args.interval, args.minutes, args.anomaly_rate)
+    total = sum(len(readings) for _now, readings in cycles)
+    print(f"{total} readings from {args.sensors} sensors every {args.interval:g}s for {args.minutes:g} min")
+    print(f"{'mode':<10}{'records':>10}{'binary KB':>12}{'JSON KB':>12}{'drone CPU s':>13}{'server CPU s':>14}")
+    root = tempfile.mkdtemp(prefix="edge-bench-")
+    try:
+        for mode in (MODE_RAW, MODE_DEADBAND, MODE_SUMMARY):
+            forwarded, binary, json_bytes, drone_cpu, server_cpu = run(mode, cycles, os.path.join(root, mode))
+            print(f"{mode:<10}{forwarded:>10}{binary / 1024:>12.1f}{json_bytes / 1024:>12.1f}"
+                  f"{drone_cpu:>13.3f}{server_cpu:>14.3f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
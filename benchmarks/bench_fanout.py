@@ -0,0 +1,172 @@
+"""
+Ingest throughput of the central server with live feed subscribers
+(common.feed) attached.
+
+A drone-side Uplink sends --records readings in batches of --batch to a
+server in this process (common.uplink.serve_uplink) that publishes every
+batch to a LiveFeed served over HTTP (FeedServer). A second process opens
+the subscriber connections and reads them:
+
+- every 4th subscriber filters on one sensor, the others take every sensor
+- policies alternate between drop and latest
+- every 10th subscriber never reads (a stalled dashboard), so its queue
+  fills up and its policy drops batches
+
+The run is repeated for every count in --subscribers. Reported are the
+ingest throughput, the CPU time the server's uplink thread spends per
+record (decoding, acknowledging and publishing), the records every reader
+of all sensors got, and the records dropped for slow subscribers.
+
+The uplink thread only queues every batch and it is serialized once, so
+its CPU time per record stays the same however many subscribers there
+are. Wall-clock throughput drops once there are subscribers because the
+serialization, the copies into every subscriber's socket and (in this
+benchmark) the subscribers themselves need the CPU as well; on a single
+core they all take turns with the uplink thread.
+
+Usage:
+python benchmarks/bench_fanout.py --records 200000 --subscribers 0 1 10 100
+"""
+import argparse
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.feed import LiveFeed, FeedServer
+from common.protocol import Reading
+from common.uplink import Uplink, serve_uplink
+
+SENSORS = 200
+
+
+def subscribe(port, count, ready, done, results):
+    """Subscriber process: open count feed connections and read the fast ones until done."""
+    selector = selectors.DefaultSelector()
+    stalled = []
+    lines = [0] * count
+    tails = [b""] * count
+    for i in range(count):
+        sock = socket.create_connection(("127.0.0.1", port))
+        query = f"policy={'latest' if i % 2 else 'drop'}&queue=16"
+        if i % 4 == 3:
+            query += f"&sensor=sensor{i % SENSORS}"
+        sock.sendall(f"GET /feed?{query} HTTP/1.0\r\n\r\n".encode())
+        if i % 10 == 9:
+            # Never read; the server-side send buffer fills up
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            stalled.append(sock)
+        else:
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ, i)
+    ready.set()
+    while not done.is_set():
+        for key, _ in selector.select(0.2):
+            try:
+                data = key.fileobj.recv(1 << 20)
+            except BlockingIOError:
+                continue
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            # Count record lines, not the HTTP header, keep-alives or drop notices
+            i = key.data
+            data = tails[i] + data
+            lines[i] += data.count(b'{"sensor_id"')
+            tails[i] = data[-12:]
+    results.put(lines)
+
+
+class Server:
+    def __init__(self, feed):
+        self.feed = feed
+        self.received = 0
+        self.cpu = 0.0
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn, _ = self.listener.accept()
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        started = time.thread_time()
+        try:
+            serve_uplink(conn, self.handle_records)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            self.cpu += time.thread_time() - started
+
+    def handle_records(self, records):
+        self.received += len(records)
+        self.feed.publish(records)
+
+
+def run(count, records, args):
+    feed = LiveFeed()
+    feed_server = FeedServer(feed, 0).start()
+    server = Server(feed)
+    context = multiprocessing.get_context("spawn")
+    ready, done, results = context.Event(), context.Event(), context.Queue()
+    process = context.Process(target=subscribe, args=(feed_server.address[1], count, ready, done, results))
+    process.start()
+    ready.wait()
+    while feed.stats()["subscribers"] < count:
+        time.sleep(0.05)
+
+    uplink = Uplink("127.0.0.1", server.port)
+    started = time.perf_counter()
+    sent = 0
+    while sent < len(records):
+        sent += uplink.send(records[sent:], args.batch)
+    elapsed = time.perf_counter() - started
+    uplink.close()
+    while server.received < len(records) or not server.cpu:
+        time.sleep(0.01)
+
+    # Let the subscribers catch up before counting what they got
+    deadline = time.monotonic() + 10
+    while feed.stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(1.0)
+    stats = feed.stats()
+    done.set()
+    lines = results.get()
+    process.join()
+    feed_server.stop()
+    return elapsed, server.cpu, stats, lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=500, help="readings per uplink batch")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[0, 1, 10, 100])
+    args = parser.parse_args()
+
+    records = [Reading(f"sensor{i % SENSORS}", 20.0 + i % 7, 50.0, 1_700_000_000_000_000 + i, 0)
+               for i in range(args.records)]
+    print(f"{args.records:,} readings from {SENSORS} sensors, uplink batches of {args.batch}")
+    print(f"{'subscribers':>12}{'ingest rec/s':>14}{'uplink CPU us/rec':>19}{'published':>11}"
+          f"{'all-sensor avg':>16}{'dropped':>11}{'overflow':>10}")
+    for count in args.subscribers:
+        elapsed, cpu, stats, lines = run(count, records, args)
+        rate = args.records / elapsed
+        # Readers that took every sensor and kept reading
+        full = [n for i, n in enumerate(lines) if i % 4 != 3 and i % 10 != 9]
+        average = f"{sum(full) / len(full):,.0f}" if full else "-"
+        print(f"{count:>12}{rate:>14,.0f}{cpu / args.records * 1e6:>19.2f}{stats['published']:>11,}"
+              f"{average:>16}{stats['dropped']:>11,}{stats['overflow']:>10,}")
+
+
+if __name__ == "__main__":
+    main()
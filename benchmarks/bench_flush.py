@@ -0,0 +1,177 @@
+"""
+Delivery latency and radio energy of the drone's flush policy
+(common.flush.FlushPolicy) against the original fixed 5 second forwarding
+loop, in a simulation.
+
+--sensors sensors report every --interval seconds (at random phases) for
+--duration seconds of simulated time, and a share of --anomalies of the
+readings is anomalous. As in the drone, readings are scored every 0.2
+seconds and then wait for the forwarding thread, which
+
+fixed 5s    sends everything every 5 seconds, anomalies included
+policy      asks FlushPolicy after every scoring pass and sleeps until the
+            latency target of the oldest waiting reading otherwise
+
+Every flush is split into uplink batches of 500 records; each batch is one
+transmission that takes --rtt plus its size over --bandwidth and costs
+battery according to the EnergyModel. The battery also drains by --idle
+percent per second, so long runs show the latency target being relaxed as
+the battery runs down.
+
+Reported per policy: transmissions, records per transmission, delivery
+latency (reading to the ack of its batch) p50/p99, p99 of the anomalous
+readings, the radio energy per 1000 records and the battery left at the end.
+"policy" relaxes its latency target once the battery is below relax_below,
+"no relax" is the same policy with a fixed 5 second target.
+
+Usage:
+python benchmarks/bench_flush.py --sensors 200 --interval 2 --duration 600
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.flush import FlushPolicy, load_config
+from common.protocol import RECORD
+from common.uplink import BATCH_SIZE
+
+DETECT_INTERVAL = 0.2
+FIXED_INTERVAL = 5.0
+# Frame header of a sequence-numbered batch, and the sequence number per record
+BATCH_HEADER = 4 + 17
+SEQ_BYTES = 4
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def readings(args):
+    """(time, anomalous) of every reading, in time order."""
+    rng = random.Random(42)
+    heap = [(rng.uniform(0, args.interval), i) for i in range(args.sensors)]
+    heapq.heapify(heap)
+    out = []
+    while heap[0][0] < args.duration:
+        t, i = heapq.heappop(heap)
+        out.append((t, rng.random() < args.anomalies))
+        heapq.heappush(heap, (t + args.interval, i))
+    return out
+
+
+class Drone:
+    def __init__(self, policy, args):
+        self.policy = policy
+        self.args = args
+        self.battery = args.battery
+        self.clock = 0.0
+        self.transmissions = 0
+        self.energy = 0.0
+        self.latencies = []
+        self.anomaly_latencies = []
+
+    def idle(self, until):
+        self.battery -= self.args.idle * (until - self.clock)
+        self.clock = until
+
+    def flush(self, waiting):
+        # Batches go out back to back; each record is delivered with its batch's ack
+        t = self.clock
+        for start in range(0, len(waiting), BATCH_SIZE):
+            batch = waiting[start:start + BATCH_SIZE]
+            nbytes = BATCH_HEADER + len(batch) * (RECORD.size + SEQ_BYTES)
+            t += self.args.rtt + nbytes / self.args.bandwidth
+            cost = self.policy.energy.transmission(nbytes)
+            self.energy += cost
+            self.battery -= cost
+            self.transmissions += 1
+            for arrived, anomalous in batch:
+                self.latencies.append(t - arrived)
+                if anomalous:
+                    self.anomaly_latencies.append(t - arrived)
+        waiting.clear()
+
+
+def simulate(name, policy, all_readings, args):
+    drone = Drone(policy, args)
+    waiting = []
+    pending_since = None
+    urgent = False
+    position = 0
+    tick = DETECT_INTERVAL
+    next_fixed = FIXED_INTERVAL
+    while tick <= args.duration + DETECT_INTERVAL:
+        # The forwarding thread wakes at the latency target between two scoring passes
+        if name != "fixed 5s" and pending_since is not None:
+            deadline = pending_since + policy.age_limit(drone.battery)
+            if deadline < tick:
+                drone.idle(max(drone.clock, deadline))
+                drone.flush(waiting)
+                pending_since, urgent = None, False
+        if name == "fixed 5s" and next_fixed <= tick:
+            drone.idle(next_fixed)
+            drone.flush(waiting)
+            next_fixed += FIXED_INTERVAL
+        drone.idle(max(drone.clock, tick))
+        # Scoring pass: everything received since the last one
+        while position < len(all_readings) and all_readings[position][0] <= tick:
+            waiting.append(all_readings[position])
+            urgent = urgent or all_readings[position][1]
+            position += 1
+        if waiting and pending_since is None:
+            pending_since = tick
+        if name != "fixed 5s":
+            nbytes = len(waiting) * RECORD.size
+            age = tick - pending_since if pending_since is not None else 0.0
+            if policy.reason(len(waiting), nbytes, age, drone.battery, urgent):
+                drone.flush(waiting)
+                pending_since, urgent = None, False
+        tick += DETECT_INTERVAL
+    drone.flush(waiting)
+    return drone
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sensors", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between two readings of a sensor")
+    parser.add_argument("--duration", type=float, default=600.0, help="simulated seconds")
+    parser.add_argument("--anomalies", type=float, default=0.001, help="share of anomalous readings")
+    parser.add_argument("--rtt", type=float, default=0.05, help="uplink round trip in seconds")
+    parser.add_argument("--bandwidth", type=float, default=250000.0, help="uplink bytes per second")
+    parser.add_argument("--battery", type=float, default=100.0, help="battery percent at the start")
+    parser.add_argument("--idle", type=float, default=0.1, help="battery percent used per second while idle")
+    args = parser.parse_args()
+
+    all_readings = readings(args)
+    base = load_config()
+    policies = [
+        ("fixed 5s", FlushPolicy(base)),
+        ("policy", FlushPolicy(base)),
+        ("policy 2s", FlushPolicy(dict(base, max_age=2.0))),
+        ("policy 15s", FlushPolicy(dict(base, max_age=15.0))),
+        ("no relax", FlushPolicy(dict(base, max_age_low_battery=base["max_age"]))),
+    ]
+    print(f"{len(all_readings):,} readings from {args.sensors} sensors over {args.duration:g}s, "
+          f"{args.anomalies:.2%} anomalous, battery {args.battery:g}% - {args.idle:g}%/s idle")
+    print(f"{'policy':>11}{'transmissions':>15}{'records/tx':>12}{'p50 s':>8}{'p99 s':>8}"
+          f"{'anomaly p99 s':>15}{'energy/1k rec %':>17}{'battery %':>11}")
+    for name, policy in policies:
+        drone = simulate(name, policy, all_readings, args)
+        latencies = sorted(drone.latencies)
+        anomalies = sorted(drone.anomaly_latencies)
+        anomaly_p99 = percentile(anomalies, 0.99)
+        print(f"{name:>11}{drone.transmissions:>15,}{len(latencies) / max(1, drone.transmissions):>12.0f}"
+              f"{percentile(latencies, 0.5):>8.2f}{percentile(latencies, 0.99):>8.2f}"
+              f"{'-' if anomaly_p99 is None else f'{anomaly_p99:.2f}':>15}"
+              f"{1000 * drone.energy / max(1, len(latencies)):>17.3f}{drone.battery:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Compare the selectors-based ingest engine with the original
+thread-per-sensor handler.
+
+Opens --connections sensor sockets against each server, sends --messages
+readings on every socket and reports how many connections were held open and
+how many messages per second the server decoded.
+
+Usage:
+python benchmarks/bench_ingest.py --connections 2000 --messages 20 --workers 1 2
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.ingest import IngestServer
+
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, data, addr):
+        with self.lock:
+            self.count += 1
+
+
+# Baseline: the original DroneGUI.handle_sensor loop, one thread per socket
+def threaded_handle_sensor(conn, on_message):
+    with conn:
+        buffer = b""
+        while True:
+            try:
+                chunk = conn.recv(1024)
+                if not chunk:
+                    break
+                buffer += chunk
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    on_message(json.loads(line.decode()), None)
+            except Exception:
+                break
+
+
+def start_threaded_server(on_message):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1024)
+
+    def accept_loop():
+        while True:
+            try:
+                conn, _addr = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=threaded_handle_sensor, args=(conn, on_message), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return listener, listener.getsockname()
+
+
+def raise_fd_limit(wanted):
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def run_load(address, counter, connections, messages):
+    threads_before = threading.active_count()
+    socks = [socket.create_connection(address) for _ in range(connections)]
+    line = json.dumps({
+        "sensor_id": "sensor1",
+        "temperature": 21.5,
+        "humidity": 48.2,
+        "timestamp": "2025-04-29T17:42:53.836839+03:00",
+    }).encode() + b"\n"
+    expected = connections * messages
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        for s in socks:
+            s.sendall(line)
+    while counter.count < expected:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    threads = threading.active_count() - threads_before
+    for s in socks:
+        s.close()
+    return expected / elapsed, threads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    args = parser.parse_args()
+
+    raise_fd_limit(args.connections * 2 + 256)
+    print(f"{'server':<22}{'connections':>12}{'extra threads':>15}{'msgs/sec':>12}")
+
+    counter = Counter()
+    listener, address = start_threaded_server(counter)
+    rate, threads = run_load(address, counter, args.connections, args.messages)
+    listener.close()
+    print(f"{'threaded handle_sensor':<22}{args.connections:>12}{threads:>15}{rate:>12.0f}")
+
+    for workers in args.workers:
+        counter = Counter()
+        server = IngestServer(0, counter, workers=workers, host="127.0.0.1")
+        server.start()
+        rate, threads = run_load(server.address, counter, args.connections, args.messages)
+        server.stop()
+        print(f"{f'ingest x{workers}':<22}{args.connections:>12}{threads:>15}{rate:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
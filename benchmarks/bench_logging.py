@@ -0,0 +1,124 @@
+"""
+Per-reading logging cost before and after common.logsetup.
+
+"before" is the old setup: logging.basicConfig to a file plus a console
+StreamHandler, and logging.info(f"Received data: {reading}") for every
+reading. The other variants log the same readings through setup_logging()
+on a "data.received" logger with %-style arguments:
+
+queue      queued and written by the listener thread, nothing sampled
+sampled    queued, data plane capped at the default 50 records/s
+jsonl      as sampled, written as JSON lines
+
+For each variant the hot path rate (readings/sec the logging thread gets
+through) and the total time until the listener has written everything are
+reported. The console goes to a temporary file so the terminal speed does
+not dominate.
+
+Usage:
+python benchmarks/bench_logging.py --messages 200000
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.logsetup import setup_logging, load_config, DataLogger
+from common.protocol import Reading
+
+
+def make_readings(count):
+    rng = random.Random(1)
+    now = int(time.time() * 1000000)
+    return [Reading(f"sensor{i % 50}", round(rng.uniform(15, 30), 2), round(rng.uniform(30, 70), 2),
+                    now + i * 1000, 0) for i in range(count)]
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+def run_before(readings, messages, directory):
+    reset_root()
+    logging.basicConfig(filename=os.path.join(directory, "drone.log"), level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logging.getLogger('').addHandler(console)
+
+    n = len(readings)
+    start = time.perf_counter()
+    for i in range(messages):
+        reading = readings[i % n]
+        logging.info(f"Received data: {reading}")
+    hot = time.perf_counter() - start
+    reset_root()
+    return hot, hot
+
+
+def run_pipeline(readings, messages, directory, fmt, rate):
+    reset_root()
+    config = load_config()
+    config.update({"directory": directory, "format": fmt})
+    config["sampling"]["data"]["rate"] = rate
+    received_log = DataLogger("data.received")
+
+    start = time.perf_counter()
+    listener = setup_logging("drone", config)
+    n = len(readings)
+    for i in range(messages):
+        received_log.info("Received data: %s", readings[i % n])
+    hot = time.perf_counter() - start
+    listener.stop()
+    total = time.perf_counter() - start
+    reset_root()
+    return hot, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    readings = make_readings(10000)
+    root = tempfile.mkdtemp(prefix="log-bench-")
+    stderr = sys.stderr
+    results = []
+    try:
+        for name, fmt, rate in (("before", None, None), ("queue", "text", 0), ("sampled", "text", 50),
+                                ("jsonl", "jsonl", 50)):
+            directory = os.path.join(root, name)
+            os.makedirs(directory)
+            # StreamHandler() binds sys.stderr when it is created
+            sys.stderr = open(os.path.join(directory, "console.out"), "w")
+            try:
+                if fmt is None:
+                    hot, total = run_before(readings, args.messages, directory)
+                else:
+                    hot, total = run_pipeline(readings, args.messages, directory, fmt, rate)
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+            size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+            results.append((name, hot, total, size))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    print(f"{args.messages} readings logged")
+    print(f"{'variant':<10}{'hot path msg/s':>16}{'total s':>10}{'written KB':>12}")
+    for name, hot, total, size in results:
+        print(f"{name:<10}{args.messages / hot:>16,.0f}{total:>10.2f}{size / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
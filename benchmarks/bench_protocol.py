@@ -0,0 +1,90 @@
+"""
+Bytes per record and encode/decode cost of the JSON-lines path versus the
+binary framing in common.protocol.
+
+Usage:
+python benchmarks/bench_protocol.py --records 100000 --sensors 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.framing import Framer, LENGTH
+from common.protocol import BinaryEncoder, BinaryDecoder, reading_from_dict, reading_to_dict
+
+
+def make_messages(count, sensors):
+    turkey_tz = timezone(timedelta(hours=3))
+    start = datetime.now(turkey_tz)
+    return [{
+        "sensor_id": f"sensor{i % sensors}",
+        "temperature": round(20 + (i % 100) / 20, 2),
+        "humidity": round(50 + (i % 70) / 10, 2),
+        "timestamp": (start + timedelta(milliseconds=i)).isoformat(),
+    } for i in range(count)]
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--sensors", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=500, help="readings per frame on the batched binary path")
+    args = parser.parse_args()
+
+    messages = make_messages(args.records, args.sensors)
+    readings = [reading_from_dict(m) for m in messages]
+    n = len(readings)
+    rows = []
+
+    # JSON lines, one message per line, as sensor.py has always sent them
+    wire, enc = timed(lambda: b"".join(json.dumps(m).encode() + b"\n" for m in messages))
+    _, dec = timed(lambda: [reading_from_dict(json.loads(line)) for line in wire.splitlines()])
+    rows.append(("json lines", len(wire), enc, dec))
+
+    # Binary, one frame per reading (a sensor sending as it measures)
+    encoder = BinaryEncoder()
+    wire, enc = timed(lambda: b"".join(encoder.encode([r]) for r in readings))
+
+    def decode_all(data):
+        decoder = BinaryDecoder()
+        framer = Framer(LENGTH, max_frame=len(data))
+        framer.feed(data)
+        return [decoder.decode(p)[2] for p in framer.frames()]
+
+    _, dec = timed(lambda: decode_all(wire))
+    rows.append(("binary per reading", len(wire), enc, dec))
+
+    # Binary, batched frames (the drone uplink)
+    encoder = BinaryEncoder()
+    wire, enc = timed(lambda: b"".join(encoder.encode_batch(i, readings[i:i + args.batch])
+                                       for i in range(0, n, args.batch)))
+    _, dec = timed(lambda: decode_all(wire))
+    rows.append((f"binary batch x{args.batch}", len(wire), enc, dec))
+
+    # JSON batch lines, the uplink fallback
+    wire, enc = timed(lambda: b"".join(
+        json.dumps({"batch": i, "records": [reading_to_dict(r) for r in readings[i:i + args.batch]]}).encode() + b"\n"
+        for i in range(0, n, args.batch)))
+    _, dec = timed(lambda: [[reading_from_dict(r) for r in json.loads(line)["records"]]
+                            for line in wire.splitlines()])
+    rows.append((f"json batch x{args.batch}", len(wire), enc, dec))
+
+    print(f"{n} readings from {args.sensors} sensors")
+    print(f"{'format':<22}{'bytes/record':>14}{'encode us/rec':>15}{'decode us/rec':>15}")
+    for name, size, enc, dec in rows:
+        print(f"{name:<22}{size / n:>14.1f}{enc / n * 1e6:>15.2f}{dec / n * 1e6:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Redundant uplink traffic and server work after outages, with and without
+sequence numbers (common.sequence).
+
+A drone-side Uplink sends --records readings in batches of --batch to a
+central server running in this process (common.uplink.serve_uplink). Two
+kinds of outage are simulated:
+
+lost acks     every --outage-every batches the server stores the batch and
+              drops the connection before its ack goes out, so the drone
+              sends the batch again after reconnecting
+replay        afterwards the drone sends everything once more, as after a
+              restart that lost its spool checkpoint
+
+Reported per mode: bytes sent over the uplink, records the server had to
+decode and hand to storage, and duplicate rows that ended up stored.
+"plain" sends unnumbered batches as before; "sequenced" numbers every
+record, so the server drops duplicates and the drone skips what the server
+reports it already has when it reconnects.
+
+Usage:
+python benchmarks/bench_resume.py --records 200000 --outage-every 20
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.metrics import metrics
+from common.protocol import Reading, FRAME_ACK
+from common.sequence import Sequencer, SequenceIndex
+from common.uplink import Uplink, serve_uplink
+
+SENSORS = 200
+
+
+class FlakyConnection:
+    """A server-side socket that drops the connection instead of sending every n-th ack."""
+
+    def __init__(self, conn, server):
+        self.conn = conn
+        self.server = server
+
+    def recv_into(self, *args):
+        return self.conn.recv_into(*args)
+
+    def sendall(self, data):
+        if data[4] == FRAME_ACK and self.server.outage_every:
+            self.server.acks += 1
+            if self.server.acks % self.server.outage_every == 0:
+                self.conn.close()
+                raise ConnectionResetError("Simulated outage")
+        self.conn.sendall(data)
+
+
+class Server:
+    def __init__(self, sequenced, outage_every):
+        self.sequences = SequenceIndex() if sequenced else None
+        self.outage_every = outage_every
+        self.acks = 0
+        self.handled = 0
+        self.rows = set()
+        self.duplicates = 0
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn, _ = self.listener.accept()
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        try:
+            serve_uplink(FlakyConnection(conn, self), self.store, sequences=self.sequences)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def store(self, records):
+        self.handled += len(records)
+        for r in records:
+            key = (r.sensor_id, r.ts_us)
+            if key in self.rows:
+                self.duplicates += 1
+            self.rows.add(key)
+
+
+def deliver(uplink, records, batch, epoch, seqs):
+    # Keep sending until every record is acknowledged, like the drone's outbox
+    sent = 0
+    while sent < len(records):
+        sent += uplink.send(records[sent:], batch, epoch=epoch, seqs=None if seqs is None else seqs[sent:])
+
+
+def run(mode, args):
+    records = [Reading(f"sensor{i % SENSORS}", 20.0 + i % 7, 50.0, 1_700_000_000_000_000 + i, 0)
+               for i in range(args.records)]
+    server = Server(mode == "sequenced", args.outage_every)
+    uplink = Uplink("127.0.0.1", server.port, min_backoff=0.001, max_backoff=0.001)
+    epoch = seqs = None
+    if mode == "sequenced":
+        sequencer = Sequencer()
+        epoch, seqs = sequencer.epoch, sequencer.number(records)
+    metrics.counters.clear()
+    started = time.perf_counter()
+
+    # Lost acks: batches are resent after every reconnect
+    deliver(uplink, records, args.batch, epoch, seqs)
+    lost_acks = (metrics.counters.get("uplink.sent_bytes", 0), server.handled, server.duplicates)
+
+    # Replay everything once more, with the numbers the records were sent with
+    server.outage_every = 0
+    uplink.close()
+    deliver(uplink, records, args.batch, epoch, seqs)
+    elapsed = time.perf_counter() - started
+    uplink.close()
+    total = (metrics.counters.get("uplink.sent_bytes", 0), server.handled, server.duplicates)
+    replay = tuple(b - a for a, b in zip(lost_acks, total))
+    return lost_acks, replay, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=500, help="readings per batch")
+    parser.add_argument("--outage-every", type=int, default=20, help="batches between two lost acks")
+    args = parser.parse_args()
+    # The outages are deliberate
+    logging.getLogger("common.uplink").setLevel(logging.CRITICAL)
+
+    print(f"{args.records:,} readings from {SENSORS} sensors, batches of {args.batch}, "
+          f"an ack lost every {args.outage_every} batches")
+    print(f"{'mode':>10}{'phase':>11}{'uplink MB':>11}{'handled':>11}{'dup rows':>10}")
+    for mode in ("plain", "sequenced"):
+        lost_acks, replay, elapsed = run(mode, args)
+        for phase, (sent_bytes, handled, duplicates) in (("lost acks", lost_acks), ("replay", replay)):
+            print(f"{mode:>10}{phase:>11}{sent_bytes / 1e6:>11.2f}{handled:>11,}{duplicates:>10,}")
+        print(f"{'':>10}{'took':>11}{elapsed:>10.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Throughput, memory and accuracy of the central server's event-time stage
+(common.stream) on simulated out-of-order traffic.
+
+--drones drones with --sensors sensors each report every --interval seconds
+for --duration seconds. Every drone forwards what it has every
+--flush seconds, at its own phase, so batches from different drones
+interleave out of order; one drone is out of range for --outage seconds in
+the middle and replays its spool once it is back (records up to minutes
+old). The batches go through the Reorderer and a 1 minute tumbling and a
+5 minute sliding (every minute) WindowAggregator, as in the server.
+
+Reported: records per second through the stage, the largest number of
+records waiting in the reorder heap and of open window panes (the stage's
+memory) against the records seen, whether the released stream was in
+event-time order, late records and the records dropped from windows that
+were already closed, and how many windows differ from aggregates computed
+over the complete, sorted history (all of them should be windows of the
+drone that was out of range).
+
+Usage:
+python benchmarks/bench_stream.py --drones 8 --sensors 50 --duration 1800
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import Reading
+from common.stream import Reorderer, WindowAggregator
+
+S = 1000000
+WINDOWS = ((60 * S, None), (300 * S, 60 * S))
+
+
+def traffic(args):
+    """Batches (arrival time, drone, readings) in arrival order."""
+    rng = random.Random(7)
+    batches = []
+    outage = (args.duration / 2, args.duration / 2 + args.outage)
+    for drone in range(args.drones):
+        phase = rng.uniform(0, args.flush)
+        pending = []
+        held = []
+        next_flush = phase
+        readings = []
+        for sensor in range(args.sensors):
+            start = rng.uniform(0, args.interval)
+            readings += [(start + k * args.interval, f"d{drone}s{sensor}")
+                         for k in range(int((args.duration - start) / args.interval))]
+        readings.sort()
+        for t, sensor_id in readings:
+            while t >= next_flush:
+                if drone == 0 and outage[0] <= next_flush < outage[1]:
+                    held += pending  # spooled while out of range
+                else:
+                    batches.append((next_flush + rng.uniform(0, 0.05), drone, held + pending))
+                    held = []
+                pending = []
+                next_flush += args.flush
+            pending.append(Reading(sensor_id, 20 + rng.random(), 50 + rng.random(), int(t * S), 0))
+        batches.append((next_flush, drone, held + pending))
+    batches.sort(key=lambda b: b[0])
+    return batches
+
+
+def exact(readings, size, slide):
+    windows = {}
+    for r in readings:
+        last = r.ts_us // slide
+        for window in range(last - size // slide + 1, last + 1):
+            w = windows.setdefault((r.sensor_id, window * slide), [0, 0.0, math.inf])
+            w[0] += 1
+            w[1] += r.temperature
+            w[2] = min(w[2], r.temperature)
+    return windows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--drones", type=int, default=8)
+    parser.add_argument("--sensors", type=int, default=50, help="sensors per drone")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between two readings of a sensor")
+    parser.add_argument("--duration", type=float, default=1800.0, help="simulated seconds")
+    parser.add_argument("--flush", type=float, default=5.0, help="seconds between two batches of a drone")
+    parser.add_argument("--outage", type=float, default=120.0, help="seconds drone 0 is out of range")
+    parser.add_argument("--delay", type=float, default=2.0, help="reorder delay per drone, seconds")
+    parser.add_argument("--lateness", type=float, default=10.0, help="window lateness, seconds")
+    args = parser.parse_args()
+
+    batches = traffic(args)
+    total = sum(len(records) for _, _, records in batches)
+    reorderer = Reorderer(int(args.delay * S))
+    aggregators = [WindowAggregator(size, slide, int(args.lateness * S)) for size, slide in WINDOWS]
+    results = [[] for _ in aggregators]
+    released = []
+    peak_waiting = peak_panes = 0
+    ordered = True
+    last_ts = -1
+
+    started = time.perf_counter()
+    for arrived, drone, records in batches:
+        out, late = reorderer.push(records, drone, now=arrived)
+        if out:
+            ordered = ordered and out[0].ts_us >= last_ts
+            last_ts = out[-1].ts_us
+            released += out
+        for aggregator, closed in zip(aggregators, results):
+            aggregator.add(out)
+            aggregator.add(late)
+            closed += aggregator.advance(reorderer.watermark)
+        peak_waiting = max(peak_waiting, len(reorderer.heap))
+        peak_panes = max(peak_panes, sum(a.open_panes() for a in aggregators))
+    out = reorderer.release(math.inf)
+    released += out
+    for aggregator, closed in zip(aggregators, results):
+        aggregator.add(out)
+        closed += aggregator.advance(math.inf)
+    elapsed = time.perf_counter() - started
+    ordered = ordered and all(a.ts_us <= b.ts_us for a, b in zip(released, released[1:]))
+
+    print(f"{total:,} readings from {args.drones} drones x {args.sensors} sensors over {args.duration:g}s, "
+          f"batches every {args.flush:g}s, drone 0 out of range for {args.outage:g}s")
+    print(f"stage: {total / elapsed:,.0f} records/s, released in order: {ordered}, "
+          f"late {reorderer.late:,}, peak waiting {peak_waiting:,} records, peak open panes {peak_panes:,}")
+    everything = [r for _, _, records in batches for r in records]
+    print(f"{'window':>14}{'emitted':>10}{'dropped late':>14}{'differ from exact':>19}{'of which outage':>17}")
+    # What drone 0 spooled, from its last batch before the outage to the replay
+    outage = ((args.duration / 2 - args.flush) * S, (args.duration / 2 + args.outage + args.flush) * S)
+    for (size, slide), aggregator, closed in zip(WINDOWS, aggregators, results):
+        slide = slide or size
+        expected = exact(everything, size, slide)
+        differ = in_outage = 0
+        got = {(s.sensor_id, s.start_us): s for s in closed}
+        for key, (n, total_t, low) in expected.items():
+            s = got.get(key)
+            if s is None or s.count != n or abs(s.temperature_mean - total_t / n) > 1e-6 or s.temperature_min != low:
+                differ += 1
+                # Windows of the drone that was out of range, overlapping the outage
+                if key[0].startswith("d0s") and key[1] < outage[1] and key[1] + size > outage[0]:
+                    in_outage += 1
+        name = f"{size // S}s" + ("" if slide == size else f"/{slide // S}s")
+        print(f"{name:>14}{aggregator.emitted:>10,}{aggregator.dropped:>14,}{differ:>19,}{in_outage:>17,}")
+
+
+if __name__ == "__main__":
+    main()
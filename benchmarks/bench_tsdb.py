@@ -0,0 +1,110 @@
+"""
+Write and read throughput of common.tsdb.TimeSeriesStore.
+
+Writes --rows readings from --sensors sensors (one reading per sensor per
+--step-ms, in uplink-sized batches) under each fsync policy, then measures
+full scans and short range scans on the resulting store.
+
+Usage:
+python benchmarks/bench_tsdb.py --rows 2000000 --sensors 100
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import Reading
+from common.tsdb import TimeSeriesStore, FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER
+
+
+def batches(rows, sensors, batch, step_us):
+    rng = random.Random(42)
+    names = [f"sensor{i}" for i in range(sensors)]
+    ts = 1_700_000_000_000_000
+    readings = []
+    for n in range(rows):
+        i = n % sensors
+        if i == 0:
+            ts += step_us
+        readings.append(Reading(names[i], 20 + rng.random(), 50 + rng.random(), ts, 0))
+        if len(readings) == batch:
+            yield readings
+            readings = []
+    if readings:
+        yield readings
+
+
+def bench_write(directory, policy, rows, sensors, batch, step_us):
+    store = TimeSeriesStore(directory, fsync=policy)
+    elapsed = 0.0
+    for readings in batches(rows, sensors, batch, step_us):
+        start = time.perf_counter()
+        store.write(readings)
+        elapsed += time.perf_counter() - start
+    start = time.perf_counter()
+    store.close()
+    elapsed += time.perf_counter() - start
+    return elapsed, store.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--always-rows", type=int, default=200_000,
+                        help="rows written with FSYNC_ALWAYS (one fsync per file per batch)")
+    parser.add_argument("--sensors", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--step-ms", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dir", default=None, help="where to create the stores (default: a temp dir)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="tsdb-bench-", dir=args.dir)
+    step_us = args.step_ms * 1000
+    try:
+        print(f"{args.rows} rows from {args.sensors} sensors, batches of {args.batch}")
+        print(f"{'write':<24}{'rows':>10}{'rows/sec':>14}{'fsyncs':>10}")
+        for policy in (FSYNC_NEVER, FSYNC_INTERVAL, FSYNC_ALWAYS):
+            rows = args.always_rows if policy == FSYNC_ALWAYS else args.rows
+            elapsed, stats = bench_write(os.path.join(root, policy), policy, rows, args.sensors,
+                                         args.batch, step_us)
+            print(f"{'fsync=' + policy:<24}{rows:>10}{rows / elapsed:>14.0f}{stats['fsyncs']:>10}")
+
+        store = TimeSeriesStore(os.path.join(root, FSYNC_NEVER), fsync=FSYNC_NEVER)
+        names = store.sensors()
+        print(f"{'read':<24}{'rows':>10}{'rows/sec':>14}{'avg ms':>10}")
+
+        start = time.perf_counter()
+        total = sum(len(store.read(name).ts_us) for name in names)
+        elapsed = time.perf_counter() - start
+        print(f"{'full scan (columns)':<24}{total:>10}{total / elapsed:>14.0f}{elapsed / len(names) * 1000:>10.2f}")
+
+        start = time.perf_counter()
+        total = sum(len(store.query(name)) for name in names[:10])
+        elapsed = time.perf_counter() - start
+        print(f"{'full scan (Readings)':<24}{total:>10}{total / elapsed:>14.0f}{elapsed / 10 * 1000:>10.2f}")
+
+        # One-minute windows at random points of the written time span
+        rng = random.Random(7)
+        first = 1_700_000_000_000_000
+        span = args.rows // args.sensors * step_us
+        window = 60 * 1000000
+        total = 0
+        start = time.perf_counter()
+        for _ in range(args.queries):
+            begin = first + rng.randrange(max(span - window, 1))
+            total += len(store.read(rng.choice(names), begin, begin + window).ts_us)
+        elapsed = time.perf_counter() - start
+        print(f"{'1 minute range scans':<24}{total:>10}{total / elapsed:>14.0f}{elapsed / args.queries * 1000:>10.2f}")
+        store.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
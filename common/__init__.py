@@ -0,0 +1 @@
+# Shared building blocks used by the sensor, drone and central server programs.
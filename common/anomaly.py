@@ -0,0 +1,277 @@
+"""
+Batch anomaly detection for drained reading buffers.
+
+AnomalyEngine.score() takes a whole batch of readings and applies, per field
+(temperature and humidity):
+
+static     value outside [min, max]
+z-score    |value - EWMA mean| / EWMA std above `zscore`, once the sensor has
+           `warmup` readings
+rate       |change| per second since the sensor's previous reading above `max_rate`
+
+Each sensor keeps a fixed amount of state per field (count, EWMA mean and
+variance, last value and timestamp) in flat arrays indexed by an interned
+sensor number, so memory is O(sensors) and independent of history length.
+
+When NumPy is installed the batch is scored with array operations: readings
+are grouped into rounds holding at most one reading per sensor, so the
+sequential EWMA updates stay exact while each round is vectorised. A batch
+from few sensors has few readings per round; once rounds get that small the
+rest of the batch goes through the plain loop, so the cost stays linear in
+the batch size. Without NumPy the same rules run in a plain Python loop.
+"""
+import time
+import math
+import logging
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional
+    np = None
+
+from common.config import load_json_config
+from common.protocol import (FLAG_TEMPERATURE, FLAG_HUMIDITY, FLAG_TEMPERATURE_ZSCORE, FLAG_HUMIDITY_ZSCORE,
+                             FLAG_TEMPERATURE_RATE, FLAG_HUMIDITY_RATE)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    # EWMA smoothing factor and readings needed before the z-score rule applies
+    "alpha": 0.05,
+    "warmup": 20,
+    "temperature": {"min": -10.0, "max": 60.0, "zscore": 6.0, "max_rate": 5.0},
+    "humidity": {"min": 10.0, "max": 90.0, "zscore": 6.0, "max_rate": 10.0},
+}
+
+# Fewest readings worth scoring as one vectorised round (see _score_numpy)
+MIN_ROUND = 32
+
+# (Reading field, static flag, z-score flag, rate flag)
+_FIELDS = (
+    ("temperature", FLAG_TEMPERATURE, FLAG_TEMPERATURE_ZSCORE, FLAG_TEMPERATURE_RATE),
+    ("humidity", FLAG_HUMIDITY, FLAG_HUMIDITY_ZSCORE, FLAG_HUMIDITY_RATE),
+)
+
+
+def load_config(path=None):
+    """Return DEFAULT_CONFIG overridden by the JSON file at path, if it exists."""
+    return load_json_config(DEFAULT_CONFIG, path)
+
+
+class AnomalyEngine:
+    """
+    Parameters:
+    config (dict): thresholds, see DEFAULT_CONFIG and load_config().
+    use_numpy (bool): vectorise with NumPy when it is installed.
+    """
+
+    def __init__(self, config=None, use_numpy=True):
+        self.config = config or load_config()
+        self.alpha = float(self.config["alpha"])
+        self.warmup = int(self.config["warmup"])
+        self.use_numpy = use_numpy and np is not None
+
+        self._index = {}
+        # Per field: count, mean, var, last value, last timestamp
+        self._state = {}
+        for field, _static, _z, _rate in _FIELDS:
+            if self.use_numpy:
+                self._state[field] = [np.zeros(0, np.int64), np.zeros(0), np.zeros(0),
+                                      np.zeros(0), np.zeros(0, np.int64)]
+            else:
+                self._state[field] = [array("q"), array("d"), array("d"), array("d"), array("q")]
+
+        # Scoring statistics
+        self.batches = 0
+        self.scored = 0
+        self.flagged = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def _intern(self, readings):
+        index = self._index
+        indexes = []
+        for r in readings:
+            i = index.get(r.sensor_id)
+            if i is None:
+                i = index[r.sensor_id] = len(index)
+            indexes.append(i)
+        self._grow(len(index))
+        return indexes
+
+    def _grow(self, size):
+        for field, state in self._state.items():
+            have = len(state[0])
+            if have >= size:
+                continue
+            if self.use_numpy:
+                new = max(size, 2 * have, 64)
+                for k, column in enumerate(state):
+                    grown = np.zeros(new, column.dtype)
+                    grown[:have] = column
+                    state[k] = grown
+            else:
+                for column in state:
+                    column.extend([0] * (size - have))
+
+    def score(self, readings):
+        """
+        Score a batch of readings in arrival order.
+
+        Returns the readings with anomaly flags set; readings without an
+        anomaly are returned unchanged (same objects).
+        """
+        if not readings:
+            return readings
+        start = time.perf_counter()
+        indexes = self._intern(readings)
+        if self.use_numpy:
+            flags = self._score_numpy(readings, indexes)
+        else:
+            flags = self._score_python(readings, indexes)
+
+        scored = list(readings)
+        flagged = 0
+        for i, f in enumerate(flags):
+            if f:
+                scored[i] = readings[i]._replace(flags=readings[i].flags | int(f))
+                flagged += 1
+
+        latency = time.perf_counter() - start
+        self.batches += 1
+        self.scored += len(readings)
+        self.flagged += flagged
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        log.debug(f"Scored {len(readings)} readings in {latency * 1000:.2f} ms, {flagged} anomalous")
+        return scored
+
+    def _score_python(self, readings, indexes, state=None):
+        state = state or self._state
+        alpha = self.alpha
+        warmup = self.warmup
+        flags = [0] * len(readings)
+        for field, static_flag, z_flag, rate_flag in _FIELDS:
+            limits = self.config[field]
+            low, high = limits["min"], limits["max"]
+            zscore, max_rate = limits["zscore"], limits["max_rate"]
+            count, mean, var, last, last_ts = state[field]
+            for n, (r, i) in enumerate(zip(readings, indexes)):
+                x = getattr(r, field)
+                if x != x:  # NaN: missing value
+                    continue
+                f = 0
+                if x > high or x < low:
+                    f |= static_flag
+                c = count[i]
+                if c:
+                    if c >= warmup and abs(x - mean[i]) > zscore * math.sqrt(var[i]) and var[i] > 0:
+                        f |= z_flag
+                    dt = (r.ts_us - last_ts[i]) / 1e6
+                    if dt > 0 and abs(x - last[i]) / dt > max_rate:
+                        f |= rate_flag
+                    diff = x - mean[i]
+                    incr = alpha * diff
+                    mean[i] += incr
+                    var[i] = (1 - alpha) * (var[i] + diff * incr)
+                else:
+                    mean[i] = x
+                    var[i] = 0.0
+                count[i] = c + 1
+                last[i] = x
+                last_ts[i] = r.ts_us
+                flags[n] |= f
+        return flags
+
+    def _score_numpy(self, readings, indexes):
+        n = len(readings)
+        idx = np.fromiter(indexes, np.int64, n)
+        ts = np.fromiter((r.ts_us for r in readings), np.int64, n)
+
+        # Rank of every reading among the readings of the same sensor in this batch
+        order = np.argsort(idx, kind="stable")
+        sorted_idx = idx[order]
+        group_start = np.r_[0, np.flatnonzero(sorted_idx[1:] != sorted_idx[:-1]) + 1]
+        group_size = np.diff(np.r_[group_start, n])
+        rank = np.empty(n, np.int64)
+        rank[order] = np.arange(n) - np.repeat(group_start, group_size)
+
+        # Round k holds the k-th reading of every sensor; rounds only shrink.
+        # Rounds of fewer than MIN_ROUND readings cost more in NumPy calls
+        # than they save, so the readings from the first such round on (the
+        # later readings of the sensors with the most) are scored in the
+        # plain loop, after the rounds, which keeps every sensor's order.
+        sizes = np.bincount(rank)
+        vectorised = int(np.argmax(sizes < MIN_ROUND)) if sizes[-1] < MIN_ROUND else len(sizes)
+        by_rank = np.argsort(rank, kind="stable")
+        ends = np.cumsum(sizes[:vectorised])
+        split = int(ends[-1]) if vectorised else 0
+        rounds = np.split(by_rank[:split], ends[:-1]) if vectorised else []
+        rest = by_rank[split:]
+
+        flags = np.zeros(n, np.int64)
+        alpha = self.alpha
+        for field, static_flag, z_flag, rate_flag in _FIELDS:
+            limits = self.config[field]
+            count, mean, var, last, last_ts = self._state[field]
+            x = np.fromiter((getattr(r, field) for r in readings), np.float64, n)
+            valid = ~np.isnan(x)
+            with np.errstate(invalid="ignore"):
+                flags |= np.where(valid & ((x > limits["max"]) | (x < limits["min"])), static_flag, 0)
+
+            # Each round holds at most one reading per sensor, so the state
+            # updates inside a round never collide
+            for positions in rounds:
+                positions = positions[valid[positions]]
+                if not len(positions):
+                    continue
+                s = idx[positions]
+                xv = x[positions]
+                c = count[s]
+                seen = c > 0
+                m = mean[s]
+                v = var[s]
+
+                deviation = np.abs(xv - m)
+                z_hit = seen & (c >= self.warmup) & (v > 0) & (deviation > limits["zscore"] * np.sqrt(v))
+                dt = (ts[positions] - last_ts[s]) / 1e6
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    rate_hit = seen & (dt > 0) & (np.abs(xv - last[s]) / dt > limits["max_rate"])
+                flags[positions] |= np.where(z_hit, z_flag, 0) | np.where(rate_hit, rate_flag, 0)
+
+                diff = xv - m
+                incr = alpha * diff
+                mean[s] = np.where(seen, m + incr, xv)
+                var[s] = np.where(seen, (1 - alpha) * (v + diff * incr), 0.0)
+                count[s] = c + 1
+                last[s] = xv
+                last_ts[s] = ts[positions]
+        flags = flags.tolist()
+        if len(rest):
+            # The plain loop runs on lists holding the state of these sensors only
+            rest = np.sort(rest)
+            sensors, local = np.unique(idx[rest], return_inverse=True)
+            state = {field: [column[sensors].tolist() for column in columns]
+                     for field, columns in self._state.items()}
+            rest = rest.tolist()
+            for position, f in zip(rest, self._score_python([readings[p] for p in rest], local.tolist(), state)):
+                flags[position] |= f
+            for field, columns in self._state.items():
+                for column, values in zip(columns, state[field]):
+                    column[sensors] = values
+        return flags
+
+    def stats(self):
+        """Scoring counters and per-batch latency in milliseconds."""
+        return {
+            "batches": self.batches,
+            "scored": self.scored,
+            "flagged": self.flagged,
+            "sensors": len(self._index),
+            "last_ms": round(self.last_latency * 1000, 3),
+            "avg_ms": round(self.total_latency / self.batches * 1000, 3) if self.batches else 0.0,
+            "max_ms": round(self.max_latency * 1000, 3),
+        }
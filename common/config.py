@@ -0,0 +1,34 @@
+"""
+JSON configuration files shared by the drone, sensor and server modules.
+
+Every configurable module (anomaly, edge, flush, logsetup) keeps its
+settings in a DEFAULT_CONFIG dict and lets a JSON file override part of it.
+A key of the file replaces the default; a nested dict only replaces the
+keys it names, so a file can change one threshold without repeating the
+others. A missing file leaves the defaults as they are.
+"""
+import json
+
+
+def load_json_config(defaults, path=None):
+    """
+    Return a copy of defaults overridden by the JSON file at path, if it exists.
+
+    Parameters:
+    defaults (dict): the module's DEFAULT_CONFIG; it is not modified.
+    path (str): optional JSON file.
+    """
+    config = json.loads(json.dumps(defaults))
+    if not path:
+        return config
+    try:
+        with open(path) as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        return config
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    return config
@@ -0,0 +1,373 @@
+"""
+Drone core: everything the drone does between the sensors and the central
+server, without any user interface.
+
+DroneCore runs the sensor ingest, batch anomaly detection, the simulated
+battery with its return-to-base state, edge reduction, spooling and
+forwarding on its own threads. Forwarding is driven by a FlushPolicy
+(common.flush): waiting records go out once there are enough of them or
+the oldest has waited for the latency target, and anomalies right away.
+Every transmission costs battery according to the policy's energy model.
+Front ends (drone/drone.py, gui/drone_gui.py) only subscribe to events:
+
+connect       callback(addr)                  a sensor connected
+disconnect    callback(addr, reason)          a sensor disconnected
+readings      callback(readings)              a batch of scored readings
+anomalies     callback(messages)              "[ANOMALY] <sensor> - <text>" per anomaly in that batch
+battery       callback(level)                 the battery level changed
+status        callback(returning_to_base)     entered or left return-to-base mode
+forwarded     callback(records)               records acknowledged by the central server
+undelivered   callback(count)                 records left in the outbox after a failed send
+queued        callback(count)                 records spooled while returning to base
+flushed       callback(records)               spooled records replayed to the server
+flush_failed  callback(flushed)               a spool replay stopped after `flushed` records
+dropped       callback(total)                 readings dropped so far because a buffer was full
+depleted      callback(total)                 readings refused so far because the battery was empty
+stats         callback(stats)                 every stats_interval seconds, see stats()
+
+Callbacks run on the core's worker threads, never on the ingest loops: the
+ingest callback only appends to a ring buffer, and events are raised from
+the detection, forwarding and battery threads. A callback must return
+quickly (a GUI should queue the data and paint it from its own thread); an
+exception in a callback is logged and does not stop the core.
+"""
+import threading
+import logging
+import time
+from array import array
+
+from common.ingest import IngestServer
+from common.uplink import Uplink
+from common.ring_buffer import ReadingBuffer, DROP_OLDEST
+from common.spool import Spool
+from common.sequence import Sequencer
+from common.anomaly import AnomalyEngine, load_config as load_anomaly_config
+from common.edge import EdgeReducer, load_config as load_edge_config
+from common.flush import FlushPolicy, load_config as load_flush_config
+from common.protocol import RECORD, anomaly_messages
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+EVENTS = ("connect", "disconnect", "readings", "anomalies", "battery", "status", "forwarded", "undelivered",
+          "queued", "flushed", "flush_failed", "dropped", "depleted", "stats")
+
+# Battery level (percent) below which the drone returns to base, and at which it resumes
+LOW_BATTERY = 20.0
+RESUME_BATTERY = 90.0
+
+
+class DroneCore:
+    """
+    Parameters:
+    port (int): port the drone listens on for sensors.
+    central_host (str), central_port (int): central server address.
+    workers (int): number of ingest event loops.
+    buffer_capacity (int): readings held in each of the incoming and scored buffers.
+    anomaly_config (str): path of the anomaly thresholds file (see common.anomaly).
+    edge_config (str): path of the edge reduction settings (see common.edge).
+    flush_config (str): path of the flush policy and energy model settings (see common.flush).
+    spool_dir (str): where data is spooled while returning to base.
+    flush_chunk (int): readings per forwarded or replayed chunk.
+    detect_interval (float): seconds between anomaly scoring passes.
+    stats_interval (float): seconds between two stats events.
+    battery_interval (float): seconds between battery updates.
+    battery_drain (float): percent of battery used per battery update while idle; 0 disables
+        the simulation, including the cost of transmissions.
+    """
+
+    def __init__(self, port=5000, central_host="127.0.0.1", central_port=6000, workers=1,
+                 buffer_capacity=100000, anomaly_config=None, edge_config=None, flush_config=None,
+                 spool_dir="spool", flush_chunk=5000, detect_interval=0.2, stats_interval=5.0,
+                 battery_interval=5.0, battery_drain=1.0):
+        self.port = port
+        self.workers = workers
+        self.flush_chunk = flush_chunk
+        self.detect_interval = detect_interval
+        self.stats_interval = stats_interval
+        self.battery_interval = battery_interval
+        self.battery_drain = battery_drain
+
+        # Readings waiting to be scored for anomalies, and scored readings waiting to be forwarded
+        self.incoming = ReadingBuffer(buffer_capacity, DROP_OLDEST)
+        self.scored = ReadingBuffer(buffer_capacity, DROP_OLDEST)
+
+        self.anomaly_engine = AnomalyEngine(load_anomaly_config(anomaly_config))
+
+        # Edge reduction between the scored buffer and the uplink; reduced
+        # records wait in the outbox until the server acknowledges them.
+        # Every record is numbered as it leaves the edge reduction (see
+        # common.sequence), so the server can drop what it already has
+        self.edge = EdgeReducer(load_edge_config(edge_config))
+        self.sequencer = Sequencer()
+        self.outbox = []
+        self.outbox_seqs = array("I")
+
+        # When to forward: the detection thread wakes the forwarding thread
+        # once the policy says so, otherwise it sleeps until the latency
+        # target of the oldest waiting record. pending_since is when the
+        # oldest record not yet forwarded was scored
+        self.flush_policy = FlushPolicy(load_flush_config(flush_config), LOW_BATTERY)
+        self.pending_since = None
+        self.urgent = False
+        self.retry_at = 0.0
+        self._pending_lock = threading.Lock()
+        self._wake = threading.Event()
+
+        # Persistent connection to the central server shared by forwarding and flushing
+        self.uplink = Uplink(central_host, central_port, on_transmit=self._on_transmit)
+        self.transmissions = 0
+        self.energy_used = 0.0
+
+        # Battery simulation and the data spooled while returning to base
+        self.battery_level = 100.0
+        self.returning_to_base = False
+        self.spool = Spool(spool_dir, epoch=self.sequencer.epoch)
+        self.flush_lock = threading.Lock()
+
+        self.ingest = None
+        self.depleted = 0
+        self._subscribers = {event: [] for event in EVENTS}
+        self._stopped = threading.Event()
+
+        # Read whenever a metrics snapshot is taken (see common.metrics)
+        metrics.gauge("drone.battery", lambda: self.battery_level)
+        metrics.gauge("drone.returning_to_base", lambda: self.returning_to_base)
+        metrics.gauge("drone.sensors", lambda: self.ingest.connection_count if self.ingest else 0)
+        metrics.gauge("queue.incoming", lambda: len(self.incoming))
+        metrics.gauge("queue.scored", lambda: len(self.scored))
+        metrics.gauge("queue.outbox", lambda: len(self.outbox))
+        metrics.gauge("queue.spooled_bytes", self.spool.pending_bytes)
+        metrics.gauge("drops.buffer_full", lambda: self.incoming.dropped + self.scored.dropped)
+        metrics.gauge("drops.battery_depleted", lambda: self.depleted)
+        metrics.gauge("drone.energy_used", lambda: round(self.energy_used, 4))
+        metrics.gauge("drone.latency_target", lambda: self.flush_policy.age_limit(self.battery_level))
+
+    def subscribe(self, event, callback):
+        """Call callback(*args) whenever event happens (see the module docstring)."""
+        if event not in self._subscribers:
+            raise ValueError(f"Unknown drone event: {event}")
+        self._subscribers[event].append(callback)
+
+    def _emit(self, event, *args):
+        for callback in self._subscribers[event]:
+            try:
+                callback(*args)
+            except Exception:
+                log.exception(f"Subscriber for '{event}' failed")
+
+    def start(self):
+        """Start ingest and the worker threads and return immediately."""
+        self.ingest = IngestServer(self.port, self._on_reading, self._on_connect, self._on_disconnect,
+                                   workers=self.workers)
+        self.ingest.start()
+        threading.Thread(target=self._detect_loop, name="detect", daemon=True).start()
+        threading.Thread(target=self._forward_loop, name="forward", daemon=True).start()
+        if self.battery_drain:
+            threading.Thread(target=self._battery_loop, name="battery", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self.ingest is not None:
+            self.ingest.stop()
+        self.uplink.close()
+
+    def wait(self):
+        """Block until stop() is called."""
+        self._stopped.wait()
+
+    # Ingest callbacks; these run on the ingest loops and must stay cheap
+    def _on_reading(self, reading, addr):
+        # If battery is dead, drop incoming data
+        if self.battery_level <= 0:
+            self.depleted += 1
+            return
+        self.incoming.append(reading)
+
+    def _on_connect(self, addr):
+        self._emit("connect", addr)
+
+    def _on_disconnect(self, addr, reason):
+        self._emit("disconnect", addr, reason)
+
+    # Score everything received since the last pass as one batch, then
+    # publish and buffer the scored readings
+    def _detect_loop(self):
+        while not self._stopped.wait(self.detect_interval):
+            batch = self.incoming.drain()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            scored = self.anomaly_engine.score(batch)
+            metrics.observe("stage.detect", (time.perf_counter() - started) * 1000000)
+            metrics.observe_ages("age.drone_scored", scored)
+            alerts = [f"[ANOMALY] {r.sensor_id} - {a}" for r in scored if r.flags for a in anomaly_messages(r)]
+            if alerts:
+                self._emit("anomalies", alerts)
+            self._emit("readings", scored)
+            with self._pending_lock:
+                self.scored.extend(scored)
+                if self.pending_since is None:
+                    self.pending_since = time.monotonic()
+                if alerts:
+                    self.urgent = True
+            if self.flush_reason() is not None:
+                self._wake.set()
+
+    # Battery cost of every batch the uplink writes (see common.flush)
+    def _on_transmit(self, nbytes):
+        cost = self.flush_policy.energy.transmission(nbytes)
+        self.transmissions += 1
+        self.energy_used += cost
+        metrics.inc("drone.transmissions")
+        if self.battery_drain:
+            self.set_battery(self.battery_level - cost)
+
+    # Simulate battery consumption over time
+    def _battery_loop(self):
+        while not self._stopped.wait(self.battery_interval):
+            self.set_battery(self.battery_level - self.battery_drain)
+
+    def set_battery(self, level):
+        """Update the battery level and enter or leave return-to-base mode."""
+        self.battery_level = max(0.0, min(100.0, level))
+        self._emit("battery", self.battery_level)
+
+        # Enter low battery mode
+        if self.battery_level < LOW_BATTERY and not self.returning_to_base:
+            self.returning_to_base = True
+            self._emit("status", True)
+
+        # Restore to normal if battery recharges
+        elif self.battery_level >= RESUME_BATTERY and self.returning_to_base:
+            self.returning_to_base = False
+            self._emit("status", False)
+            self.flush_spool()
+
+    # Replay the spooled data to the server after battery recovers. The spool
+    # checkpoint only advances past acknowledged readings, so a failed or
+    # interrupted flush resumes where it stopped
+    def flush_spool(self):
+        # The battery and forwarding threads may both trigger a flush; one is enough
+        if not self.flush_lock.acquire(blocking=False):
+            return
+        try:
+            flushed = 0
+            for chunk in self.spool.replay(self.flush_chunk):
+                sent = self.uplink.send(chunk.readings, epoch=chunk.epoch, seqs=chunk.seqs)
+                self.spool.commit(chunk, sent)
+                flushed += sent
+                if sent:
+                    self._emit("flushed", chunk.readings[:sent])
+                if sent < len(chunk.readings):
+                    self._emit("flush_failed", flushed)
+                    return
+        finally:
+            self.flush_lock.release()
+
+    def flush_reason(self):
+        """Why the waiting records should be forwarded now, or None (see FlushPolicy.reason())."""
+        if time.monotonic() < self.retry_at:
+            return None
+        pending = len(self.scored) + len(self.outbox)
+        age = time.monotonic() - self.pending_since if self.pending_since is not None else 0.0
+        return self.flush_policy.reason(pending, pending * RECORD.size, age, self.battery_level, self.urgent)
+
+    # Forward waiting records whenever the flush policy says so
+    def _forward_loop(self):
+        reported_drops = 0
+        reported_depleted = 0
+        next_stats = time.monotonic() + self.stats_interval
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            timeout = self.flush_policy.wait(now - (self.pending_since or now), self.battery_level)
+            if self.retry_at > now:
+                timeout = max(timeout, self.retry_at - now)
+            self._wake.wait(min(timeout, max(0.0, next_stats - now)))
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            reason = self.flush_reason()
+            if reason is not None:
+                metrics.inc(f"flush.{reason}")
+                self.flush()
+            elif self.pending_since is None:
+                # Nothing waiting: summary windows that are due still get closed
+                self.flush()
+            if time.monotonic() < next_stats:
+                continue
+            next_stats += self.stats_interval
+            drops = self.incoming.dropped + self.scored.dropped
+            if drops != reported_drops:
+                reported_drops = drops
+                self._emit("dropped", drops)
+            if self.depleted != reported_depleted:
+                reported_depleted = self.depleted
+                self._emit("depleted", reported_depleted)
+            self._emit("stats", self.stats())
+
+    def flush(self):
+        """Forward (or, while returning to base, spool) everything waiting."""
+        self.urgent = False
+        # Spooled data left over from an earlier flush (or a restart) goes first
+        if not self.returning_to_base and self.spool.pending_bytes():
+            self.flush_spool()
+        if self.returning_to_base:
+            # Queue data on disk while returning to base
+            reduced = self.edge.reduce(self.scored.drain())
+            pending = self.outbox + reduced
+            seqs = self.outbox_seqs + self.sequencer.number(reduced)
+            self.outbox = []
+            self.outbox_seqs = array("I")
+            if pending:
+                self.spool.append(pending, seqs)
+                self._emit("queued", len(pending))
+        else:
+            self.forward_outbox()
+        with self._pending_lock:
+            if self.outbox:
+                # Undelivered: try again once the latency target has passed
+                self.retry_at = time.monotonic() + self.flush_policy.max_age
+            elif not len(self.scored):
+                self.pending_since = None
+
+    # Reduce buffered readings chunk by chunk and send them; only acknowledged
+    # records leave the outbox, the rest is retried on the next cycle
+    def forward_outbox(self):
+        more = True
+        while self.outbox or more:
+            if not self.outbox:
+                # Summary windows that are due are closed even when no readings arrived
+                readings = self.scored.drain(self.flush_chunk)
+                more = len(readings) == self.flush_chunk
+                self.outbox = self.edge.reduce(readings)
+                self.outbox_seqs = self.sequencer.number(self.outbox)
+                if not self.outbox:
+                    continue
+            sent = self.uplink.send(self.outbox, epoch=self.sequencer.epoch, seqs=self.outbox_seqs)
+            if sent:
+                metrics.observe_ages("age.drone_forwarded", self.outbox[:sent])
+                self._emit("forwarded", self.outbox[:sent])
+            del self.outbox[:sent]
+            del self.outbox_seqs[:sent]
+            if self.outbox:
+                self._emit("undelivered", len(self.outbox))
+                return
+
+    def stats(self):
+        return {
+            "battery": self.battery_level,
+            "returning_to_base": self.returning_to_base,
+            "sensors": self.ingest.connection_count if self.ingest else 0,
+            "incoming": self.incoming.stats(),
+            "scored": self.scored.stats(),
+            "outbox": len(self.outbox),
+            "spooled_bytes": self.spool.pending_bytes(),
+            "depleted": self.depleted,
+            "anomaly": self.anomaly_engine.stats() if self.anomaly_engine.batches else None,
+            "edge": self.edge.stats(),
+            "transmissions": self.transmissions,
+            "energy_used": round(self.energy_used, 4),
+            "latency_target": self.flush_policy.age_limit(self.battery_level),
+        }
@@ -0,0 +1,212 @@
+"""
+Edge reduction: shrink what the drone forwards to the central server.
+
+EdgeReducer.reduce() takes scored readings in arrival order and returns the
+records to forward. Anomalous readings (flags set) always pass through at
+full resolution. What happens to the others depends on the mode:
+
+raw        forward every reading (no reduction)
+deadband   forward a reading only if temperature or humidity moved more than
+           the deadband since the sensor's last forwarded reading, or if
+           nothing was forwarded for `heartbeat` seconds
+summary    forward one Summary per sensor and window of `window` seconds
+           (count, min/max/mean/last of each field) instead of the readings
+
+A window is closed when the sensor sends a reading past its end, or once the
+drone clock is `lateness` seconds past its end. Readings that arrive for a
+window that was already closed are forwarded as they are. Summaries only
+cover normal readings, so the anomalies forwarded next to them are not
+counted twice.
+"""
+import math
+import time
+
+from common.config import load_json_config
+from common.protocol import Summary
+
+MODE_RAW = "raw"
+MODE_DEADBAND = "deadband"
+MODE_SUMMARY = "summary"
+
+DEFAULT_CONFIG = {
+    "mode": MODE_RAW,
+    # summary mode: window length and how long to wait for late readings (seconds)
+    "window": 10.0,
+    "lateness": 2.0,
+    # deadband mode: smallest change worth forwarding, and the longest silence per sensor
+    "deadband": {"temperature": 0.5, "humidity": 1.0},
+    "heartbeat": 60.0,
+}
+
+
+def load_config(path=None):
+    """Return DEFAULT_CONFIG overridden by the JSON file at path, if it exists."""
+    return load_json_config(DEFAULT_CONFIG, path)
+
+
+class _Window:
+    __slots__ = ("start", "end", "count", "t_n", "t_sum", "t_min", "t_max", "h_n", "h_sum", "h_min", "h_max",
+                 "last")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.count = 0
+        self.t_n = self.h_n = 0
+        self.t_sum = self.h_sum = 0.0
+        self.t_min = self.h_min = math.inf
+        self.t_max = self.h_max = -math.inf
+        self.last = None
+
+    def add(self, r):
+        self.count += 1
+        t = r.temperature
+        if t == t:  # NaN: missing value
+            self.t_n += 1
+            self.t_sum += t
+            if t < self.t_min:
+                self.t_min = t
+            if t > self.t_max:
+                self.t_max = t
+        h = r.humidity
+        if h == h:
+            self.h_n += 1
+            self.h_sum += h
+            if h < self.h_min:
+                self.h_min = h
+            if h > self.h_max:
+                self.h_max = h
+        if self.last is None or r.ts_us >= self.last.ts_us:
+            self.last = r
+
+    def summary(self):
+        nan = math.nan
+        t_n, h_n, last = self.t_n, self.h_n, self.last
+        return Summary(last.sensor_id, self.start, self.end, self.count,
+                       self.t_min if t_n else nan, self.t_max if t_n else nan,
+                       self.t_sum / t_n if t_n else nan, last.temperature,
+                       self.h_min if h_n else nan, self.h_max if h_n else nan,
+                       self.h_sum / h_n if h_n else nan, last.humidity, last.ts_us)
+
+
+class EdgeReducer:
+    """
+    Parameters:
+    config (dict): see DEFAULT_CONFIG and load_config().
+    """
+
+    def __init__(self, config=None):
+        self.config = config or load_config()
+        self.mode = self.config["mode"]
+        if self.mode not in (MODE_RAW, MODE_DEADBAND, MODE_SUMMARY):
+            raise ValueError(f"Unknown edge reduction mode: {self.mode}")
+        self.window_us = int(self.config["window"] * 1000000)
+        self.lateness_us = int(self.config["lateness"] * 1000000)
+        self.heartbeat_us = int(self.config["heartbeat"] * 1000000)
+        self.deadband_t = float(self.config["deadband"]["temperature"])
+        self.deadband_h = float(self.config["deadband"]["humidity"])
+
+        # summary mode: open window per sensor, and where the last closed one ended
+        self._windows = {}
+        self._closed_until = {}
+        # deadband mode: last forwarded reading per sensor
+        self._forwarded = {}
+
+        # Counters
+        self.readings_in = 0
+        self.records_out = 0
+        self.anomalies = 0
+        self.suppressed = 0
+        self.summaries = 0
+
+    def reduce(self, readings, now_us=None):
+        """
+        Return the records to forward for readings, plus every summary
+        window that is due by now_us (default: the current time).
+        """
+        if self.mode == MODE_RAW:
+            out = list(readings)
+        elif self.mode == MODE_DEADBAND:
+            out = self._deadband(readings)
+        else:
+            out = self._summarise(readings, int(time.time() * 1000000) if now_us is None else now_us)
+        self.readings_in += len(readings)
+        self.records_out += len(out)
+        return out
+
+    def flush(self):
+        """Close every open window, e.g. before shutting down."""
+        out = [window.summary() for window in self._windows.values()]
+        for sensor_id, window in self._windows.items():
+            self._closed_until[sensor_id] = window.end
+        self._windows.clear()
+        self.summaries += len(out)
+        self.records_out += len(out)
+        return out
+
+    def _deadband(self, readings):
+        forwarded = self._forwarded
+        db_t, db_h, heartbeat = self.deadband_t, self.deadband_h, self.heartbeat_us
+        out = []
+        for r in readings:
+            if r.flags:
+                self.anomalies += 1
+            else:
+                last = forwarded.get(r.sensor_id)
+                if last is not None and r.ts_us - last.ts_us < heartbeat:
+                    dt = abs(r.temperature - last.temperature)
+                    dh = abs(r.humidity - last.humidity)
+                    # NaN on either side counts as a change
+                    if dt <= db_t and dh <= db_h:
+                        self.suppressed += 1
+                        continue
+            forwarded[r.sensor_id] = r
+            out.append(r)
+        return out
+
+    def _summarise(self, readings, now_us):
+        windows = self._windows
+        closed_until = self._closed_until
+        window_us = self.window_us
+        out = []
+        for r in readings:
+            if r.flags:
+                self.anomalies += 1
+                out.append(r)
+                continue
+            window = windows.get(r.sensor_id)
+            if window is None or r.ts_us >= window.end:
+                if window is not None:
+                    out.append(window.summary())
+                    closed_until[r.sensor_id] = window.end
+                    self.summaries += 1
+                start = r.ts_us // window_us * window_us
+                if start < closed_until.get(r.sensor_id, start):
+                    # Late reading for a window that was already forwarded
+                    out.append(r)
+                    continue
+                window = windows[r.sensor_id] = _Window(start, start + window_us)
+            elif r.ts_us < window.start:
+                out.append(r)
+                continue
+            window.add(r)
+
+        # Windows nobody has written past, but whose time is up
+        due = now_us - self.lateness_us
+        for sensor_id in [s for s, w in windows.items() if w.end <= due]:
+            window = windows.pop(sensor_id)
+            out.append(window.summary())
+            closed_until[sensor_id] = window.end
+            self.summaries += 1
+        return out
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "readings_in": self.readings_in,
+            "records_out": self.records_out,
+            "anomalies": self.anomalies,
+            "suppressed": self.suppressed,
+            "summaries": self.summaries,
+            "open_windows": len(self._windows),
+        }
@@ -0,0 +1,311 @@
+"""
+Live feed of the records the central server receives, for any number of
+viewers besides the server's own window.
+
+LiveFeed fans every stored batch out to its subscribers. publish() is
+called on the thread that handled the batch and only queues it (nothing at
+all happens while nobody is subscribed); a fan-out thread serializes the
+batch once, one JSON line per record as in the JSON uplink messages, and
+hands the same bytes to every subscriber. Subscribers with a sensor filter
+get the lines of their sensors, grouped per sensor once per batch, so the
+cost of a batch does not grow with the number of subscribers and the
+ingest path does not slow down as viewers are added.
+
+Every subscriber has a bounded queue of batches. When a subscriber does not
+keep up, its policy decides what is lost:
+
+drop      batches arriving while the queue is full are dropped
+latest    the queued backlog is dropped and the newest batch kept
+          (skip to latest, for dashboards that only show the current state)
+
+Either way the subscriber is told how many records it missed by a
+{"dropped": n} line before the next records it gets.
+
+FeedServer streams the feed over HTTP on localhost, one connection per
+subscriber:
+
+/feed?sensor=ID&policy=latest&queue=N      newline-delimited JSON until the client disconnects
+
+sensor= may be repeated and is optional (every sensor), policy defaults to
+drop and queue (batches) to QUEUE_BATCHES. Blank lines are keep-alives.
+e.g. curl -N "http://127.0.0.1:6300/feed?sensor=sensor1"
+"""
+import json
+import queue
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from common.protocol import Summary, reading_to_dict, summary_to_dict
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+FEED_PORT = 6300
+
+# Batches queued per subscriber unless it asks for another size
+QUEUE_BATCHES = 64
+MAX_QUEUE_BATCHES = 10000
+
+# Batches waiting for the fan-out thread; beyond that publish() drops them
+# rather than hold up the ingest path
+PUBLISH_QUEUE = 1000
+
+# Seconds without data after which a keep-alive line is sent, and after
+# which a subscriber that stopped reading is disconnected
+KEEPALIVE = 15.0
+STALL_TIMEOUT = 60.0
+
+POLICIES = ("drop", "latest")
+
+# json.dumps() with separators builds a new encoder on every call
+_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+
+class _Batch:
+    """One published batch, serialized once for all subscribers."""
+
+    __slots__ = ("data", "count", "_lines", "_sensors")
+
+    def __init__(self, records):
+        self._lines = [(r.sensor_id, (_encode(summary_to_dict(r) if type(r) is Summary else reading_to_dict(r))
+                                      + "\n").encode())
+                       for r in records]
+        self.data = b"".join(line for _, line in self._lines)
+        self.count = len(self._lines)
+        self._sensors = None
+
+    def select(self, sensors):
+        """(bytes, records) of the given sensors, or of all of them for None."""
+        if sensors is None:
+            return self.data, self.count
+        if self._sensors is None:
+            # Grouped when the first filtered subscriber asks
+            grouped = {}
+            for sensor, line in self._lines:
+                grouped.setdefault(sensor, []).append(line)
+            self._sensors = {sensor: (b"".join(lines), len(lines)) for sensor, lines in grouped.items()}
+        if len(sensors) == 1:
+            for sensor in sensors:
+                return self._sensors.get(sensor, (b"", 0))
+        if len(sensors) < len(self._sensors):
+            parts = [self._sensors[s] for s in sensors if s in self._sensors]
+        else:
+            parts = [part for s, part in self._sensors.items() if s in sensors]
+        return b"".join(data for data, _ in parts), sum(count for _, count in parts)
+
+
+class Subscriber:
+    """
+    One subscriber's queue. Returned by LiveFeed.subscribe(); read it with take().
+
+    Parameters:
+    sensors (iterable): sensor ids to receive; empty for every sensor.
+    policy (str): "drop" or "latest", what to lose when the queue is full.
+    queue_size (int): batches queued before the policy applies.
+    """
+
+    def __init__(self, sensors=(), policy="drop", queue_size=QUEUE_BATCHES):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy: {policy!r} (use {' or '.join(POLICIES)})")
+        if not 1 <= queue_size <= MAX_QUEUE_BATCHES:
+            raise ValueError(f"queue must be between 1 and {MAX_QUEUE_BATCHES}")
+        self.sensors = frozenset(sensors) or None
+        self.policy = policy
+        self.queue_size = queue_size
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.closed = False
+        # Records missed since the last take(), and totals
+        self.missed = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def offer(self, batch):
+        # Called from the fan-out thread only
+        data, count = batch.select(self.sensors)
+        if not count:
+            return
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                if self.policy == "drop":
+                    lost = count
+                else:
+                    lost = sum(n for _, n in self.queue)
+                    self.queue.clear()
+                self.missed += lost
+                self.dropped += lost
+                metrics.inc("feed.dropped", lost)
+                if self.policy == "drop":
+                    return
+            self.queue.append((data, count))
+            self.cond.notify()
+
+    def take(self, timeout=None):
+        """
+        Wait up to timeout seconds for data, then return (chunks, missed):
+        the queued bytes (JSON lines) and the number of records dropped
+        before them. Returns ([], 0) on a timeout or once closed.
+        """
+        with self.cond:
+            if not self.queue and not self.missed and not self.closed:
+                self.cond.wait(timeout)
+            chunks = [data for data, _ in self.queue]
+            self.delivered += sum(count for _, count in self.queue)
+            self.queue.clear()
+            missed, self.missed = self.missed, 0
+        return chunks, missed
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "sensors": sorted(self.sensors) if self.sensors else None,
+                "policy": self.policy,
+                "queued": len(self.queue),
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+            }
+
+
+class LiveFeed:
+    """
+    Parameters:
+    backlog (int): published batches waiting for the fan-out thread.
+    """
+
+    def __init__(self, backlog=PUBLISH_QUEUE):
+        self._pending = queue.Queue(backlog)
+        self._lock = threading.Lock()
+        # Replaced, never changed in place, so the fan-out thread reads it without the lock
+        self._subscribers = ()
+        self.published = 0
+        self.overflow = 0
+        threading.Thread(target=self._fan_out, name="feed", daemon=True).start()
+
+    def publish(self, records):
+        """Queue one batch of Reading/Summary records for the subscribers."""
+        if not self._subscribers or not records:
+            return
+        try:
+            self._pending.put_nowait(records)
+        except queue.Full:
+            self.overflow += len(records)
+            metrics.inc("feed.overflow", len(records))
+
+    def _fan_out(self):
+        while True:
+            records = self._pending.get()
+            subscribers = self._subscribers
+            if not subscribers:
+                continue
+            try:
+                batch = _Batch(records)
+                for subscriber in subscribers:
+                    subscriber.offer(batch)
+            except Exception:
+                log.exception("Publishing a batch to the live feed failed")
+                continue
+            self.published += 1
+            metrics.inc("feed.batches")
+
+    def subscribe(self, sensors=(), policy="drop", queue_size=QUEUE_BATCHES):
+        """Add a Subscriber (see its parameters) and return it."""
+        subscriber = Subscriber(sensors, policy, queue_size)
+        with self._lock:
+            self._subscribers = self._subscribers + (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscriber)
+
+    def stats(self):
+        subscribers = self._subscribers
+        return {
+            "subscribers": len(subscribers),
+            "published": self.published,
+            "pending": self._pending.qsize(),
+            "overflow": self.overflow,
+            "dropped": sum(s.dropped for s in subscribers),
+            "per_subscriber": [s.stats() for s in subscribers],
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # A subscriber that stops reading for this long is disconnected
+    timeout = STALL_TIMEOUT
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != "/feed":
+            self._error(404, f"Unknown path: {url.path}")
+            return
+        params = parse_qs(url.query)
+        try:
+            policy = params.get("policy", ["drop"])[0]
+            queue_size = int(params.get("queue", [QUEUE_BATCHES])[0])
+            subscriber = self.server.feed.subscribe(params.get("sensor", ()), policy, queue_size)
+        except ValueError as e:
+            self._error(400, str(e))
+            return
+        log.info(f"Feed subscriber {self.address_string()} connected")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            while not subscriber.closed:
+                chunks, missed = subscriber.take(KEEPALIVE)
+                if missed:
+                    self.wfile.write(b'{"dropped":%d}\n' % missed)
+                for data in chunks:
+                    self.wfile.write(data)
+                if not chunks and not missed:
+                    self.wfile.write(b"\n")
+        except OSError:
+            pass
+        finally:
+            self.server.feed.unsubscribe(subscriber)
+            log.info(f"Feed subscriber {self.address_string()} disconnected")
+
+    def _error(self, status, message):
+        data = json.dumps({"error": message}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(f"{self.address_string()} {format % args}")
+
+
+class FeedServer:
+    """
+    Parameters:
+    feed (LiveFeed): what to stream.
+    port (int): TCP port of the feed.
+    host (str): address to bind; localhost only by default.
+    """
+
+    def __init__(self, feed, port=FEED_PORT, host="127.0.0.1"):
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.feed = feed
+        self.address = self._httpd.server_address
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
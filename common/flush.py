@@ -0,0 +1,103 @@
+"""
+When the drone forwards, and what forwarding costs the battery.
+
+FlushPolicy decides when the records waiting on the drone are sent to the
+central server: as soon as any of these is reached, whichever comes first,
+
+max_records   records waiting
+max_bytes     their estimated size on the uplink
+max_age       seconds the oldest of them has been waiting (the latency target)
+
+and immediately when an anomalous reading is among them (urgent_anomalies).
+The latency target is relaxed as the battery runs down: below relax_below
+percent max_age grows linearly until it reaches max_age_low_battery at the
+return-to-base level, so a tired drone makes fewer, larger transmissions.
+
+EnergyModel puts a price on every transmission: a fixed cost for waking the
+radio and waiting for the ack plus a cost per kilobyte, both in percent of
+the battery. Flushing more often lowers the latency and spends more energy;
+benchmarks/bench_flush.py shows the trade-off for a few settings.
+"""
+from common.config import load_json_config
+
+
+DEFAULT_CONFIG = {
+    "max_records": 5000,
+    "max_bytes": 256 * 1024,
+    # latency target in seconds, and how far it stretches on a low battery
+    "max_age": 5.0,
+    "max_age_low_battery": 30.0,
+    "relax_below": 50.0,
+    "urgent_anomalies": True,
+    # battery percent per transmission and per kilobyte sent
+    "energy": {"per_transmission": 0.05, "per_kilobyte": 0.002},
+}
+
+
+def load_config(path=None):
+    """Return DEFAULT_CONFIG overridden by the JSON file at path, if it exists."""
+    return load_json_config(DEFAULT_CONFIG, path)
+
+
+class EnergyModel:
+    """
+    Parameters:
+    per_transmission (float): battery percent used by one uplink batch, whatever its size.
+    per_kilobyte (float): battery percent used per kilobyte sent.
+    """
+
+    def __init__(self, per_transmission=0.05, per_kilobyte=0.002):
+        self.per_transmission = per_transmission
+        self.per_kilobyte = per_kilobyte
+
+    def transmission(self, nbytes):
+        """Battery percent one transmission of nbytes costs."""
+        return self.per_transmission + self.per_kilobyte * nbytes / 1024
+
+
+class FlushPolicy:
+    """
+    Parameters:
+    config (dict): see DEFAULT_CONFIG and load_config().
+    low_battery (float): battery percent at which the drone returns to base.
+    """
+
+    def __init__(self, config=None, low_battery=20.0):
+        self.config = config or load_config()
+        self.max_records = int(self.config["max_records"])
+        self.max_bytes = int(self.config["max_bytes"])
+        self.max_age = float(self.config["max_age"])
+        self.max_age_low_battery = max(self.max_age, float(self.config["max_age_low_battery"]))
+        self.relax_below = float(self.config["relax_below"])
+        self.urgent_anomalies = bool(self.config["urgent_anomalies"])
+        self.low_battery = low_battery
+        self.energy = EnergyModel(**self.config["energy"])
+
+    def age_limit(self, battery):
+        """The latency target (seconds) at a battery level (percent)."""
+        if battery >= self.relax_below or self.relax_below <= self.low_battery:
+            return self.max_age
+        share = min(1.0, (self.relax_below - battery) / (self.relax_below - self.low_battery))
+        return self.max_age + share * (self.max_age_low_battery - self.max_age)
+
+    def reason(self, records, nbytes, age, battery, anomalies=False):
+        """
+        Why the waiting records should be sent now ("anomaly", "records",
+        "bytes" or "age"), or None if they can wait. age is how long the
+        oldest of them has been waiting, in seconds.
+        """
+        if not records:
+            return None
+        if anomalies and self.urgent_anomalies:
+            return "anomaly"
+        if records >= self.max_records:
+            return "records"
+        if nbytes >= self.max_bytes:
+            return "bytes"
+        if age >= self.age_limit(battery):
+            return "age"
+        return None
+
+    def wait(self, age, battery):
+        """Seconds until records that have waited `age` seconds reach the latency target."""
+        return max(0.0, self.age_limit(battery) - age)
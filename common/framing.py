@@ -0,0 +1,141 @@
+"""
+Stream framer shared by every receiver.
+
+A Framer owns one preallocated bytearray per connection. Sockets read
+straight into its free tail with recv_into(), and frames() pulls out every
+complete frame that is buffered in one pass. Consumed bytes are never shifted
+per frame: the read position just advances, and the unread tail is moved to
+the front only when the free space runs out. The cost of a read is therefore
+linear in the bytes received, no matter how many frames a large batch holds.
+
+Two framings are supported and a connection may switch between them after
+its handshake:
+
+LINE    newline-terminated frames (JSON lines)
+LENGTH  uint32 little-endian payload length followed by the payload
+"""
+import struct
+
+LINE = "line"
+LENGTH = "length"
+
+# Bytes requested from the kernel per recv_into() call
+RECV_SIZE = 65536
+
+# Largest frame a peer may send before the connection is treated as broken
+MAX_FRAME = 4 * 1024 * 1024
+
+_LENGTH = struct.Struct("<I")
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a peer's frame exceeds max_frame bytes."""
+
+
+class Framer:
+    """
+    Parameters:
+    mode (str): LINE or LENGTH.
+    recv_size (int): bytes requested per recv_into() call.
+    max_frame (int): largest accepted frame; buffered data never grows past it.
+    """
+
+    def __init__(self, mode=LINE, recv_size=RECV_SIZE, max_frame=MAX_FRAME):
+        self.mode = mode
+        self.recv_size = recv_size
+        self.max_frame = max_frame
+        self._buf = bytearray(max(2 * recv_size, 4096))
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    @property
+    def pending(self):
+        """Number of buffered bytes not yet returned as frames."""
+        return self._end - self._start
+
+    def _reserve(self, size):
+        # Make room for `size` more bytes after the unread data
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size <= len(self._buf):
+            # Enough room once the unread tail is moved to the front
+            self._buf[:pending] = self._view[self._start:self._end]
+        else:
+            grown = bytearray(max(2 * len(self._buf), pending + size))
+            grown[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buf = grown
+            self._view = memoryview(grown)
+        self._start = 0
+        self._end = pending
+
+    def recv_from(self, sock):
+        """
+        Read once from sock into the buffer.
+
+        Returns the number of bytes read; 0 means the peer closed the
+        connection. BlockingIOError from non-blocking sockets propagates.
+        """
+        self._reserve(self.recv_size)
+        n = sock.recv_into(self._view[self._end:self._end + self.recv_size])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        """Append bytes that were received some other way."""
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def peek(self):
+        """Copy of the unread bytes, e.g. to inspect a handshake."""
+        return self._view[self._start:self._end].tobytes()
+
+    def consume(self, n):
+        """Drop n unread bytes from the front of the buffer."""
+        self._start = min(self._start + n, self._end)
+
+    def frames(self):
+        """Return every complete frame currently buffered, oldest first."""
+        if self.mode == LINE:
+            frames = self._line_frames()
+        else:
+            frames = self._length_frames()
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end - self._start > self.max_frame + _LENGTH.size:
+            raise FrameTooLarge(f"Incomplete frame exceeds {self.max_frame} bytes")
+        return frames
+
+    def _line_frames(self):
+        buf = self._buf
+        view = self._view
+        frames = []
+        pos = self._start
+        end = self._end
+        i = buf.find(b"\n", pos, end)
+        while i != -1:
+            frames.append(view[pos:i].tobytes())
+            pos = i + 1
+            i = buf.find(b"\n", pos, end)
+        self._start = pos
+        return frames
+
+    def _length_frames(self):
+        view = self._view
+        frames = []
+        pos = self._start
+        end = self._end
+        while end - pos >= _LENGTH.size:
+            (size,) = _LENGTH.unpack_from(view, pos)
+            if size > self.max_frame:
+                raise FrameTooLarge(f"Frame of {size} bytes exceeds {self.max_frame} bytes")
+            start = pos + _LENGTH.size
+            if end - start < size:
+                break
+            frames.append(view[start:start + size].tobytes())
+            pos = start + size
+        self._start = pos
+        return frames
@@ -0,0 +1,245 @@
+import selectors
+import socket
+import threading
+import json
+import logging
+import itertools
+import collections
+
+from common.framing import Framer, LENGTH, RECV_SIZE, MAX_FRAME
+from common.protocol import BinaryDecoder, accept_hello, hello_reply, reading_from_dict
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class _Connection:
+    """State kept for one accepted sensor socket."""
+
+    __slots__ = ("sock", "addr", "framer", "decoder", "negotiated")
+
+    def __init__(self, sock, addr, recv_size, max_frame):
+        self.sock = sock
+        self.addr = addr
+        self.framer = Framer(recv_size=recv_size, max_frame=max_frame)
+        # Set once the first bytes told us whether this is a binary or JSON client
+        self.negotiated = False
+        self.decoder = None
+
+
+class _Worker:
+    """
+    One event loop owning a selector and every connection assigned to it.
+
+    New sockets are handed over through a queue and a self-pipe wakeup, so the
+    acceptor never touches another loop's selector directly.
+    """
+
+    def __init__(self, server, index):
+        self.server = server
+        self.index = index
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        self._pending = collections.deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self._drain_wakeups)
+
+    # Called from the acceptor thread
+    def add(self, sock, addr):
+        self._pending.append((sock, addr))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # a wakeup is already pending or the loop is shutting down
+
+    def _drain_wakeups(self, _sock):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._pending:
+            sock, addr = self._pending.popleft()
+            self._register(sock, addr)
+
+    def _register(self, sock, addr):
+        sock.setblocking(False)
+        conn = _Connection(sock, addr, self.server.recv_size, self.server.max_frame)
+        self.connections[sock.fileno()] = conn
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        self.server._connected(addr)
+
+    def _close(self, conn, reason):
+        self.connections.pop(conn.sock.fileno(), None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        self.server._disconnected(conn.addr, reason)
+
+    def _read(self, conn):
+        framer = conn.framer
+        try:
+            n = framer.recv_from(conn.sock)
+            if not n:
+                self._close(conn, "Sensor disconnected cleanly.")
+                return
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._close(conn, e)
+            return
+        metrics.inc("ingest.recv_bytes", n)
+        try:
+            if not conn.negotiated:
+                version, consumed = accept_hello(framer.peek(), self.server.binary)
+                if version is None:
+                    return  # wait for the rest of the handshake
+                if consumed:
+                    conn.sock.send(hello_reply(version))
+                    framer.consume(consumed)
+                if version:
+                    conn.decoder = BinaryDecoder()
+                    framer.mode = LENGTH
+                conn.negotiated = True
+            on_message = self.server.on_message
+            frames = framer.frames()
+            reading = None
+            if conn.decoder is not None:
+                for payload in frames:
+                    for reading in conn.decoder.decode(payload)[2]:
+                        on_message(reading, conn.addr)
+            else:
+                for line in frames:
+                    if line.strip():
+                        reading = reading_from_dict(json.loads(line))
+                        on_message(reading, conn.addr)
+        except Exception as e:
+            metrics.inc("ingest.decode_errors")
+            self._close(conn, e)
+            return
+        metrics.inc("ingest.frames", len(frames))
+        if reading is not None:
+            # One age sample per read keeps the cost per reading flat
+            metrics.observe_age("age.drone_received", reading)
+
+    def run(self):
+        while not self.server.stopped:
+            for key, _mask in self.selector.select(timeout=1.0):
+                target = key.data
+                if isinstance(target, _Connection):
+                    self._read(target)
+                else:
+                    target(key.fileobj)
+        for conn in list(self.connections.values()):
+            self._close(conn, "Drone shutting down.")
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+class IngestServer:
+    """
+    Accepts sensor connections and decodes readings from all of them on a
+    small, fixed number of event loops instead of one thread per socket.
+    Each connection negotiates binary frames or newline-delimited JSON (see
+    common.protocol); either way readings arrive as Reading tuples.
+
+    Parameters:
+    port (int): TCP port to listen on (0 picks a free port, see `address`).
+    on_message (callable): called as on_message(reading, addr) for every decoded reading.
+    on_connect (callable): optional, called as on_connect(addr).
+    on_disconnect (callable): optional, called as on_disconnect(addr, reason).
+    workers (int): number of event loops the connections are sharded across.
+    binary (bool): accept the binary handshake; False keeps every client on JSON lines.
+    recv_size (int): bytes read per readable event (see common.framing).
+    max_frame (int): largest frame a sensor may send before it is disconnected.
+    """
+
+    def __init__(self, port, on_message, on_connect=None, on_disconnect=None, workers=1, host="",
+                 binary=True, recv_size=RECV_SIZE, max_frame=MAX_FRAME):
+        self.on_message = on_message
+        self.binary = binary
+        self.recv_size = recv_size
+        self.max_frame = max_frame
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.stopped = False
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.address = self.listener.getsockname()
+
+        self.workers = [_Worker(self, i) for i in range(max(1, workers))]
+        self._next_worker = itertools.cycle(self.workers)
+        self._lock = threading.Lock()
+        self._connections = 0
+
+    @property
+    def connection_count(self):
+        return self._connections
+
+    def _connected(self, addr):
+        metrics.inc("ingest.connects")
+        with self._lock:
+            self._connections += 1
+        if self.on_connect:
+            self.on_connect(addr)
+
+    def _disconnected(self, addr, reason):
+        with self._lock:
+            self._connections -= 1
+        if self.on_disconnect:
+            self.on_disconnect(addr, reason)
+
+    def _accept(self, listener):
+        # Accept every pending connection; the listener is non-blocking
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if not self.stopped:
+                    log.error(f"Accept failed: {e}")
+                return
+            if len(self.workers) == 1:
+                self.workers[0]._register(sock, addr)
+            else:
+                next(self._next_worker).add(sock, addr)
+
+    def serve_forever(self):
+        """Run the loops; blocks the calling thread until stop() is called."""
+        self.listener.setblocking(False)
+        if len(self.workers) == 1:
+            # Single loop: the listener shares the selector with the sensors
+            self.workers[0].selector.register(self.listener, selectors.EVENT_READ, self._accept)
+            self.workers[0].run()
+        else:
+            for worker in self.workers:
+                threading.Thread(target=worker.run, name=f"ingest-{worker.index}", daemon=True).start()
+            with selectors.DefaultSelector() as sel:
+                sel.register(self.listener, selectors.EVENT_READ)
+                while not self.stopped:
+                    if sel.select(timeout=1.0):
+                        self._accept(self.listener)
+        self.listener.close()
+
+    def start(self):
+        """Run serve_forever() in a daemon thread and return immediately."""
+        thread = threading.Thread(target=self.serve_forever, name="ingest", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped = True
+        for worker in self.workers:
+            worker.wakeup()
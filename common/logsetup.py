@@ -0,0 +1,242 @@
+"""
+Logging pipeline shared by the sensor, drone and server programs.
+
+setup_logging() replaces the synchronous file + console handlers with a
+QueueHandler on the root logger. Records are put on an in-memory queue by
+the calling thread and written by one listener thread, so a slow disk or
+terminal never blocks ingest or forwarding. Records are queued unformatted:
+log with %-style arguments (log.info("Sent: %s", reading)) and the message
+is only built on the listener thread, and only if it is written.
+
+Messages are split into two planes by logger name:
+
+control plane   every logger outside "data." (connections, anomalies,
+                battery, errors); never sampled
+data plane      loggers under "data." (data.sent, data.received,
+                data.forwarded, ...), one record per reading
+
+Data plane categories are sampled before they are queued (DataLogger
+samples before a record is even built): "sample" keeps
+one record in N and "rate" caps the records per second (0 = no cap). The
+category is the longest matching prefix in the "sampling" config. The next
+record written in a category says how many were left out before it.
+
+Output goes to logs/<name>.log (text) or logs/<name>.jsonl (one JSON
+object per line) and is rotated by size.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+from common.config import load_json_config
+
+DEFAULT_CONFIG = {
+    "level": "INFO",
+    "directory": "logs",
+    "console": True,
+    # "text" or "jsonl"
+    "format": "text",
+    # rotate the log file at max_bytes, keeping `backups` old files
+    "max_bytes": 10 * 1024 * 1024,
+    "backups": 5,
+    # data plane categories: keep one record in `sample`, at most `rate` per second
+    "sampling": {
+        "data": {"sample": 1, "rate": 50},
+    },
+}
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Prefix of the data plane loggers
+DATA = "data"
+
+
+def load_config(path=None):
+    """Return DEFAULT_CONFIG overridden by the JSON file at path, if it exists."""
+    return load_json_config(DEFAULT_CONFIG, path)
+
+
+class Sampler:
+    """
+    Per-category sampling and rate limiting of data plane records.
+
+    Parameters:
+    sampling (dict): category -> {"sample": N, "rate": per second}, see DEFAULT_CONFIG.
+    """
+
+    def __init__(self, sampling):
+        self.sampling = {name: (max(1, int(s.get("sample", 1))), float(s.get("rate", 0)))
+                         for name, s in sampling.items()}
+        self._lock = threading.Lock()
+        # logger name -> [category settings or None, seen, window start, written in window, suppressed]
+        self._state = {}
+        self.suppressed = 0
+
+    def _category(self, name):
+        parts = name.split(".")
+        if parts[0] != DATA:
+            return None
+        while parts:
+            settings = self.sampling.get(".".join(parts))
+            if settings is not None:
+                return settings
+            parts.pop()
+        return None
+
+    def admit(self, name, now):
+        """
+        Return None if a record of logger `name` is to be left out,
+        otherwise how many were left out since the last one written.
+        """
+        state = self._state.get(name)
+        if state is None:
+            state = self._state[name] = [self._category(name), 0, 0.0, 0, 0]
+        settings = state[0]
+        if settings is None:
+            return 0
+        sample, rate = settings
+        with self._lock:
+            state[1] += 1
+            keep = state[1] % sample == 0
+            if keep and rate:
+                if now - state[2] >= 1.0:
+                    state[2] = now
+                    state[3] = 0
+                keep = state[3] < rate
+                if keep:
+                    state[3] += 1
+            if not keep:
+                state[4] += 1
+                self.suppressed += 1
+                return None
+            suppressed = state[4]
+            state[4] = 0
+        return suppressed
+
+
+class SamplingFilter(logging.Filter):
+    """Apply a Sampler to records logged on plain data plane loggers."""
+
+    def __init__(self, sampler):
+        super().__init__()
+        self.sampler = sampler
+
+    def filter(self, record):
+        if hasattr(record, "suppressed"):
+            return True  # already sampled by a DataLogger
+        suppressed = self.sampler.admit(record.name, record.created)
+        if suppressed is None:
+            return False
+        record.suppressed = suppressed
+        return True
+
+
+# The sampler of the active setup_logging() call
+_sampler = None
+
+
+class DataLogger:
+    """
+    Logger for the per-reading hot path. Records that sampling leaves out
+    cost a counter update: no LogRecord is built and nothing is formatted.
+
+    Parameters:
+    name (str): logger name under "data.", e.g. "data.received".
+    """
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+        self.name = name
+
+    def info(self, msg, *args):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        suppressed = 0
+        if _sampler is not None:
+            suppressed = _sampler.admit(self.name, time.time())
+            if suppressed is None:
+                return
+        self.logger.info(msg, *args, extra={"suppressed": suppressed}, stacklevel=2)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the message in the logging thread; the
+    # queue stays in this process, so the record can go as it is and the
+    # listener formats it
+    def prepare(self, record):
+        return record
+
+
+class _Listener(logging.handlers.QueueListener):
+    # stop() may run twice: explicitly and again at exit
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, "suppressed", 0):
+            text += f" [{record.suppressed} similar suppressed]"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per record."""
+
+    def format(self, record):
+        entry = {"ts": round(record.created, 6), "level": record.levelname, "logger": record.name,
+                 "msg": record.getMessage()}
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+def setup_logging(name, config=None):
+    """
+    Route the root logger through a queue to a rotating file (and the
+    console) for the program `name`; returns the QueueListener, which is
+    also stopped at exit so queued records are not lost.
+
+    Parameters:
+    name (str): log file name without extension, e.g. "drone".
+    config (dict): see DEFAULT_CONFIG and load_config().
+    """
+    config = config or load_config()
+    os.makedirs(config["directory"], exist_ok=True)
+    jsonl = config["format"] == "jsonl"
+    path = os.path.join(config["directory"], f"{name}.{'jsonl' if jsonl else 'log'}")
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=config["max_bytes"],
+                                                        backupCount=config["backups"], encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter() if jsonl else TextFormatter(TEXT_FORMAT))
+    handlers = [file_handler]
+    if config["console"]:
+        console = logging.StreamHandler()
+        console.setFormatter(TextFormatter(TEXT_FORMAT))
+        handlers.append(console)
+
+    global _sampler
+    _sampler = Sampler(config["sampling"])
+    log_queue = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(_sampler))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config["level"])
+
+    listener = _Listener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
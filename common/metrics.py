@@ -0,0 +1,237 @@
+"""
+Lightweight metrics: counters, gauges and HDR-style latency histograms.
+
+Every program has one registry, `metrics`, that the shared modules update
+as data passes through them:
+
+age.*       how old a reading is when it reaches a hop, i.e. now minus the
+            timestamp the sensor stamped it with (age.drone_received,
+            age.drone_scored, age.drone_forwarded, age.central_received).
+            The difference between two hops is the time spent between them.
+            age.drone_received takes one sample per socket read.
+stage.*     how long one step took (stage.detect, stage.uplink_rtt,
+            stage.store_write, stage.sensor_send)
+counters    bytes, frames, decode errors, drops, reconnects, ...
+gauges      queue depths, battery level, ... read when a snapshot is taken
+
+Histograms store microsecond values in log-linear buckets (64 linear
+buckets, then 32 per power of two, so within ~3%), which makes recording
+a few integer operations and a snapshot O(buckets) however many values
+were recorded. Updates are not locked: two threads updating the same
+metric at the same instant may lose a count, which is the price of
+keeping the hot path cheap.
+
+snapshot() returns everything as a dict; MetricsServer serves it as JSON on
+http://127.0.0.1:<port>/metrics and dump_periodically() writes it to a file.
+Setting metrics.enabled = False turns recording into a no-op.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+# Histogram layout: values below _SUB get a bucket each, above that every
+# power of two is split into _HALF buckets
+_BITS = 6
+_SUB = 1 << _BITS
+_HALF = _SUB // 2
+# Largest tracked value: 2**40 us (~12 days); larger values land in the last bucket
+_BUCKETS = (40 - _BITS + 1) * _HALF + _SUB
+
+
+def _bucket_value(index):
+    # Lowest value that falls into a bucket
+    if index < _SUB:
+        return index
+    shift = index // _HALF - 1
+    return (index - shift * _HALF) << shift
+
+
+class Histogram:
+    """Latency histogram of integer microsecond values."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = array("q", bytes(8 * _BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0  # sensor clock ahead of ours
+        if value < _SUB:
+            index = value
+        else:
+            shift = value.bit_length() - _BITS
+            index = shift * _HALF + (value >> shift)
+            if index >= _BUCKETS:
+                index = _BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Value at quantile q (0..1), as the midpoint of its bucket."""
+        if not self.count:
+            return None
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        counts = self.counts
+        for index in range(_BUCKETS):
+            seen += counts[index]
+            if seen >= rank:
+                low = _bucket_value(index)
+                high = _bucket_value(index + 1)
+                return min(self.max, (low + high - 1) / 2)
+        return self.max
+
+    def snapshot(self):
+        """Count and percentiles in milliseconds."""
+        if not self.count:
+            return {"count": 0}
+        ms = 1000.0
+        lowest = next(i for i, n in enumerate(self.counts) if n)
+        return {
+            "count": self.count,
+            "min": round(min(self.max, _bucket_value(lowest)) / ms, 3),
+            "mean": round(self.total / self.count / ms, 3),
+            "p50": round(self.percentile(0.5) / ms, 3),
+            "p90": round(self.percentile(0.9) / ms, 3),
+            "p99": round(self.percentile(0.99) / ms, 3),
+            "p999": round(self.percentile(0.999) / ms, 3),
+            "max": round(self.max / ms, 3),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        self.started = time.time()
+        self.counters = {}
+        self.values = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, n=1):
+        if self.enabled:
+            counters = self.counters
+            counters[name] = counters.get(name, 0) + n
+
+    def set(self, name, value):
+        if self.enabled:
+            self.values[name] = value
+
+    def gauge(self, name, read):
+        """Report read() under name in every snapshot."""
+        self.gauges[name] = read
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, value_us):
+        if self.enabled:
+            self.histogram(name).record(int(value_us))
+
+    def observe_age(self, name, record):
+        """Record now - ts_us for one reading (or summary)."""
+        if self.enabled:
+            self.histogram(name).record(int(time.time() * 1000000) - record.ts_us)
+
+    def observe_ages(self, name, records, now_us=None):
+        """Record now - ts_us for every reading (or summary) in records."""
+        if not self.enabled or not records:
+            return
+        if now_us is None:
+            now_us = int(time.time() * 1000000)
+        record = self.histogram(name).record
+        for r in records:
+            record(now_us - r.ts_us)
+
+    def snapshot(self):
+        gauges = dict(self.values)
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            "time": time.time(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "enabled": self.enabled,
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "histograms_ms": {name: h.snapshot() for name, h in list(self.histograms.items())},
+        }
+
+
+# The registry of this process
+metrics = Metrics()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        data = json.dumps(self.server.registry.snapshot(), indent=1).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(f"{self.address_string()} {format % args}")
+
+
+class MetricsServer:
+    """
+    Parameters:
+    registry (Metrics): what to serve.
+    port (int): TCP port of the endpoint.
+    host (str): address to bind; localhost only by default.
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.registry = registry
+        self.address = self._httpd.server_address
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def dump_periodically(registry, path, interval=10.0):
+    """Rewrite path with a snapshot every interval seconds from a daemon thread."""
+    def dump():
+        while True:
+            time.sleep(interval)
+            tmp = path + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(registry.snapshot(), f, indent=1)
+                os.replace(tmp, path)
+            except OSError as e:
+                log.error(f"Could not write metrics to {path}: {e}")
+
+    thread = threading.Thread(target=dump, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
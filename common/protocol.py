@@ -0,0 +1,453 @@
+"""
+Wire formats shared by the sensors, the drone and the central server.
+
+Two encodings are supported on every link:
+
+JSON lines (fallback, always available)
+    One JSON object per line, as produced by sensor.get_sensor_data().
+
+Binary, negotiated at connect time
+    The client opens with HELLO = MAGIC + version byte. A receiver that
+    understands it answers MAGIC + the version it picked (0 means "stay on
+    JSON lines"). Receivers tell the two apart from the first byte: a JSON
+    client always starts with "{", a binary client with 0x00.
+
+    After the handshake every frame is a little-endian uint32 payload length
+    followed by the payload (split out by common.framing.Framer in LENGTH
+    mode), whose first byte is the frame type:
+
+    FRAME_SENSOR    uint16 index + UTF-8 sensor id (1 to MAX_SENSOR_ID_BYTES).
+                    Assigns the index used by later readings on the same
+                    connection.
+    FRAME_READINGS  N x RECORD
+    FRAME_BATCH     uint64 batch id + N x RECORD (drone uplink, acknowledged)
+    FRAME_ACK       uint64 batch id
+    FRAME_SUMMARIES uint64 batch id + N x SUMMARY (drone uplink, acknowledged)
+
+    Version 2 adds sequence-numbered uplink batches and resuming (see
+    common.sequence):
+
+    FRAME_BATCH_SEQ      uint64 batch id + uint64 epoch + N x RECORD + N x uint32 sequence number
+    FRAME_SUMMARIES_SEQ  uint64 batch id + uint64 epoch + N x SUMMARY + N x uint32 sequence number
+    FRAME_RESUME         uint64 epoch: the drone asks which of that epoch's records the server has
+    FRAME_RESUME_STATE   uint64 epoch + per sensor: uint8 id length, uint32 highest number,
+                         uint16 gap count, the UTF-8 id and gap count x (uint32 first, uint32 last)
+
+    RECORD is uint16 sensor index, float32 temperature, float32 humidity,
+    int64 timestamp in microseconds since the Unix epoch and a uint8
+    anomaly bitmask: 19 bytes per reading.
+
+    SUMMARY is uint16 sensor index, int64 window start and end, uint32
+    reading count, float32 min/max/mean/last temperature and humidity and
+    the int64 timestamp of the last reading: 62 bytes per window.
+
+Decoded readings are Reading tuples on both paths, so receivers never build a
+dict per message. Window summaries produced by the drone's edge reduction
+(common.edge) travel as Summary tuples.
+"""
+import socket
+import struct
+from collections import namedtuple
+from datetime import datetime, timezone, timedelta
+
+# A single sensor reading. ts_us is microseconds since the Unix epoch and
+# flags is a bitmask of the FLAG_* anomaly bits below.
+Reading = namedtuple("Reading", "sensor_id temperature humidity ts_us flags", defaults=(0,))
+
+# Statistics of one sensor over the window [start_us, end_us), produced by the
+# drone's edge reduction. ts_us is the timestamp of the last reading.
+Summary = namedtuple("Summary", "sensor_id start_us end_us count "
+                                "temperature_min temperature_max temperature_mean temperature_last "
+                                "humidity_min humidity_max humidity_mean humidity_last ts_us")
+
+# Anomaly bits set by the drone (see common.anomaly)
+FLAG_TEMPERATURE = 0x01       # outside the static limits
+FLAG_HUMIDITY = 0x02
+FLAG_TEMPERATURE_ZSCORE = 0x04  # far from the sensor's rolling mean
+FLAG_HUMIDITY_ZSCORE = 0x08
+FLAG_TEMPERATURE_RATE = 0x10  # changing faster than allowed
+FLAG_HUMIDITY_RATE = 0x20
+
+# Message label for each flag; also used to map JSON anomaly strings back to flags
+_ANOMALY_LABELS = (
+    (FLAG_TEMPERATURE, "Temperature anomaly", "temperature", "°C"),
+    (FLAG_HUMIDITY, "Humidity anomaly", "humidity", "%"),
+    (FLAG_TEMPERATURE_ZSCORE, "Temperature outlier", "temperature", "°C"),
+    (FLAG_HUMIDITY_ZSCORE, "Humidity outlier", "humidity", "%"),
+    (FLAG_TEMPERATURE_RATE, "Temperature rate anomaly", "temperature", "°C"),
+    (FLAG_HUMIDITY_RATE, "Humidity rate anomaly", "humidity", "%"),
+)
+_FLAG_BY_LABEL = {label: flag for flag, label, _field, _unit in _ANOMALY_LABELS}
+
+# Longest sensor id in UTF-8 bytes: its length is a single byte in
+# FRAME_RESUME_STATE and in the drone's spool (common.spool)
+MAX_SENSOR_ID_BYTES = 255
+
+MAGIC = b"\x00SNR"
+VERSION = 2
+HELLO = MAGIC + bytes([VERSION])
+HELLO_SIZE = len(HELLO)
+
+FRAME_SENSOR = 1
+FRAME_READINGS = 2
+FRAME_BATCH = 3
+FRAME_ACK = 4
+FRAME_SUMMARIES = 5
+FRAME_BATCH_SEQ = 6
+FRAME_SUMMARIES_SEQ = 7
+FRAME_RESUME = 8
+FRAME_RESUME_STATE = 9
+
+LENGTH = struct.Struct("<I")
+RECORD = struct.Struct("<HffqB")
+SENSOR_INDEX = struct.Struct("<BH")
+BATCH_ID = struct.Struct("<BQ")
+SUMMARY = struct.Struct("<HqqIffffffffq")
+SEQ_BATCH = struct.Struct("<BQQ")
+RESUME = struct.Struct("<BQ")
+RESUME_STREAM = struct.Struct("<BIH")
+GAP = struct.Struct("<II")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+NAN = float("nan")
+
+
+class ProtocolError(ValueError):
+    """Raised when a peer sends bytes that are not valid for the negotiated format."""
+
+
+# --- TIMESTAMPS ---
+
+def iso_to_us(text):
+    """Parse an ISO-8601 timestamp ("...Z" or with an offset) into epoch microseconds."""
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    dt = datetime.fromisoformat(text)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def us_to_iso(ts_us):
+    """Format epoch microseconds as an ISO-8601 UTC timestamp ending in "Z"."""
+    return (EPOCH + timedelta(microseconds=ts_us)).isoformat()[:-6] + "Z"
+
+
+# --- READINGS ---
+
+def encode_sensor_id(sensor_id):
+    """
+    The UTF-8 bytes of a sensor id. Raises ProtocolError for an empty id or
+    one longer than MAX_SENSOR_ID_BYTES; ids are never truncated, which could
+    split a character and would rename the sensor.
+    """
+    name = sensor_id.encode()
+    if not 0 < len(name) <= MAX_SENSOR_ID_BYTES:
+        raise ProtocolError(f"Sensor id must be 1 to {MAX_SENSOR_ID_BYTES} UTF-8 bytes, got {len(name)}")
+    return name
+
+
+def anomaly_messages(reading):
+    """Human-readable anomaly descriptions for a reading's flags."""
+    messages = []
+    if reading.flags:
+        for flag, label, field, unit in _ANOMALY_LABELS:
+            if reading.flags & flag:
+                messages.append(f"{label}: {getattr(reading, field):g}{unit}")
+    return messages
+
+
+def reading_from_dict(data):
+    """Convert a JSON message into a Reading, parsing the timestamp once."""
+    flags = 0
+    for text in data.get("anomaly", ()):
+        flags |= _FLAG_BY_LABEL.get(text.partition(":")[0], 0)
+    temp = data.get("temperature")
+    hum = data.get("humidity")
+    sensor_id = data["sensor_id"]
+    # At most 4 bytes per character: only long ids need encoding to check
+    if not sensor_id or len(sensor_id) > MAX_SENSOR_ID_BYTES // 4:
+        encode_sensor_id(sensor_id)
+    return Reading(
+        sensor_id,
+        NAN if temp is None else float(temp),
+        NAN if hum is None else float(hum),
+        iso_to_us(data["timestamp"]),
+        flags,
+    )
+
+
+def reading_to_dict(reading):
+    """Convert a Reading back into the JSON message layout."""
+    data = {
+        "sensor_id": reading.sensor_id,
+        # float32 values from the binary path are rounded back to sensor precision
+        "temperature": round(reading.temperature, 4),
+        "humidity": round(reading.humidity, 4),
+        "timestamp": us_to_iso(reading.ts_us),
+    }
+    if reading.flags:
+        data["anomaly"] = anomaly_messages(reading)
+    return data
+
+
+def summary_to_dict(summary):
+    """JSON layout of a Summary: the last reading plus a "summary" object."""
+    stats = {}
+    for field in ("temperature", "humidity"):
+        stats[field] = {k: round(getattr(summary, f"{field}_{k}"), 4) for k in ("min", "max", "mean", "last")}
+    return {
+        "sensor_id": summary.sensor_id,
+        "timestamp": us_to_iso(summary.ts_us),
+        "summary": {
+            "start": us_to_iso(summary.start_us),
+            "end": us_to_iso(summary.end_us),
+            "count": summary.count,
+            **stats,
+        },
+    }
+
+
+def summary_from_dict(data):
+    stats = data["summary"]
+    values = []
+    for field in ("temperature", "humidity"):
+        for k in ("min", "max", "mean", "last"):
+            value = stats[field].get(k)
+            values.append(NAN if value is None else float(value))
+    return Summary(data["sensor_id"], iso_to_us(stats["start"]), iso_to_us(stats["end"]), int(stats["count"]),
+                   *values, iso_to_us(data["timestamp"]))
+
+
+def record_from_dict(data):
+    """Reading or Summary, depending on the JSON message."""
+    return summary_from_dict(data) if "summary" in data else reading_from_dict(data)
+
+
+def record_to_dict(record):
+    return summary_to_dict(record) if type(record) is Summary else reading_to_dict(record)
+
+
+def last_reading(summary):
+    """The last reading of a summarised window (without anomaly flags)."""
+    return Reading(summary.sensor_id, summary.temperature_last, summary.humidity_last, summary.ts_us)
+
+
+# --- HANDSHAKE ---
+
+def accept_hello(buffer, binary=True):
+    """
+    Inspect the first bytes a client sent.
+
+    Returns (version, consumed): version 0 means JSON lines, consumed is the
+    number of handshake bytes to drop from the buffer. Returns (None, 0) when
+    more bytes are needed to decide.
+    """
+    if not buffer:
+        return None, 0
+    if buffer[0] != 0:
+        return 0, 0
+    if len(buffer) < HELLO_SIZE:
+        return None, 0
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ProtocolError("Bad handshake")
+    version = min(buffer[len(MAGIC)], VERSION) if binary else 0
+    return version, HELLO_SIZE
+
+
+def hello_reply(version):
+    return MAGIC + bytes([version])
+
+
+def negotiate(sock, timeout=2.0):
+    """
+    Client side of the handshake on a freshly connected, blocking socket.
+
+    Returns the agreed version (0 = JSON lines). Raises ProtocolError if the
+    peer does not answer, e.g. an older receiver that only knows JSON; the
+    caller should then reconnect and use JSON lines.
+    """
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        sock.sendall(HELLO)
+        reply = b""
+        while len(reply) < HELLO_SIZE:
+            chunk = sock.recv(HELLO_SIZE - len(reply))
+            if not chunk:
+                raise ProtocolError("Peer closed the connection during the handshake")
+            reply += chunk
+    except socket.timeout:
+        raise ProtocolError("Peer did not answer the binary handshake")
+    finally:
+        sock.settimeout(previous)
+    if reply[:len(MAGIC)] != MAGIC:
+        raise ProtocolError("Bad handshake reply")
+    return reply[len(MAGIC)]
+
+
+# --- BINARY FRAMES ---
+
+class BinaryEncoder:
+    """Encodes readings for one connection, defining each sensor id once."""
+
+    def __init__(self):
+        self.index = {}
+
+    def _sensor(self, sensor_id, out):
+        i = self.index.get(sensor_id)
+        if i is None:
+            name = encode_sensor_id(sensor_id)
+            i = self.index[sensor_id] = len(self.index)
+            out.append(LENGTH.pack(SENSOR_INDEX.size + len(name)) + SENSOR_INDEX.pack(FRAME_SENSOR, i) + name)
+        return i
+
+    def _records(self, readings, out):
+        index = self.index
+        pack = RECORD.pack
+        records = []
+        for r in readings:
+            i = index.get(r.sensor_id)
+            if i is None:
+                i = self._sensor(r.sensor_id, out)
+            records.append(pack(i, r.temperature, r.humidity, r.ts_us, r.flags))
+        return b"".join(records)
+
+    def _summaries(self, summaries, out):
+        pack = SUMMARY.pack
+        return b"".join(pack(self._sensor(s.sensor_id, out), *s[1:]) for s in summaries)
+
+    def encode(self, readings):
+        """Encode readings as one FRAME_READINGS frame (plus any sensor definitions)."""
+        out = []
+        body = self._records(readings, out)
+        out.append(LENGTH.pack(1 + len(body)) + bytes([FRAME_READINGS]) + body)
+        return b"".join(out)
+
+    def encode_batch(self, batch_id, records, epoch=None, seqs=None):
+        """
+        Encode records as one acknowledged frame: FRAME_BATCH for Readings,
+        FRAME_SUMMARIES for Summaries. A batch holds only one of the two.
+        With seqs (one sequence number per record) the frame is
+        FRAME_BATCH_SEQ or FRAME_SUMMARIES_SEQ, which need version 2.
+        """
+        out = []
+        summaries = bool(records) and type(records[0]) is Summary
+        body = self._summaries(records, out) if summaries else self._records(records, out)
+        if seqs is None:
+            header = BATCH_ID.pack(FRAME_SUMMARIES if summaries else FRAME_BATCH, batch_id)
+        else:
+            header = SEQ_BATCH.pack(FRAME_SUMMARIES_SEQ if summaries else FRAME_BATCH_SEQ, batch_id, epoch)
+            body += struct.pack(f"<{len(seqs)}I", *seqs)
+        out.append(LENGTH.pack(len(header) + len(body)) + header + body)
+        return b"".join(out)
+
+
+def encode_ack(batch_id):
+    return LENGTH.pack(BATCH_ID.size) + BATCH_ID.pack(FRAME_ACK, batch_id)
+
+
+def encode_resume(epoch):
+    return LENGTH.pack(RESUME.size) + RESUME.pack(FRAME_RESUME, epoch)
+
+
+def encode_resume_state(epoch, state):
+    """FRAME_RESUME_STATE for {sensor id: (highest number, [(first, last), ...] gaps)}."""
+    parts = [RESUME.pack(FRAME_RESUME_STATE, epoch)]
+    for sensor_id, (high, gaps) in state.items():
+        name = encode_sensor_id(sensor_id)
+        parts.append(RESUME_STREAM.pack(len(name), high, len(gaps)) + name)
+        parts.extend(GAP.pack(first, last) for first, last in gaps)
+    body = b"".join(parts)
+    return LENGTH.pack(len(body)) + body
+
+
+def decode_resume_state(payload):
+    """(epoch, {sensor id: (highest number, [(first, last), ...] gaps)}) from a FRAME_RESUME_STATE payload."""
+    _, epoch = RESUME.unpack_from(payload)
+    state = {}
+    pos = RESUME.size
+    try:
+        while pos < len(payload):
+            length, high, count = RESUME_STREAM.unpack_from(payload, pos)
+            pos += RESUME_STREAM.size
+            name = bytes(payload[pos:pos + length]).decode()
+            pos += length
+            state[name] = (high, [GAP.unpack_from(payload, pos + i * GAP.size) for i in range(count)])
+            pos += count * GAP.size
+    except struct.error:
+        raise ProtocolError("Truncated resume state")
+    if pos != len(payload):
+        raise ProtocolError("Truncated resume state")
+    return epoch, state
+
+
+class BinaryDecoder:
+    """Decodes frames from one connection, keeping its sensor index table."""
+
+    def __init__(self):
+        self.names = {}
+        # (epoch, sequence numbers) of the last FRAME_BATCH_SEQ / FRAME_SUMMARIES_SEQ
+        self.sequence = None
+
+    def decode(self, payload):
+        """
+        Decode one frame payload.
+
+        Returns (frame_type, batch_id, records); batch_id is None for frames
+        that do not carry one (the epoch for FRAME_RESUME) and records is
+        empty for control frames. For sequence-numbered batches the epoch
+        and the numbers are left in self.sequence.
+        """
+        if not payload:
+            raise ProtocolError("Empty frame")
+        kind = payload[0]
+        if kind == FRAME_READINGS:
+            return kind, None, self._records(payload, 1)
+        if kind == FRAME_BATCH:
+            return kind, BATCH_ID.unpack_from(payload)[1], self._records(payload, BATCH_ID.size)
+        if kind == FRAME_SUMMARIES:
+            return kind, BATCH_ID.unpack_from(payload)[1], self._summaries(payload, BATCH_ID.size)
+        if kind == FRAME_BATCH_SEQ or kind == FRAME_SUMMARIES_SEQ:
+            _, batch_id, epoch = SEQ_BATCH.unpack_from(payload)
+            size = RECORD.size if kind == FRAME_BATCH_SEQ else SUMMARY.size
+            count, rest = divmod(len(payload) - SEQ_BATCH.size, size + 4)
+            if rest:
+                raise ProtocolError("Truncated sequence-numbered batch")
+            end = SEQ_BATCH.size + count * size
+            self.sequence = epoch, struct.unpack_from(f"<{count}I", payload, end)
+            if kind == FRAME_BATCH_SEQ:
+                return kind, batch_id, self._records(payload, SEQ_BATCH.size, end)
+            return kind, batch_id, self._summaries(payload, SEQ_BATCH.size, end)
+        if kind == FRAME_RESUME:
+            return kind, RESUME.unpack_from(payload)[1], []
+        if kind == FRAME_SENSOR:
+            _, i = SENSOR_INDEX.unpack_from(payload)
+            name = bytes(payload[SENSOR_INDEX.size:])
+            if not 0 < len(name) <= MAX_SENSOR_ID_BYTES:
+                raise ProtocolError(f"Sensor id of {len(name)} bytes")
+            self.names[i] = name.decode()
+            return kind, None, []
+        if kind == FRAME_ACK:
+            return kind, BATCH_ID.unpack_from(payload)[1], []
+        raise ProtocolError(f"Unknown frame type {kind}")
+
+    def _records(self, payload, offset, end=None):
+        if ((end or len(payload)) - offset) % RECORD.size:
+            raise ProtocolError("Truncated reading record")
+        names = self.names
+        try:
+            return [Reading(names[i], t, h, ts, f)
+                    for i, t, h, ts, f in RECORD.iter_unpack(memoryview(payload)[offset:end])]
+        except KeyError as e:
+            raise ProtocolError(f"Reading for undefined sensor index {e}")
+
+    def _summaries(self, payload, offset, end=None):
+        if ((end or len(payload)) - offset) % SUMMARY.size:
+            raise ProtocolError("Truncated summary record")
+        names = self.names
+        try:
+            return [Summary(names[values[0]], *values[1:])
+                    for values in SUMMARY.iter_unpack(memoryview(payload)[offset:end])]
+        except KeyError as e:
+            raise ProtocolError(f"Summary for undefined sensor index {e}")
@@ -0,0 +1,655 @@
+"""
+Query side of the central server: rollups, a result cache and a local HTTP API.
+
+QueryEngine sits in front of a TimeSeriesStore. write() stores a batch and
+folds it into the structures below (apply() only folds a batch that another
+process already stored):
+
+Rollups      per sensor and resolution (1m, 10m, 1h) a fixed ring of buckets
+             holding count/sum/min/max of temperature and humidity and the
+             number of anomalous readings, updated as readings arrive. A slot
+             is reused when the ring wraps, so each resolution keeps a fixed
+             history (1 day, 1 week, 90 days). All rings together stay within
+             ROLLUP_MEMORY (256 MB, the full history of about 620 sensors):
+             past that the least recently written parts are freed, and
+             aggregate queries read the stored rows for those buckets only.
+latest       the newest reading of every sensor
+ResultCache  LRU of query results. Every entry remembers the sensors and the
+             time range it covers and is dropped when a write touches them.
+
+On start-up the rollups are rebuilt from the store, within the history each
+resolution keeps. Window summaries from the drone's edge reduction (see
+common.edge) are folded into the rollups with their full statistics, but
+the store only keeps the last reading of each window, so a rebuild sees
+one reading per summarised window.
+
+QueryServer answers HTTP GET requests with JSON:
+
+/sensors                                      sensor ids
+/latest[?sensor=ID]                           newest reading (of every sensor without sensor=)
+/range?sensor=ID&start=T&end=T&limit=N        raw readings from the store, oldest first
+                                              (cached only with an explicit end)
+/aggregate?sensor=ID&field=temperature&step=1m&last=6h
+                                              count/mean/min/max per step from the rollups
+/stats                                        store, rollup and cache counters
+
+T is epoch microseconds or an ISO-8601 timestamp, end defaults to now and
+last=6h (s, m, h or d) means start = end - 6h. sensor= may be repeated;
+/aggregate without sensor= covers every sensor.
+"""
+import json
+import math
+import time
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from common.protocol import Reading, Summary, iso_to_us, us_to_iso, reading_to_dict, last_reading
+
+log = logging.getLogger(__name__)
+
+QUERY_PORT = 6100
+CACHE_SIZE = 256
+RANGE_LIMIT = 100000
+
+MINUTE_US = 60 * 1000000
+
+# (name, bucket length in microseconds, buckets kept)
+RESOLUTIONS = (
+    ("1m", MINUTE_US, 24 * 60),
+    ("10m", 10 * MINUTE_US, 7 * 24 * 6),
+    ("1h", 60 * MINUTE_US, 90 * 24),
+)
+
+_UNITS = {"s": 1000000, "m": MINUTE_US, "h": 60 * MINUTE_US, "d": 24 * 60 * MINUTE_US}
+
+# Values kept per bucket: reading count, then n/sum/min/max per field, then anomalies
+_WIDTH = 10
+_FIELDS = {"temperature": 1, "humidity": 5}
+_ANOMALIES = 9
+_EMPTY = array("d", [0, 0, 0, math.inf, -math.inf, 0, 0, math.inf, -math.inf, 0])
+_PAGE = 64
+# Memory of one page of buckets: bucket numbers, values and the objects around them
+PAGE_BYTES = _PAGE * (8 + 8 * _WIDTH) + 256
+
+# Memory the rollups of all sensors may use together (see Rollups)
+ROLLUP_MEMORY = 256 * 1024 * 1024
+
+
+def parse_duration(text):
+    """"90s", "5m", "6h", "1d" -> microseconds."""
+    try:
+        value, unit = float(text[:-1]), _UNITS[text[-1]]
+    except (KeyError, ValueError, IndexError):
+        raise ValueError(f"Invalid duration: {text!r} (use e.g. 90s, 5m, 6h, 1d)") from None
+    if value <= 0:
+        raise ValueError(f"Duration must be positive: {text!r}")
+    return int(value * unit)
+
+
+def parse_time(text):
+    """Epoch microseconds or an ISO-8601 timestamp -> epoch microseconds."""
+    if text.lstrip("-").isdigit():
+        return int(text)
+    try:
+        return iso_to_us(text)
+    except ValueError:
+        raise ValueError(f"Invalid time: {text!r}") from None
+
+
+class _Ring:
+    """
+    Slots are allocated in pages of _PAGE on first use, so a sensor only
+    costs memory for the part of the history it has actually filled.
+    """
+
+    __slots__ = ("resolution", "slots", "pages", "floor")
+
+    def __init__(self, resolution, slots):
+        self.resolution = resolution
+        self.slots = slots
+        # Per page: bucket number held by each slot (-1: empty) and its _WIDTH values
+        self.pages = [None] * -(-slots // _PAGE)
+        # Every bucket from this one on is complete; older ones were
+        # overwritten, dropped or freed (see Rollups)
+        self.floor = -math.inf
+
+
+class Rollups:
+    """
+    Incremental per-sensor aggregates at every resolution in RESOLUTIONS.
+
+    A sensor with its full history at every resolution takes
+    sum(slots) / _PAGE pages of PAGE_BYTES, about 420 KB with the default
+    RESOLUTIONS. The pages of all sensors together never take more than
+    max_bytes: beyond that the least recently written page is freed, which
+    is the oldest part of a ring that has wrapped or the history of a sensor
+    that stopped reporting. The buckets of a freed page are then read from
+    the store (see QueryEngine.aggregate).
+
+    Parameters:
+    resolutions (tuple): (name, bucket length in microseconds, buckets kept) per resolution.
+    max_bytes (int): memory of all pages together; None for no bound.
+    """
+
+    def __init__(self, resolutions=RESOLUTIONS, max_bytes=ROLLUP_MEMORY):
+        self.resolutions = resolutions
+        self.base = min(resolution for _name, resolution, _slots in resolutions)
+        self.max_pages = None if max_bytes is None else max(1, max_bytes // PAGE_BYTES)
+        self._rings = {}
+        # (ring, page number) of every allocated page, least recently written first
+        self._pages = OrderedDict()
+        self.added = 0
+        self.freed = 0
+
+    def sensors(self):
+        return list(self._rings)
+
+    def add(self, readings):
+        # Fold the batch into per-sensor partials at the finest resolution
+        # first, so the rings are updated once per (sensor, bucket) instead
+        # of once per reading
+        base = self.base
+        partials = {}
+        for r in readings:
+            key = (r.sensor_id, r.ts_us // base)
+            p = partials.get(key)
+            if p is None:
+                p = partials[key] = _EMPTY[:]
+            p[0] += 1
+            t = r.temperature
+            if t == t:  # NaN: missing value
+                p[1] += 1
+                p[2] += t
+                if t < p[3]:
+                    p[3] = t
+                if t > p[4]:
+                    p[4] = t
+            h = r.humidity
+            if h == h:
+                p[5] += 1
+                p[6] += h
+                if h < p[7]:
+                    p[7] = h
+                if h > p[8]:
+                    p[8] = h
+            if r.flags:
+                p[_ANOMALIES] += 1
+        self._fold(partials)
+        self.added += len(readings)
+
+    def add_summaries(self, summaries):
+        """Fold window summaries from the drone's edge reduction into the rollups."""
+        base = self.base
+        partials = {}
+        for s in summaries:
+            key = (s.sensor_id, s.start_us // base)
+            p = partials.get(key)
+            if p is None:
+                p = partials[key] = _EMPTY[:]
+            p[0] += s.count
+            for offset, mean, low, high in ((1, s.temperature_mean, s.temperature_min, s.temperature_max),
+                                            (5, s.humidity_mean, s.humidity_min, s.humidity_max)):
+                if mean == mean:
+                    p[offset] += s.count
+                    p[offset + 1] += mean * s.count
+                    p[offset + 2] = min(p[offset + 2], low)
+                    p[offset + 3] = max(p[offset + 3], high)
+        self._fold(partials)
+        self.added += sum(s.count for s in summaries)
+
+    def _fold(self, partials):
+        base = self.base
+        for (sensor_id, bucket), p in partials.items():
+            rings = self._rings.get(sensor_id)
+            if rings is None:
+                rings = self._rings[sensor_id] = [_Ring(resolution, slots)
+                                                  for _name, resolution, slots in self.resolutions]
+            for ring in rings:
+                self._merge(ring, bucket * base // ring.resolution, p)
+
+    def _page(self, ring, slot):
+        number = slot // _PAGE
+        page = ring.pages[number]
+        if page is None:
+            if self.max_pages is not None and len(self._pages) >= self.max_pages:
+                self._free()
+            page = ring.pages[number] = (array("q", [-1]) * _PAGE, _EMPTY * _PAGE)
+            self._pages[(ring, number)] = None
+        else:
+            self._pages.move_to_end((ring, number))
+        return page
+
+    def _free(self):
+        (ring, number), _ = self._pages.popitem(last=False)
+        buckets = ring.pages[number][0]
+        ring.pages[number] = None
+        ring.floor = max(ring.floor, max(buckets) + 1)
+        self.freed += 1
+
+    def _merge(self, ring, bucket, p):
+        if bucket < ring.floor:
+            return  # older than the history this ring keeps
+        slot = bucket % ring.slots
+        buckets, v = self._page(ring, slot)
+        i = slot % _PAGE
+        base = i * _WIDTH
+        have = buckets[i]
+        if have != bucket:
+            if have > bucket:
+                ring.floor = bucket + 1
+                return
+            if have >= 0:
+                ring.floor = max(ring.floor, have + 1)
+            buckets[i] = bucket
+            v[base:base + _WIDTH] = _EMPTY
+        for k in (0, 1, 2, 5, 6, _ANOMALIES):
+            v[base + k] += p[k]
+        for k in (3, 7):
+            if p[k] < v[base + k]:
+                v[base + k] = p[k]
+        for k in (4, 8):
+            if p[k] > v[base + k]:
+                v[base + k] = p[k]
+
+    def pick(self, step_us, start_us, end_us):
+        """The coarsest resolution that divides step_us and keeps the whole range."""
+        for name, resolution, slots in reversed(self.resolutions):
+            if step_us % resolution == 0 and end_us - start_us <= resolution * slots:
+                return name, resolution
+        for name, resolution, slots in self.resolutions:
+            if step_us % resolution == 0:
+                raise ValueError(f"Range is longer than the {name} rollups keep; use a coarser step")
+        raise ValueError(f"step must be a multiple of {self.resolutions[0][0]}")
+
+    def _ring(self, sensor_id, step_us, start_us, end_us):
+        name, resolution = self.pick(step_us, start_us, end_us)
+        rings = self._rings.get(sensor_id)
+        if rings is None:
+            return resolution, None
+        return resolution, rings[[r[0] for r in self.resolutions].index(name)]
+
+    def kept_from(self, sensor_id, step_us, start_us, end_us):
+        """Epoch microseconds from which the rollups aggregate() uses for this query are complete."""
+        resolution, ring = self._ring(sensor_id, step_us, start_us, end_us)
+        if ring is None or ring.floor == -math.inf:
+            return start_us
+        return max(start_us, ring.floor * resolution)
+
+    def aggregate(self, sensor_id, field, step_us, start_us, end_us):
+        """Count/mean/min/max of field per step in [start_us, end_us), empty steps left out."""
+        offset = _FIELDS[field]
+        resolution, ring = self._ring(sensor_id, step_us, start_us, end_us)
+        if ring is None:
+            return []
+        pages, slots = ring.pages, ring.slots
+        out = []
+        current = None
+        for bucket in range(start_us // resolution, (end_us - 1) // resolution + 1):
+            slot = bucket % slots
+            page = pages[slot // _PAGE]
+            if page is None:
+                continue
+            buckets, values = page
+            i = slot % _PAGE
+            if buckets[i] != bucket:
+                continue
+            base = i * _WIDTH
+            step = bucket * resolution // step_us
+            if current is None or current[0] != step:
+                current = [step, 0, 0.0, math.inf, -math.inf, 0]
+                out.append(current)
+            current[1] += values[base + offset]
+            current[2] += values[base + offset + 1]
+            current[3] = min(current[3], values[base + offset + 2])
+            current[4] = max(current[4], values[base + offset + 3])
+            current[5] += values[base + _ANOMALIES]
+        return [{
+            "start": us_to_iso(step * step_us),
+            "count": int(n),
+            "mean": round(total / n, 4),
+            "min": round(low, 4),
+            "max": round(high, 4),
+            "anomalies": int(anomalies),
+        } for step, n, total, low, high, anomalies in out if n]
+
+
+def split_records(records):
+    """
+    (readings, summaries, stored) for a batch from the drone, where stored
+    is what goes into the store: the readings plus the last reading of
+    every summarised window. summaries is None for a batch without any.
+    """
+    if not any(type(r) is Summary for r in records):
+        return records, None, records
+    summaries = [r for r in records if type(r) is Summary]
+    readings = [r for r in records if type(r) is not Summary]
+    return readings, summaries, readings + [last_reading(s) for s in summaries]
+
+
+class ResultCache:
+    """LRU of query results, invalidated by writes to the sensors and time range they cover."""
+
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        # Bumped by every invalidate(); results computed across a bump are not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, sensors, start_us, end_us):
+        """sensors is a set of sensor ids, or None for "every sensor"."""
+        self._entries[key] = (value, sensors, start_us, end_us)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, touched):
+        """touched maps sensor id -> (min ts_us, max ts_us) of the rows just written."""
+        self.generation += 1
+        stale = []
+        for key, (_value, sensors, start_us, end_us) in self._entries.items():
+            for sensor_id in (touched if sensors is None else sensors & touched.keys()):
+                low, high = touched[sensor_id]
+                if high >= start_us and low < end_us:
+                    stale.append(key)
+                    break
+        for key in stale:
+            del self._entries[key]
+        self.invalidated += len(stale)
+
+
+class QueryEngine:
+    """
+    Parameters:
+    store (TimeSeriesStore): where readings are kept.
+    cache_size (int): number of query results kept in the LRU cache.
+    cache_ranges (bool): cache /range results too; off when the store only
+        sees rows some time after they were written (see MergedStore).
+    rollup_memory (int): bytes the rollups of all sensors may take, see Rollups.
+    """
+
+    def __init__(self, store, cache_size=CACHE_SIZE, cache_ranges=True, rollup_memory=ROLLUP_MEMORY):
+        self.store = store
+        self.cache_ranges = cache_ranges
+        self.rollups = Rollups(max_bytes=rollup_memory)
+        self.cache = ResultCache(cache_size)
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._rebuild()
+
+    def _rebuild(self):
+        start = time.perf_counter()
+        history = max(resolution * slots for _name, resolution, slots in self.rollups.resolutions)
+        rows = 0
+        for sensor_id in self.store.sensors():
+            latest = self.store.latest(sensor_id)
+            if latest is None:
+                continue
+            self._latest[sensor_id] = latest
+            for series in self.store.scan(sensor_id, latest.ts_us - history):
+                readings = [Reading(sensor_id, t, h, ts, f) for ts, t, h, f in zip(*series)]
+                self.rollups.add(readings)
+                rows += len(readings)
+        if rows:
+            log.info(f"Rebuilt rollups from {rows} stored readings in {time.perf_counter() - start:.1f} s")
+
+    def write(self, records):
+        """
+        Store a batch and update the rollups, the latest values and the cache.
+
+        Summaries from the drone's edge reduction go into the rollups with
+        their full statistics; the store keeps the last reading of each window.
+        """
+        self._update(records, self.store.write)
+
+    def apply(self, records):
+        """
+        Update the rollups, the latest values and the cache for a batch that
+        was stored elsewhere, e.g. by a worker process (see common.workers).
+        """
+        self._update(records, None)
+
+    def _update(self, records, store):
+        if not records:
+            return
+        readings, summaries, stored = split_records(records)
+        if store is not None:
+            store(stored)
+        # Oldest and newest reading of every sensor in the batch
+        spans = {}
+        for r in stored:
+            span = spans.get(r.sensor_id)
+            if span is None:
+                spans[r.sensor_id] = [r, r]
+            elif r.ts_us >= span[1].ts_us:
+                span[1] = r
+            elif r.ts_us < span[0].ts_us:
+                span[0] = r
+        with self._lock:
+            self.rollups.add(readings)
+            if summaries:
+                self.rollups.add_summaries(summaries)
+            for sensor_id, (_oldest, newest) in spans.items():
+                current = self._latest.get(sensor_id)
+                if current is None or newest.ts_us >= current.ts_us:
+                    self._latest[sensor_id] = newest
+            self.cache.invalidate({s: (oldest.ts_us, newest.ts_us) for s, (oldest, newest) in spans.items()})
+
+    # --- queries ---
+
+    def sensors(self):
+        with self._lock:
+            return sorted(self._latest)
+
+    def latest(self, sensor_ids=None):
+        """{sensor id: newest Reading} for sensor_ids, or for every sensor."""
+        with self._lock:
+            if sensor_ids is None:
+                return dict(self._latest)
+            return {s: self._latest[s] for s in sensor_ids if s in self._latest}
+
+    def range(self, sensor_id, start_us, end_us, limit=RANGE_LIMIT, cache=True):
+        """
+        Raw readings in [start_us, end_us) from the store, oldest first, at
+        most limit. cache=False for a range that will not be asked for
+        again, such as one ending now: it is neither looked up nor cached,
+        so it does not push other results out of the cache.
+        """
+        cache = cache and self.cache_ranges
+        key = ("range", sensor_id, start_us, end_us, limit)
+        if cache:
+            with self._lock:
+                readings = self.cache.get(key)
+                if readings is not None:
+                    return readings
+                generation = self.cache.generation
+        readings = self.store.query(sensor_id, start_us, end_us, limit)
+        if not cache:
+            return readings
+        with self._lock:
+            if self.cache.generation == generation:
+                self.cache.put(key, readings, {sensor_id}, start_us, end_us)
+        return readings
+
+    def aggregate(self, sensor_ids, field, step_us, start_us, end_us):
+        """
+        {sensor id: [bucket, ...]} from the rollups; sensor_ids None means
+        every sensor. The range is widened to whole steps.
+        """
+        if field not in _FIELDS:
+            raise ValueError(f"field must be one of {', '.join(_FIELDS)}")
+        start_us = start_us // step_us * step_us
+        end_us = -(-end_us // step_us) * step_us
+        key = ("aggregate", None if sensor_ids is None else tuple(sorted(sensor_ids)), field, step_us, start_us, end_us)
+        with self._lock:
+            result = self.cache.get(key)
+            if result is not None:
+                return result
+            generation = self.cache.generation
+            names = self.rollups.sensors() if sensor_ids is None else sensor_ids
+            result = {}
+            # Sensor -> end of the steps the rollups no longer keep
+            stored = {}
+            for s in names:
+                kept = self.rollups.kept_from(s, step_us, start_us, end_us)
+                split = min(end_us, -(-kept // step_us) * step_us)
+                result[s] = self.rollups.aggregate(s, field, step_us, split, end_us) if split < end_us else []
+                if split > start_us:
+                    stored[s] = split
+        for s, split in stored.items():
+            result[s] = self._aggregate_stored(s, field, step_us, start_us, split) + result[s]
+        with self._lock:
+            if self.cache.generation == generation:
+                self.cache.put(key, result, None if sensor_ids is None else set(sensor_ids), start_us, end_us)
+        return result
+
+    def _aggregate_stored(self, sensor_id, field, step_us, start_us, end_us):
+        # Rollups freed for memory: aggregate the stored rows, one bucket per step
+        rollups = Rollups((("stored", step_us, (end_us - start_us) // step_us),), max_bytes=None)
+        rollups.add(self.store.query(sensor_id, start_us, end_us))
+        return rollups.aggregate(sensor_id, field, step_us, start_us, end_us)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "store": self.store.stats(),
+                "rollups": {
+                    "sensors": len(self.rollups.sensors()),
+                    "readings": self.rollups.added,
+                    "bytes": len(self.rollups._pages) * PAGE_BYTES,
+                    "pages_freed": self.rollups.freed,
+                },
+                "cache": {
+                    "entries": len(self.cache._entries),
+                    "hits": self.cache.hits,
+                    "misses": self.cache.misses,
+                    "invalidated": self.cache.invalidated,
+                },
+            }
+
+
+# --- HTTP API ---
+
+def _one(params, name, default=None):
+    values = params.get(name)
+    if not values:
+        if default is None:
+            raise ValueError(f"Missing parameter: {name}")
+        return default
+    return values[-1]
+
+
+def _window(params, default_last):
+    end_us = parse_time(params["end"][-1]) if "end" in params else int(time.time() * 1000000)
+    if "start" in params:
+        start_us = parse_time(params["start"][-1])
+    else:
+        start_us = end_us - parse_duration(_one(params, "last", default_last))
+    if start_us >= end_us:
+        raise ValueError("start must be before end")
+    return start_us, end_us
+
+
+def _get_sensors(engine, params):
+    return {"sensors": engine.sensors()}
+
+
+def _get_latest(engine, params):
+    latest = engine.latest(params.get("sensor"))
+    return {"sensors": {s: reading_to_dict(r) for s, r in latest.items()}}
+
+
+def _get_range(engine, params):
+    sensor_id = _one(params, "sensor")
+    start_us, end_us = _window(params, "1h")
+    limit = int(_one(params, "limit", str(RANGE_LIMIT)))
+    # A range ending now is different on every request
+    readings = engine.range(sensor_id, start_us, end_us, limit, cache="end" in params)
+    return {"sensor": sensor_id, "start": us_to_iso(start_us), "end": us_to_iso(end_us),
+            "readings": [reading_to_dict(r) for r in readings]}
+
+
+def _get_aggregate(engine, params):
+    field = _one(params, "field", "temperature")
+    step = _one(params, "step", "1m")
+    start_us, end_us = _window(params, "1h")
+    result = engine.aggregate(params.get("sensor"), field, parse_duration(step), start_us, end_us)
+    return {"field": field, "step": step, "start": us_to_iso(start_us), "end": us_to_iso(end_us),
+            "sensors": result}
+
+
+def _get_stats(engine, params):
+    return engine.stats()
+
+
+_ROUTES = {
+    "/sensors": _get_sensors,
+    "/latest": _get_latest,
+    "/range": _get_range,
+    "/aggregate": _get_aggregate,
+    "/stats": _get_stats,
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = _ROUTES.get(url.path)
+        if route is None:
+            self._reply(404, {"error": f"Unknown path: {url.path}", "paths": sorted(_ROUTES)})
+            return
+        try:
+            body = route(self.server.engine, parse_qs(url.query))
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        self._reply(200, body)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(f"{self.address_string()} {format % args}")
+
+
+class QueryServer:
+    """
+    Parameters:
+    engine (QueryEngine): answers the queries.
+    port (int): TCP port of the HTTP API.
+    host (str): address to bind; localhost only by default.
+    """
+
+    def __init__(self, engine, port=QUERY_PORT, host="127.0.0.1"):
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.engine = engine
+        self.address = self._httpd.server_address
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
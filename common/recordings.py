@@ -0,0 +1,291 @@
+"""
+Streaming readers for recorded sensor traffic, used by sensor/replay.py.
+
+Every reader yields (time_us, Reading) in file order without loading the
+file: time_us is when the reading was sent, which is what a replay is
+paced by.
+
+read_log       sensor and drone logs: the Python repr after "Sent:" or
+               "Received data:" (a dict in old logs, Reading(...) in newer
+               ones), text or JSONL (common.logsetup). Paced by the
+               reading's own timestamp.
+read_pcapng    sensor -> drone TCP flows in a pcapng capture, reassembled
+               per flow and decoded like the drone does (JSON lines or the
+               binary protocol). Paced by the capture timestamp.
+read_source    picks one of the two by file contents.
+merge          interleaves several sources by time.
+"""
+import ast
+import heapq
+import json
+import math
+import re
+import struct
+
+from common.framing import Framer, LENGTH
+from common.protocol import Reading, BinaryDecoder, ProtocolError, accept_hello, reading_from_dict
+
+# Port the drone listens on; flows to it are the sensor traffic in a capture
+DRONE_PORT = 5000
+
+# Log messages that carry one reading
+_LOG_MESSAGE = re.compile(r"(?:Sent|Received data): (.*)$")
+
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+
+# pcapng block types
+_SHB = 0x0A0D0D0A
+_IDB = 1
+_EPB = 6
+
+# Link layer header types: length of the header before the IP packet
+_LINKTYPE_NULL = 0
+_LINKTYPE_ETHERNET = 1
+_LINKTYPE_RAW = 101
+_LINKTYPE_LOOP = 108
+_LINKTYPE_LINUX_SLL = 113
+_LINKTYPE_LINUX_SLL2 = 276
+
+_TCP = 6
+
+
+class ReadErrors:
+    """Counts of lines or packets a reader could not use."""
+
+    def __init__(self):
+        self.skipped = 0
+        self.last = None
+
+    def add(self, error):
+        self.skipped += 1
+        self.last = error
+
+
+def _literal(node):
+    # Reading reprs spell missing values as nan, which literal_eval rejects
+    if isinstance(node, ast.Name) and node.id == "nan":
+        return math.nan
+    return ast.literal_eval(node)
+
+
+def parse_reading(text):
+    """Parse the repr of a sensor message dict or of a Reading."""
+    node = ast.parse(text.strip(), mode="eval").body
+    if isinstance(node, ast.Call) and getattr(node.func, "id", None) == "Reading":
+        fields = dict(zip(Reading._fields, map(_literal, node.args)))
+        fields.update((kw.arg, _literal(kw.value)) for kw in node.keywords)
+        return Reading(**fields)
+    return reading_from_dict(ast.literal_eval(node))
+
+
+def read_log(path, errors=None):
+    """Yield (time_us, Reading) for every reading logged in a text or JSONL log."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if line.startswith("{"):
+                try:
+                    line = json.loads(line).get("msg", "")
+                except ValueError:
+                    continue
+            match = _LOG_MESSAGE.search(line)
+            if not match:
+                continue
+            try:
+                reading = parse_reading(match.group(1))
+            except (ValueError, SyntaxError, KeyError, TypeError) as e:
+                if errors is not None:
+                    errors.add(e)
+                continue
+            yield reading.ts_us, reading
+
+
+def _ip_payload(linktype, data):
+    # Return the IP packet inside a link layer frame, or None
+    if linktype in (_LINKTYPE_NULL, _LINKTYPE_LOOP):
+        return data[4:]
+    if linktype == _LINKTYPE_ETHERNET:
+        offset, ethertype = 14, data[12:14]
+        while ethertype == b"\x81\x00":  # VLAN tag
+            ethertype = data[offset + 2:offset + 4]
+            offset += 4
+        return data[offset:] if ethertype in (b"\x08\x00", b"\x86\xdd") else None
+    if linktype == _LINKTYPE_RAW:
+        return data
+    if linktype == _LINKTYPE_LINUX_SLL:
+        return data[16:]
+    if linktype == _LINKTYPE_LINUX_SLL2:
+        return data[20:]
+    return None
+
+
+def _tcp_segment(packet):
+    # Return (src, sport, dst, dport, seq, payload) of a TCP packet, or None
+    if len(packet) < 20:
+        return None
+    version = packet[0] >> 4
+    if version == 4:
+        header = (packet[0] & 0x0F) * 4
+        if packet[9] != _TCP:
+            return None
+        total = struct.unpack_from("!H", packet, 2)[0]
+        src, dst = packet[12:16], packet[16:20]
+        segment = packet[header:total]
+    elif version == 6:
+        if len(packet) < 40 or packet[6] != _TCP:
+            return None
+        total = 40 + struct.unpack_from("!H", packet, 4)[0]
+        src, dst = packet[8:24], packet[24:40]
+        segment = packet[40:total]
+    else:
+        return None
+    if len(segment) < 20:
+        return None
+    sport, dport, seq = struct.unpack_from("!HHI", segment)
+    offset = (segment[12] >> 4) * 4
+    return src, sport, dst, dport, seq, segment[offset:]
+
+
+def _blocks(f):
+    # Yield (block type, body) from a pcapng file; handles either byte order
+    endian = "<"
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        if head[:4] == PCAPNG_MAGIC:
+            # Section header: its byte-order magic says how to read the rest
+            magic = f.read(4)
+            endian = "<" if magic == b"\x4d\x3c\x2b\x1a" else ">"
+            length = struct.unpack(endian + "I", head[4:])[0]
+            body = magic + f.read(length - 16)
+            f.read(4)
+            yield _SHB, endian, body
+            continue
+        block_type, length = struct.unpack(endian + "II", head)
+        if length < 12:
+            return
+        body = f.read(length - 12)
+        f.read(4)
+        yield block_type, endian, body
+
+
+def _tsresol(options, endian):
+    # Timestamp units per second from an interface's options (default microseconds)
+    pos = 0
+    while pos + 4 <= len(options):
+        code, size = struct.unpack_from(endian + "HH", options, pos)
+        if code == 0:
+            break
+        if code == 9 and size >= 1:
+            value = options[pos + 4]
+            return 2 ** (value & 0x7F) if value & 0x80 else 10 ** value
+        pos += 4 + (size + 3) // 4 * 4
+    return 1000000
+
+
+class _Flow:
+    __slots__ = ("framer", "decoder", "negotiated", "next_seq")
+
+    def __init__(self):
+        self.framer = Framer()
+        self.decoder = None
+        self.negotiated = False
+        self.next_seq = None
+
+    def feed(self, seq, payload):
+        # Append a segment in sequence order; retransmitted bytes are skipped
+        if self.next_seq is not None:
+            overlap = (self.next_seq - seq) & 0xFFFFFFFF
+            if overlap and overlap < 0x80000000:
+                if overlap >= len(payload):
+                    return []
+                payload = payload[overlap:]
+                seq = self.next_seq
+        self.next_seq = (seq + len(payload)) & 0xFFFFFFFF
+        self.framer.feed(payload)
+        return self.readings()
+
+    def readings(self):
+        if not self.negotiated:
+            buffered = self.framer.peek()
+            version, consumed = accept_hello(buffered)
+            if version is None:
+                return []
+            self.framer.consume(consumed)
+            if consumed:
+                # After the handshake the client goes on in binary unless the drone declined
+                rest = buffered[consumed:consumed + 1]
+                if not rest:
+                    return []
+                if rest != b"{":
+                    self.decoder = BinaryDecoder()
+                    self.framer.mode = LENGTH
+            self.negotiated = True
+        out = []
+        for frame in self.framer.frames():
+            if self.decoder is not None:
+                out.extend(self.decoder.decode(frame)[2])
+            elif frame.strip():
+                out.append(reading_from_dict(json.loads(frame)))
+        return out
+
+
+def read_pcapng(path, port=DRONE_PORT, errors=None):
+    """
+    Yield (time_us, Reading) for the readings sensors sent to `port` in a
+    pcapng capture. Each TCP flow is reassembled on its own; a reading
+    gets the capture time of the packet that completed it.
+    """
+    interfaces = []
+    flows = {}
+    with open(path, "rb") as f:
+        for block_type, endian, body in _blocks(f):
+            if block_type == _SHB:
+                interfaces = []
+                continue
+            if block_type == _IDB:
+                linktype = struct.unpack_from(endian + "H", body)[0]
+                interfaces.append((linktype, _tsresol(body[8:], endian)))
+                continue
+            if block_type != _EPB:
+                continue
+            interface, ts_high, ts_low, captured = struct.unpack_from(endian + "IIII", body)
+            if interface >= len(interfaces):
+                continue
+            linktype, resolution = interfaces[interface]
+            packet = _ip_payload(linktype, body[20:20 + captured])
+            segment = _tcp_segment(packet) if packet else None
+            if segment is None:
+                continue
+            src, sport, dst, dport, seq, payload = segment
+            if dport != port or not payload:
+                continue
+            ts_us = ((ts_high << 32) | ts_low) * 1000000 // resolution
+            key = (src, sport, dst, dport)
+            flow = flows.get(key)
+            if flow is None:
+                flow = flows[key] = _Flow()
+            try:
+                readings = flow.feed(seq, payload)
+            except (ValueError, KeyError, ProtocolError) as e:
+                # Undecodable stream: drop the flow, a new one starts from scratch
+                del flows[key]
+                if errors is not None:
+                    errors.add(e)
+                continue
+            for reading in readings:
+                yield ts_us, reading
+
+
+def read_source(path, port=DRONE_PORT, errors=None):
+    """read_pcapng() for pcapng files, read_log() for anything else."""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == PCAPNG_MAGIC:
+        return read_pcapng(path, port, errors)
+    return read_log(path, errors)
+
+
+def merge(sources):
+    """Interleave (time_us, Reading) streams by time; each source must be roughly in order."""
+    return heapq.merge(*sources, key=lambda item: item[0])
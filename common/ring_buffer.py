@@ -0,0 +1,126 @@
+"""
+Bounded, thread-safe ring buffer of sensor readings.
+
+Readings are stored column by column in preallocated `array` storage (sensor
+index, temperature, humidity, timestamp, anomaly flags) instead of one Python
+object per reading, so a full buffer costs about 30 bytes per slot.
+
+Consumers take readings out with drain(). The drone holds what it has
+drained but not yet delivered itself: the edge reduction keeps state across
+drains, so delivery is tracked on the reduced records in the drone's outbox
+(common.drone_core), not in this buffer.
+"""
+import threading
+from array import array
+
+from common.protocol import Reading
+
+# What append() does when the buffer is full
+DROP_OLDEST = "drop_oldest"  # overwrite the oldest reading and count it as dropped
+BLOCK = "block"              # wait for room (backpressure); drop the new reading on timeout
+
+
+class ReadingBuffer:
+    """
+    Parameters:
+    capacity (int): maximum number of buffered readings.
+    policy (str): DROP_OLDEST or BLOCK.
+    block_timeout (float): with BLOCK, seconds to wait for room before the
+        new reading is dropped; None waits indefinitely.
+    """
+
+    def __init__(self, capacity, policy=DROP_OLDEST, block_timeout=None):
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self._sensor = array("I", bytes(4 * capacity))
+        self._temperature = array("d", bytes(8 * capacity))
+        self._humidity = array("d", bytes(8 * capacity))
+        self._ts = array("q", bytes(8 * capacity))
+        self._flags = array("B", bytes(capacity))
+
+        # Sensor ids are interned once and stored as indexes
+        self._ids = {}
+        self._names = []
+
+        self._head = 0
+        self._tail = 0
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+
+        # Counters
+        self.appended = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def _intern(self, sensor_id):
+        i = self._ids.get(sensor_id)
+        if i is None:
+            i = self._ids[sensor_id] = len(self._names)
+            self._names.append(sensor_id)
+        return i
+
+    def _make_room(self):
+        # Called with the lock held and the buffer full; returns False to drop the new reading
+        if self.policy == DROP_OLDEST:
+            self._head += 1
+            self.dropped += 1
+            return True
+        self.blocked += 1
+        if self._not_full.wait_for(lambda: self._tail - self._head < self.capacity, self.block_timeout):
+            return True
+        self.dropped += 1
+        return False
+
+    def append(self, reading):
+        """Add one reading. Returns False if it was dropped because the buffer stayed full."""
+        with self._lock:
+            if self._tail - self._head >= self.capacity and not self._make_room():
+                return False
+            slot = self._tail % self.capacity
+            self._sensor[slot] = self._intern(reading.sensor_id)
+            self._temperature[slot] = reading.temperature
+            self._humidity[slot] = reading.humidity
+            self._ts[slot] = reading.ts_us
+            self._flags[slot] = reading.flags
+            self._tail += 1
+            self.appended += 1
+            return True
+
+    def extend(self, readings):
+        for reading in readings:
+            self.append(reading)
+
+    def _copy(self, start, count):
+        names = self._names
+        capacity = self.capacity
+        out = []
+        for pos in range(start, start + count):
+            slot = pos % capacity
+            out.append(Reading(names[self._sensor[slot]], self._temperature[slot], self._humidity[slot],
+                               self._ts[slot], self._flags[slot]))
+        return out
+
+    def drain(self, max_items=None):
+        """Atomically remove and return up to max_items of the oldest readings."""
+        with self._lock:
+            count = len(self) if max_items is None else min(max_items, len(self))
+            readings = self._copy(self._head, count)
+            self._head += count
+            self._not_full.notify_all()
+            return readings
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "capacity": self.capacity,
+            "appended": self.appended,
+            "dropped": self.dropped,
+            "blocked": self.blocked,
+        }
@@ -0,0 +1,319 @@
+"""
+Sequence numbers for the drone -> central server uplink.
+
+Every record the drone forwards gets a per-sensor sequence number (1, 2,
+3, ...) when it enters the outbox or the spool, and keeps it however often
+it is resent. Numbers are counted per drone run: a run is identified by its
+epoch, the time the drone started in epoch microseconds, so a restarted
+drone never reuses a number without having to persist its counters.
+Spooled records keep the epoch they were numbered in (see common.spool).
+
+The central server keeps a SequenceIndex: per epoch and sensor the highest
+number received plus the gaps below it, usually none or a few. A record
+whose number is already in the index is a duplicate (a batch that was
+stored but whose ack got lost, a spool replay after a restart) and is
+dropped before it reaches the store. Checking a batch reserves its new
+numbers until it is stored, so when a drone resends a batch over another
+connection while the first copy is still being stored, the second copy
+waits for the first and is dropped. When a drone reconnects it asks for
+the index of its epoch and skips whatever the server already has, so after
+an outage only the missing records go over the uplink again
+(common.uplink).
+
+The index is saved to a JSON file next to the store. persist_periodically()
+flushes the store before writing a snapshot, so the file never claims rows
+the store could still lose in a crash; after a crash the server may accept
+a few duplicates again, but never drops a record it does not have.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from array import array
+from bisect import bisect_right
+
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Gaps remembered per sensor and epoch; beyond that the two oldest are merged
+# (the records between them may then be accepted twice, never lost)
+MAX_GAPS = 32
+
+# Drone runs the index remembers; records of older runs are accepted unchecked
+MAX_EPOCHS = 256
+
+# Seconds between two saves of the index
+SAVE_INTERVAL = 5.0
+
+# Seconds a batch waits for another delivery of the same numbers to be
+# stored; after that they are accepted again (twice rather than never)
+RESERVE_TIMEOUT = 10.0
+
+
+def new_epoch():
+    """Epoch of a new drone run: the current time in epoch microseconds."""
+    return time.time_ns() // 1000
+
+
+class SequenceRange:
+    """
+    The numbers received for one sensor in one epoch: everything up to
+    `high` except the inclusive [start, end] ranges in `gaps`.
+    """
+
+    __slots__ = ("high", "gaps")
+
+    def __init__(self, high=0, gaps=None):
+        self.high = high
+        self.gaps = gaps if gaps is not None else []
+
+    def __contains__(self, seq):
+        if seq > self.high:
+            return False
+        gaps = self.gaps
+        if not gaps:
+            return True
+        i = bisect_right(gaps, [seq, float("inf")]) - 1
+        return i < 0 or gaps[i][1] < seq
+
+    def add(self, seq):
+        """Mark seq as received; returns False if it already was."""
+        high = self.high
+        if seq == high + 1:
+            self.high = seq
+            return True
+        if seq > high:
+            self.gaps.append([high + 1, seq - 1])
+            self.high = seq
+            if len(self.gaps) > MAX_GAPS:
+                first, second = self.gaps[0], self.gaps.pop(1)
+                first[1] = second[1]
+            return True
+        gaps = self.gaps
+        i = bisect_right(gaps, [seq, float("inf")]) - 1
+        if i < 0 or gaps[i][1] < seq:
+            return False
+        start, end = gaps[i]
+        if start == end:
+            del gaps[i]
+        elif seq == start:
+            gaps[i][0] = seq + 1
+        elif seq == end:
+            gaps[i][1] = seq - 1
+        else:
+            gaps[i][1] = seq - 1
+            gaps.insert(i + 1, [seq + 1, end])
+        return True
+
+
+class Sequencer:
+    """Numbers the records of one drone run, per sensor, starting at 1."""
+
+    def __init__(self, epoch=None):
+        self.epoch = epoch or new_epoch()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def number(self, records):
+        """Sequence numbers for records, in order, as an array of uint32."""
+        seqs = array("I")
+        counters = self.counters
+        with self.lock:
+            for r in records:
+                seq = counters.get(r.sensor_id, 0) + 1
+                counters[r.sensor_id] = seq
+                seqs.append(seq)
+        return seqs
+
+
+class SequenceIndex:
+    """
+    Server-side index of the sequence numbers received, per epoch and sensor.
+
+    Parameters:
+    path (str): JSON file the index is loaded from and saved to; None keeps it in memory only.
+    max_epochs (int): drone runs remembered, oldest forgotten first.
+    """
+
+    def __init__(self, path=None, max_epochs=MAX_EPOCHS):
+        self.path = path
+        self.max_epochs = max_epochs
+        self.lock = threading.Lock()
+        # Notified whenever reserved numbers are stored or released
+        self.changed = threading.Condition(self.lock)
+        # epoch -> {sensor id -> SequenceRange}
+        self.epochs = {}
+        # (epoch, sensor id, number) -> owner, for numbers being stored; not saved
+        self.reserved = {}
+        self.duplicates = 0
+        self.dirty = False
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            for epoch, sensors in data["epochs"].items():
+                self.epochs[int(epoch)] = {sensor: SequenceRange(high, gaps)
+                                           for sensor, (high, gaps) in sensors.items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error(f"Ignoring unreadable sequence index {self.path}: {e}")
+            self.epochs = {}
+
+    def filter(self, epoch, records, seqs):
+        """
+        The records (and their numbers) not received yet. Their numbers are
+        reserved: call add() with them once they are stored, or release()
+        if storing them failed.
+        """
+        fresh = self.reserve(epoch, [r.sensor_id for r in records], seqs)
+        if fresh is None:
+            return records, seqs
+        return ([r for r, keep in zip(records, fresh) if keep],
+                array("I", [seq for seq, keep in zip(seqs, fresh) if keep]))
+
+    def reserve(self, epoch, sensor_ids, seqs, owner=None, timeout=RESERVE_TIMEOUT):
+        """
+        filter() by sensor id and number: per number, whether it was not
+        received yet, or None when none was. A number another delivery has
+        reserved waits until that one is stored (a duplicate) or released
+        (fresh), for up to timeout seconds. owner is passed on to
+        release_owner().
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                reserved = self.reserved
+                sensors = self.epochs.get(epoch, {})
+                fresh = []
+                busy = False
+                for sensor_id, seq in zip(sensor_ids, seqs):
+                    received = sensors.get(sensor_id)
+                    fresh.append(received is None or seq not in received)
+                    if fresh[-1] and reserved and (epoch, sensor_id, seq) in reserved:
+                        busy = True
+                if not busy:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.warning(f"Numbers of epoch {epoch} stayed reserved for {timeout:g}s, accepting them again")
+                    break
+                self.changed.wait(remaining)
+            for sensor_id, seq, keep in zip(sensor_ids, seqs, fresh):
+                if keep:
+                    reserved.setdefault((epoch, sensor_id, seq), owner)
+        duplicates = len(fresh) - sum(fresh)
+        if not duplicates:
+            return None
+        self.duplicates += duplicates
+        metrics.inc("uplink.duplicates", duplicates)
+        return fresh
+
+    def release(self, epoch, records, seqs):
+        """Give up the reservation of records filter() returned that could not be stored."""
+        self.release_numbers(epoch, [r.sensor_id for r in records], seqs)
+
+    def release_numbers(self, epoch, sensor_ids, seqs):
+        """release() by sensor id and number."""
+        with self.lock:
+            for sensor_id, seq in zip(sensor_ids, seqs):
+                self.reserved.pop((epoch, sensor_id, seq), None)
+            self.changed.notify_all()
+
+    def release_owner(self, owner):
+        """Give up every reservation of owner (e.g. a worker process that exited)."""
+        with self.lock:
+            self.reserved = {key: held for key, held in self.reserved.items() if held != owner}
+            self.changed.notify_all()
+
+    def add(self, epoch, records, seqs):
+        """Mark the numbers of stored records as received (and no longer reserved)."""
+        self.add_numbers(epoch, [r.sensor_id for r in records], seqs)
+
+    def add_numbers(self, epoch, sensor_ids, seqs):
+        """add() by sensor id and number."""
+        if not sensor_ids:
+            return
+        with self.lock:
+            sensors = self.epochs.get(epoch)
+            if sensors is None:
+                sensors = self.epochs[epoch] = {}
+                while len(self.epochs) > self.max_epochs:
+                    del self.epochs[min(self.epochs)]
+            last_sensor = received = None
+            for sensor_id, seq in zip(sensor_ids, seqs):
+                if sensor_id != last_sensor:
+                    last_sensor = sensor_id
+                    received = sensors.get(last_sensor)
+                    if received is None:
+                        received = sensors[last_sensor] = SequenceRange()
+                received.add(seq)
+            if self.reserved:
+                for sensor_id, seq in zip(sensor_ids, seqs):
+                    self.reserved.pop((epoch, sensor_id, seq), None)
+                self.changed.notify_all()
+            self.dirty = True
+
+    def state(self, epoch):
+        """{sensor id: (high, gaps)} of one epoch, as sent to a resuming drone."""
+        with self.lock:
+            return {sensor: (r.high, [tuple(gap) for gap in r.gaps])
+                    for sensor, r in self.epochs.get(epoch, {}).items()}
+
+    def snapshot(self):
+        """The whole index as JSON-ready data."""
+        with self.lock:
+            self.dirty = False
+            return {"epochs": {str(epoch): {sensor: [r.high, [list(gap) for gap in r.gaps]]
+                                            for sensor, r in sensors.items()}
+                               for epoch, sensors in self.epochs.items()}}
+
+    def save(self, snapshot=None):
+        """Write the index (or a snapshot() taken earlier) with an atomic rename."""
+        if self.path is None:
+            return
+        if snapshot is None:
+            snapshot = self.snapshot()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "epochs": len(self.epochs),
+                "streams": sum(len(sensors) for sensors in self.epochs.values()),
+                "gaps": sum(len(r.gaps) for sensors in self.epochs.values() for r in sensors.values()),
+                "duplicates": self.duplicates,
+            }
+
+
+def persist_periodically(index, store, interval=SAVE_INTERVAL):
+    """
+    Save index every interval seconds from a daemon thread. The snapshot is
+    taken before the store is flushed, so it only covers rows on disk.
+    """
+    def persist():
+        while True:
+            time.sleep(interval)
+            if not index.dirty:
+                continue
+            try:
+                snapshot = index.snapshot()
+                store.flush()
+                index.save(snapshot)
+            except (OSError, ValueError) as e:
+                index.dirty = True
+                log.error(f"Could not save the sequence index to {index.path}: {e}")
+
+    thread = threading.Thread(target=persist, name="sequence-index", daemon=True)
+    thread.start()
+    return thread
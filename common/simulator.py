@@ -0,0 +1,339 @@
+"""
+Sensor simulation: reading profiles, and a field of many sensors hosted by
+one process (sensor/sensor.py --sensors).
+
+Profiles decide what a sensor reports:
+
+normal     temperature 17.5-22.5 C, humidity 45-55 %
+anomaly    100 C and 85 %, which the drone flags as a temperature anomaly
+
+SensorField runs thousands of sensors on one thread. Every sensor has its
+own due time on a timer wheel; the interval is jittered by +-jitter so the
+sensors drift apart like real ones instead of firing in lock step. All
+sensors due on the same tick are generated in one pass (one clock read and
+one timestamp for the whole tick) and grouped by connection: the sensors
+share `connections` connections to the drone, and each connection gets one
+write per tick, a single binary frame or every JSON line of the tick sent
+with one vectored sendmsg() call.
+"""
+import os
+import json
+import math
+import time
+import random
+import socket
+import logging
+from datetime import datetime, timezone, timedelta
+
+from common.protocol import Reading, BinaryEncoder, ProtocolError, negotiate
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Sensors stamp their JSON messages in Turkey time (UTC+3)
+TURKEY_TZ = timezone(timedelta(hours=3))
+
+# Timer wheel resolution in seconds
+TICK = 0.01
+
+# Seconds before a failed connection is tried again
+RETRY_INTERVAL = 5.0
+
+# Buffers per sendmsg() call
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") and "SC_IOV_MAX" in os.sysconf_names else 1024
+
+
+# --- PROFILES ---
+
+def _normal(rnd):
+    # Small variation around 20 C / 50 %
+    return round(20 + 5 * (0.5 - rnd()), 2), round(50 + 10 * (0.5 - rnd()), 2)
+
+
+def _anomaly(rnd):
+    # Anomalous high temperature, humidity still within the normal range
+    return 100.0, 85.0
+
+
+# Profile name -> function(random) returning (temperature, humidity)
+PROFILES = {"normal": _normal, "anomaly": _anomaly}
+
+
+def get_sensor_data(sensor_id, profile="normal"):
+    """One JSON sensor message for the given profile."""
+    temperature, humidity = PROFILES[profile](random.random)
+    return {
+        "sensor_id": sensor_id,
+        "temperature": temperature,
+        "humidity": humidity,
+        "timestamp": datetime.now(TURKEY_TZ).isoformat(),
+    }
+
+
+def parse_sensor_ids(spec):
+    """
+    Sensor ids from a comma-separated list of ids, ranges and files:
+    "sensor1-5000" is sensor1 ... sensor5000, "node001-120" node001 ...
+    node120, "a,b,c" three ids and "@ids.txt" one id per line of that file.
+    """
+    ids = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if item.startswith("@"):
+            with open(item[1:]) as f:
+                ids.extend(line.strip() for line in f if line.strip())
+            continue
+        prefix, sep, last = item.rpartition("-")
+        digits = len(prefix) - len(prefix.rstrip("0123456789"))
+        if sep and digits and last.isdigit():
+            first = prefix[len(prefix) - digits:]
+            prefix = prefix[:len(prefix) - digits]
+            # Zero-padded ranges (node001-120) keep their width
+            width = len(first) if first.startswith("0") else 0
+            ids.extend(f"{prefix}{n:0{width}d}" for n in range(int(first), int(last) + 1))
+        else:
+            ids.append(item)
+    return ids
+
+
+# --- SCHEDULING ---
+
+class TimerWheel:
+    """
+    Single-level timer wheel. An item is put in the slot of the tick it is
+    due on and advance() returns every item whose tick has passed, so
+    scheduling and expiry cost O(1) per item however many are waiting.
+    Items must be due within `horizon` seconds.
+    """
+
+    def __init__(self, tick, horizon, now):
+        self.tick = tick
+        self.slots = [[] for _ in range(int(math.ceil(horizon / tick)) + 2)]
+        self.current = int(now / tick)
+
+    def schedule(self, item, due):
+        """Run item at monotonic time due (on the next tick if that has passed)."""
+        t = max(int(due / self.tick), self.current + 1)
+        if t - self.current >= len(self.slots):
+            raise ValueError("Item is due beyond the wheel's horizon")
+        self.slots[t % len(self.slots)].append(item)
+
+    def advance(self, now):
+        """Items due up to now, oldest tick first."""
+        target = int(now / self.tick)
+        slots = self.slots
+        due = []
+        # After a long stall every slot is due once
+        for t in range(self.current + 1, min(target, self.current + len(slots)) + 1):
+            slot = slots[t % len(slots)]
+            if slot:
+                due.extend(slot)
+                slot.clear()
+        self.current = max(self.current, target)
+        return due
+
+    def next_tick(self):
+        """Monotonic time at which the next tick starts."""
+        return (self.current + 1) * self.tick
+
+
+# --- NETWORK ---
+
+def send_buffers(sock, buffers):
+    """Write every buffer, with vectored sendmsg() calls where the platform has them."""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(b) for b in buffers]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+class _Link:
+    """One connection to the drone shared by a group of sensors."""
+
+    def __init__(self, field):
+        self.field = field
+        self.sock = None
+        self.encoder = None
+        self.binary = field.protocol != "json"
+        self.retry_at = 0.0
+
+    def connect(self, now):
+        field = self.field
+        if self.sock is not None:
+            return True
+        if now < self.retry_at:
+            return False
+        try:
+            sock = socket.create_connection((field.host, field.port), timeout=RETRY_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0 if field.nagle else 1)
+            encoder = None
+            if self.binary:
+                try:
+                    if negotiate(sock):
+                        encoder = BinaryEncoder()
+                except ProtocolError as e:
+                    sock.close()
+                    if field.protocol == "binary":
+                        raise
+                    log.warning(f"{e}, switching to JSON")
+                    self.binary = False
+                    return self.connect(now)
+            sock.settimeout(None)
+        except (OSError, ProtocolError) as e:
+            metrics.inc("sensor.connection_errors")
+            log.error(f"Connection failed: {e}, retrying in {RETRY_INTERVAL:g} seconds...")
+            self.retry_at = now + RETRY_INTERVAL
+            return False
+        self.sock, self.encoder = sock, encoder
+        metrics.inc("sensor.connects")
+        log.info(f"Connected to Drone at {field.host}:{field.port} ({'binary' if encoder else 'JSON'})")
+        return True
+
+    def send(self, buffers):
+        try:
+            send_buffers(self.sock, buffers)
+        except OSError as e:
+            metrics.inc("sensor.connection_errors")
+            log.error(f"Connection failed: {e}, retrying in {RETRY_INTERVAL:g} seconds...")
+            self.sock.close()
+            self.sock = self.encoder = None
+            self.retry_at = time.monotonic() + RETRY_INTERVAL
+            return False
+        return True
+
+
+class SensorField:
+    """
+    Parameters:
+    sensor_ids (list): ids of the simulated sensors.
+    host (str), port (int): drone address.
+    interval (float): seconds between two readings of one sensor.
+    jitter (float): every interval is scaled by a random factor in [1 - jitter, 1 + jitter].
+    connections (int): connections the sensors are spread over (sensor i uses connection i % connections).
+    profile (str): profile of every sensor not listed in `profiles`.
+    profiles (dict): sensor id -> profile name for sensors that use another profile.
+    protocol (str): "auto", "binary" or "json", as for a single sensor.
+    nagle (bool): leave Nagle's algorithm on; by default TCP_NODELAY is set,
+        since every write is already a whole tick's batch.
+    on_sent (callable): optional, called as on_sent(readings) after a batch went out.
+    """
+
+    def __init__(self, sensor_ids, host="127.0.0.1", port=5000, interval=2.0, jitter=0.1, connections=1,
+                 profile="normal", profiles=None, protocol="auto", nagle=False, on_sent=None):
+        if not sensor_ids:
+            raise ValueError("No sensor ids given")
+        self.sensor_ids = list(sensor_ids)
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.jitter = jitter
+        self.protocol = protocol
+        self.nagle = nagle
+        self.on_sent = on_sent
+        self.random = random.Random()
+
+        profiles = profiles or {}
+        for name in set(profiles.values()) | {profile}:
+            if name not in PROFILES:
+                raise ValueError(f"Unknown sensor profile: {name}")
+        # Per sensor: profile function and the JSON-escaped id, both looked up once
+        self.profile = [PROFILES[profiles.get(s, profile)] for s in self.sensor_ids]
+        self.quoted = [json.dumps(s) for s in self.sensor_ids]
+        self.links = [_Link(self) for _ in range(max(1, min(connections, len(self.sensor_ids))))]
+
+        self.due = []
+        self.sent = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+        self.stopped = False
+
+    def _generate(self, indexes, ts_us):
+        rnd = self.random.random
+        ids, profile = self.sensor_ids, self.profile
+        return [Reading(ids[i], *profile[i](rnd), ts_us) for i in indexes]
+
+    def _json_lines(self, indexes, readings, stamp):
+        quoted = self.quoted
+        return [(f'{{"sensor_id": {quoted[i]}, "temperature": {r.temperature}, "humidity": {r.humidity}, '
+                 f'"timestamp": "{stamp}"}}\n').encode()
+                for i, r in zip(indexes, readings)]
+
+    def _emit(self, due, now):
+        # One timestamp for the whole tick
+        ts_us = time.time_ns() // 1000
+        stamp = None
+        links = self.links
+        groups = [[] for _ in links]
+        for i in due:
+            groups[i % len(links)].append(i)
+        for link, indexes in zip(links, groups):
+            if not indexes:
+                continue
+            if not link.connect(now):
+                self.dropped += len(indexes)
+                continue
+            readings = self._generate(indexes, ts_us)
+            if link.encoder is not None:
+                buffers = [link.encoder.encode(readings)]
+            else:
+                if stamp is None:
+                    stamp = datetime.fromtimestamp(ts_us / 1000000, TURKEY_TZ).isoformat()
+                buffers = self._json_lines(indexes, readings, stamp)
+            started = time.perf_counter()
+            if not link.send(buffers):
+                self.dropped += len(indexes)
+                continue
+            metrics.observe("stage.sensor_send", (time.perf_counter() - started) * 1000000)
+            metrics.inc("sensor.sent", len(readings))
+            metrics.inc("sensor.sent_bytes", sum(len(b) for b in buffers))
+            self.sent += len(readings)
+            if self.on_sent is not None:
+                self.on_sent(readings)
+
+    def run(self):
+        """Send readings until stop() is called."""
+        interval, jitter = self.interval, self.jitter
+        uniform = self.random.uniform
+        start = time.monotonic()
+        wheel = TimerWheel(TICK, interval * (1 + jitter), start)
+        # Spread the first readings over one interval
+        self.due = [start + uniform(0, interval) for _ in self.sensor_ids]
+        for i, due in enumerate(self.due):
+            wheel.schedule(i, due)
+        while not self.stopped:
+            now = time.monotonic()
+            due = wheel.advance(now)
+            if due:
+                self._emit(due, now)
+                for i in due:
+                    self.max_lag = max(self.max_lag, now - self.due[i])
+                    self.due[i] = next_due = max(self.due[i] + interval * (1 + uniform(-jitter, jitter)), now)
+                    wheel.schedule(i, next_due)
+            delay = wheel.next_tick() - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        for link in self.links:
+            if link.sock is not None:
+                link.sock.close()
+
+    def stop(self):
+        self.stopped = True
+
+    def stats(self):
+        return {
+            "sensors": len(self.sensor_ids),
+            "connections": sum(link.sock is not None for link in self.links),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+        }
@@ -0,0 +1,269 @@
+"""
+Disk-backed, append-only spool for readings that cannot be forwarded yet.
+
+Readings are appended to numbered segment files in the spool directory.
+Each record is a small struct header (sensor id length, float32 temperature
+and humidity, int64 epoch-micros timestamp, anomaly flags) followed by the
+UTF-8 sensor id. Window summaries from the edge reduction use the same
+header (last temperature and humidity, timestamp of the last reading, flags
+set to _SUMMARY) followed by the sensor id and the rest of the window
+statistics. Once a segment reaches segment_size bytes a new one is started.
+
+A spool opened with an epoch keeps the uplink sequence numbers (see
+common.sequence) with the records: every segment it starts begins with a
+header holding the epoch, and every record header ends with the record's
+uint32 sequence number. Segments written without an epoch, e.g. by an
+older drone, are still replayed (without numbers).
+
+replay() walks the closed segments through read-only memory maps and yields
+large chunks of readings. After a chunk (or part of it) has been delivered,
+commit() persists a checkpoint (segment number and byte offset) with an
+atomic rename and deletes segments that are fully delivered. If the process
+dies mid-flush, the next replay() resumes at the checkpoint.
+"""
+import os
+import json
+import mmap
+import struct
+import threading
+from array import array
+
+from common.protocol import Reading, Summary, encode_sensor_id
+
+SEGMENT_SIZE = 8 * 1024 * 1024
+CHECKPOINT = "checkpoint.json"
+
+_RECORD = struct.Struct("<BffqB")
+# Record header in segments that start with _SEGMENT_HEADER: _RECORD plus the sequence number
+_SEQ_RECORD = struct.Struct("<BffqBI")
+# Magic and epoch at the start of a sequence-numbered segment; an old
+# segment starts with a sensor id length, which is never 0
+_SEGMENT_HEADER = struct.Struct("<4sQ")
+_SEQUENCED = b"\x00SEQ"
+# Flags value marking a Summary; anomaly flags never use the top bit
+_SUMMARY = 0x80
+# start, end, count, then min/max/mean of temperature and humidity
+_SUMMARY_TAIL = struct.Struct("<qqIffffff")
+
+
+class SpoolChunk:
+    """A run of consecutive readings from one segment, as yielded by Spool.replay()."""
+
+    __slots__ = ("segment", "readings", "ends", "last", "epoch", "seqs")
+
+    def __init__(self, segment, readings, ends, last, epoch=None, seqs=None):
+        self.segment = segment
+        self.readings = readings
+        # Byte offset just past each reading, used to checkpoint partial deliveries
+        self.ends = ends
+        # True when the chunk runs to the end of its segment
+        self.last = last
+        # Epoch and sequence number of every reading, None for unnumbered segments
+        self.epoch = epoch
+        self.seqs = seqs
+
+
+class Spool:
+    """
+    Parameters:
+    directory (str): where segment files and the checkpoint are kept.
+    segment_size (int): size in bytes at which a new segment is started.
+    fsync (bool): fsync after every append() instead of only when a segment is closed.
+    epoch (int): uplink epoch of the records appended by this process; with
+        it, append() takes their sequence numbers as well.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, fsync=False, epoch=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.epoch = epoch
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._names = {}
+        self._active = None
+        self._active_segment = None
+        self._checkpoint = self._read_checkpoint()
+
+    # --- files ---
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}.seg")
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".seg"):
+                segments.append(int(name[:-4]))
+        return sorted(segments)
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                data = json.load(f)
+            return data["segment"], data["offset"]
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def _write_checkpoint(self, segment, offset):
+        path = os.path.join(self.directory, CHECKPOINT)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._checkpoint = (segment, offset)
+
+    def _close_active(self):
+        # Called with the lock held
+        if self._active is not None:
+            self._active.flush()
+            os.fsync(self._active.fileno())
+            self._active.close()
+            self._active = None
+
+    # --- writing ---
+
+    def append(self, readings, seqs=None):
+        """
+        Append Readings (and Summaries) to the active segment, starting a new
+        one when it is full. A spool with an epoch needs the sequence number
+        of every reading in seqs. Raises ProtocolError (a ValueError), before
+        anything is written, for a sensor id that does not fit in the one
+        byte length (the ingest path already rejects those).
+        """
+        if not readings:
+            return
+        if (seqs is None) != (self.epoch is None):
+            raise ValueError("Sequence numbers are needed if and only if the spool has an epoch")
+        names = self._names
+        if seqs is None:
+            pack = _RECORD.pack
+            extra = ()
+        else:
+            pack = _SEQ_RECORD.pack
+        parts = []
+        for i, r in enumerate(readings):
+            name = names.get(r.sensor_id)
+            if name is None:
+                name = names[r.sensor_id] = encode_sensor_id(r.sensor_id)
+            if seqs is not None:
+                extra = (seqs[i],)
+            if type(r) is Summary:
+                parts.append(pack(len(name), r.temperature_last, r.humidity_last, r.ts_us, _SUMMARY, *extra))
+                parts.append(name)
+                parts.append(_SUMMARY_TAIL.pack(r.start_us, r.end_us, r.count,
+                                                r.temperature_min, r.temperature_max, r.temperature_mean,
+                                                r.humidity_min, r.humidity_max, r.humidity_mean))
+                continue
+            parts.append(pack(len(name), r.temperature, r.humidity, r.ts_us, r.flags, *extra))
+            parts.append(name)
+        data = b"".join(parts)
+
+        with self._lock:
+            if self._active is None:
+                segments = self._segments()
+                self._active_segment = max(segments[-1] + 1 if segments else 0, self._checkpoint[0])
+                self._active = open(self._path(self._active_segment), "ab")
+                if self.epoch is not None:
+                    self._active.write(_SEGMENT_HEADER.pack(_SEQUENCED, self.epoch))
+            self._active.write(data)
+            self._active.flush()
+            if self.fsync:
+                os.fsync(self._active.fileno())
+            if self._active.tell() >= self.segment_size:
+                self._close_active()
+
+    # --- reading ---
+
+    def pending_bytes(self):
+        """Bytes spooled but not yet committed (0 means nothing to replay)."""
+        segment, offset = self._checkpoint
+        total = 0
+        for s in self._segments():
+            if s >= segment:
+                size = os.path.getsize(self._path(s))
+                total += size - offset if s == segment else size
+        return max(total, 0)
+
+    def replay(self, chunk_size=5000):
+        """
+        Yield SpoolChunks of up to chunk_size readings, oldest first, starting
+        at the last checkpoint. Readings appended while replaying go to a new
+        segment and are picked up by the next replay().
+        """
+        with self._lock:
+            self._close_active()
+        segment, offset = self._checkpoint
+        for s in self._segments():
+            if s < segment:
+                continue
+            start = offset if s == segment else 0
+            yield from self._replay_segment(s, start, chunk_size)
+
+    def _replay_segment(self, segment, offset, chunk_size):
+        with open(self._path(segment), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            epoch = None
+            start = f.read(_SEGMENT_HEADER.size)
+            if len(start) == _SEGMENT_HEADER.size and start.startswith(_SEQUENCED):
+                epoch = _SEGMENT_HEADER.unpack(start)[1]
+                offset = max(offset, _SEGMENT_HEADER.size)
+            if size <= offset:
+                yield SpoolChunk(segment, [], array("Q"), True)
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                record = _RECORD if epoch is None else _SEQ_RECORD
+                unpack = record.unpack_from
+                header = record.size
+                tail = _SUMMARY_TAIL.size
+                names = {}
+                pos = offset
+                while pos < size:
+                    readings = []
+                    ends = array("Q")
+                    seqs = None if epoch is None else array("I")
+                    while len(readings) < chunk_size and pos + header <= size:
+                        length, temp, hum, ts, flags, *seq = unpack(mm, pos)
+                        end = pos + header + length
+                        if flags == _SUMMARY:
+                            end += tail
+                        if end > size:
+                            break
+                        raw = mm[pos + header:pos + header + length]
+                        name = names.get(raw)
+                        if name is None:
+                            # Spools written before ids were checked may hold a split character
+                            name = names[raw] = raw.decode(errors="replace")
+                        if flags == _SUMMARY:
+                            (start, stop, count, t_min, t_max, t_mean,
+                             h_min, h_max, h_mean) = _SUMMARY_TAIL.unpack_from(mm, end - tail)
+                            readings.append(Summary(name, start, stop, count, t_min, t_max, t_mean, temp,
+                                                    h_min, h_max, h_mean, hum, ts))
+                        else:
+                            readings.append(Reading(name, temp, hum, ts, flags))
+                        if seqs is not None:
+                            seqs.append(seq[0])
+                        ends.append(end)
+                        pos = end
+                    # A torn record at the end of a segment (crash mid-write) is skipped
+                    last = pos >= size or pos + header > size or len(readings) < chunk_size
+                    yield SpoolChunk(segment, readings, ends, last, epoch, seqs)
+                    if last:
+                        return
+
+    def commit(self, chunk, count):
+        """Record that the first `count` readings of chunk were delivered."""
+        if count <= 0 and not (chunk.last and not chunk.readings):
+            return
+        with self._lock:
+            if count == len(chunk.readings) and chunk.last:
+                # Segment fully delivered: move on to the next one
+                self._write_checkpoint(chunk.segment + 1, 0)
+            else:
+                self._write_checkpoint(chunk.segment, chunk.ends[count - 1])
+            for s in self._segments():
+                if s < self._checkpoint[0] and s != self._active_segment:
+                    os.remove(self._path(s))
@@ -0,0 +1,364 @@
+"""
+Event-time stream stage of the central server.
+
+Records reach the server out of event-time order: every drone holds them
+back until its flush policy sends them (common.flush), a drone returning to
+base replays its spool much later, and several drones interleave. The stage
+puts them back in order and aggregates them per sensor over time windows.
+Timestamps are the epoch microseconds (ts_us) decoded once by the uplink,
+so records are only ever compared as integers.
+
+Reorderer     merges the records of every source (a drone connection) in a
+              heap and releases them in event-time order once the watermark
+              has passed them. Every source has its own watermark, the
+              newest timestamp it sent minus max_delay; the stage's
+              watermark is the lowest of them, so a drone that flushes less
+              often holds the others back instead of being overtaken.
+              Sources that sent nothing for idle_timeout seconds, or only
+              records behind the watermark, are left out. A record older
+              than the watermark is late: it is not reordered any more but
+              still goes to the windows.
+WindowAggregator
+              count/min/max/mean/last of temperature and humidity per
+              sensor over tumbling (slide = size) or sliding windows. The
+              records are folded into panes of one slide as they arrive and
+              a window is the merge of its panes, so memory is proportional
+              to the open panes, not to the history. A window is emitted,
+              as a Summary, once the watermark has passed its end by
+              lateness; records for an emitted window are dropped from the
+              aggregates (they are still stored).
+
+Window summaries from the drone's edge reduction count with their full
+statistics, in the window their start falls in, as in the query rollups
+(common.query).
+
+StreamProcessor runs both on a thread of its own, fed by submit(). Late
+records are not lost to its consumer: they are passed on as they arrive,
+after the records released in order.
+"""
+import math
+import time
+import heapq
+import queue
+import logging
+import threading
+from itertools import count as counter
+
+from common.protocol import Summary
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Seconds without records after which a source no longer holds the watermark back
+IDLE_TIMEOUT = 30.0
+
+# Batches waiting for the stream thread; when it falls this far behind,
+# submit() blocks and the drones are acknowledged later
+SUBMIT_QUEUE = 1000
+
+# Seconds between two watermark updates while no records arrive
+TICK_INTERVAL = 1.0
+
+# Values kept per pane: count, then n/sum/min/max/last per field, then the
+# timestamp of the last reading
+_FIELDS = (1, 6)
+_LAST_TS = 11
+
+
+def _empty():
+    return [0, 0, 0.0, math.inf, -math.inf, math.nan, 0, 0.0, math.inf, -math.inf, math.nan, -1]
+
+
+class Reorderer:
+    """
+    Parameters:
+    max_delay_us (int): how far behind its newest record a source may still send older ones.
+    idle_timeout (float): seconds after which a silent source is left out of the watermark.
+    """
+
+    def __init__(self, max_delay_us, idle_timeout=IDLE_TIMEOUT):
+        self.max_delay_us = max_delay_us
+        self.idle_timeout = idle_timeout
+        self.heap = []
+        self._order = counter()
+        # source -> [newest ts_us, monotonic time of its last records]
+        self.sources = {}
+        # Every record older than this has been released
+        self.watermark = -math.inf
+        self.released = 0
+        self.late = 0
+
+    def push(self, records, source=None, now=None):
+        """Add a batch; returns (released, late) records, the released ones in event-time order."""
+        now = time.monotonic() if now is None else now
+        heap, order, watermark = self.heap, self._order, self.watermark
+        late = []
+        newest = -math.inf
+        for r in records:
+            ts = r.ts_us
+            if ts < watermark:
+                late.append(r)
+                continue
+            heapq.heappush(heap, (ts, next(order), r))
+            if ts > newest:
+                newest = ts
+        state = self.sources.get(source)
+        if state is None:
+            state = self.sources[source] = [newest, now]
+        elif newest > state[0]:
+            state[0] = newest
+        state[1] = now
+        self.late += len(late)
+        return self.advance(now), late
+
+    def remove(self, source):
+        """Forget a source (its drone disconnected)."""
+        self.sources.pop(source, None)
+
+    def advance(self, now=None):
+        """Move the watermark on (idle sources stop counting); returns the records released."""
+        now = time.monotonic() if now is None else now
+        # A source entirely behind the watermark (e.g. replaying its spool) only sends late records
+        active = [newest for newest, seen in self.sources.values()
+                  if now - seen < self.idle_timeout and newest >= self.watermark]
+        if active:
+            watermark = min(active) - self.max_delay_us
+        elif self.heap:
+            # Nobody is sending: everything waiting can go
+            watermark = max(ts for ts, _, _ in self.heap) + 1
+        else:
+            return []
+        return self.release(watermark)
+
+    def release(self, watermark):
+        """Release every record older than watermark (math.inf: all of them)."""
+        if watermark <= self.watermark:
+            return []
+        self.watermark = watermark
+        heap = self.heap
+        out = []
+        while heap and heap[0][0] < watermark:
+            out.append(heapq.heappop(heap)[2])
+        self.released += len(out)
+        return out
+
+
+class WindowAggregator:
+    """
+    Parameters:
+    size_us (int): window length in microseconds.
+    slide_us (int): distance between two window starts; None or size_us for tumbling windows.
+        size_us must be a multiple of it.
+    lateness_us (int): how long after the watermark passed its end a window stays open.
+    """
+
+    def __init__(self, size_us, slide_us=None, lateness_us=0):
+        slide_us = slide_us or size_us
+        if size_us <= 0 or slide_us <= 0 or size_us % slide_us:
+            raise ValueError("Window size must be a positive multiple of its slide")
+        self.size_us = size_us
+        self.slide_us = slide_us
+        self.lateness_us = lateness_us
+        self.panes_per_window = size_us // slide_us
+        # sensor id -> {pane index: values}
+        self.panes = {}
+        # Windows up to this index are emitted; panes up to it are no longer needed
+        self.closed = -math.inf
+        self.emitted = 0
+        self.dropped = 0
+
+    def add(self, records):
+        """Fold records into their panes; returns how many were too late."""
+        slide, closed, panes = self.slide_us, self.closed, self.panes
+        dropped = 0
+        for r in records:
+            summary = type(r) is Summary
+            index = (r.start_us if summary else r.ts_us) // slide
+            if index <= closed:
+                dropped += 1
+                continue
+            sensor = panes.get(r.sensor_id)
+            if sensor is None:
+                sensor = panes[r.sensor_id] = {}
+            p = sensor.get(index)
+            if p is None:
+                p = sensor[index] = _empty()
+            if summary:
+                p[0] += r.count
+                fields = ((r.temperature_mean, r.temperature_min, r.temperature_max, r.temperature_last),
+                          (r.humidity_mean, r.humidity_min, r.humidity_max, r.humidity_last))
+                n = r.count
+            else:
+                p[0] += 1
+                fields = ((r.temperature, r.temperature, r.temperature, r.temperature),
+                          (r.humidity, r.humidity, r.humidity, r.humidity))
+                n = 1
+            newer = r.ts_us >= p[_LAST_TS]
+            for offset, (mean, low, high, last) in zip(_FIELDS, fields):
+                if mean == mean:  # NaN: missing value
+                    p[offset] += n
+                    p[offset + 1] += mean * n
+                    if low < p[offset + 2]:
+                        p[offset + 2] = low
+                    if high > p[offset + 3]:
+                        p[offset + 3] = high
+                if newer:
+                    p[offset + 4] = last
+            if newer:
+                p[_LAST_TS] = r.ts_us
+        self.dropped += dropped
+        return dropped
+
+    def advance(self, watermark):
+        """Close the windows the watermark has passed by lateness; returns their Summary records."""
+        if watermark == math.inf:
+            last = max((max(sensor) for sensor in self.panes.values() if sensor), default=self.closed)
+        else:
+            last = (watermark - self.lateness_us - self.size_us) // self.slide_us
+        if last <= self.closed:
+            return []
+        k, slide, size = self.panes_per_window, self.slide_us, self.size_us
+        first = self.closed + 1
+        out = []
+        for sensor_id, sensor in self.panes.items():
+            # Windows that contain at least one pane
+            windows = set()
+            for index in sensor:
+                if index - k < last:
+                    windows.update(range(max(index - k + 1, first), min(index, last) + 1))
+            for window in sorted(windows):
+                merged = _empty()
+                for index in range(window, window + k):
+                    p = sensor.get(index)
+                    if p is not None:
+                        _merge(merged, p)
+                out.append(_summary(sensor_id, window * slide, window * slide + size, merged))
+            for index in [index for index in sensor if index <= last]:
+                del sensor[index]
+        self.panes = {sensor_id: sensor for sensor_id, sensor in self.panes.items() if sensor}
+        self.closed = last
+        out.sort(key=lambda s: (s.end_us, s.sensor_id))
+        self.emitted += len(out)
+        return out
+
+    def open_panes(self):
+        return sum(len(sensor) for sensor in self.panes.values())
+
+
+def _merge(into, p):
+    into[0] += p[0]
+    for offset in _FIELDS:
+        into[offset] += p[offset]
+        into[offset + 1] += p[offset + 1]
+        into[offset + 2] = min(into[offset + 2], p[offset + 2])
+        into[offset + 3] = max(into[offset + 3], p[offset + 3])
+    if p[_LAST_TS] >= into[_LAST_TS]:
+        into[5], into[10], into[_LAST_TS] = p[5], p[10], p[_LAST_TS]
+
+
+def _summary(sensor_id, start_us, end_us, p):
+    stats = []
+    for offset in _FIELDS:
+        n = p[offset]
+        if n:
+            stats += [p[offset + 2], p[offset + 3], p[offset + 1] / n, p[offset + 4]]
+        else:
+            stats += [math.nan, math.nan, math.nan, p[offset + 4]]
+    return Summary(sensor_id, start_us, end_us, p[0], *stats, p[_LAST_TS])
+
+
+class StreamProcessor:
+    """
+    Parameters:
+    windows (iterable): (size_us, slide_us) of every window aggregate; slide_us None for tumbling windows.
+    max_delay_us (int): see Reorderer.
+    lateness_us (int): see WindowAggregator.
+    on_records (callable): optional, called as on_records(records) with the released records in event-time
+        order, and with every batch's late records as they arrive (e.g. a spool replay).
+    on_windows (callable): optional, called as on_windows(size_us, slide_us, summaries) for closed windows.
+    idle_timeout (float): see Reorderer.
+    """
+
+    def __init__(self, windows=(), max_delay_us=2000000, lateness_us=0, on_records=None, on_windows=None,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.reorderer = Reorderer(max_delay_us, idle_timeout)
+        self.windows = [WindowAggregator(size_us, slide_us, lateness_us) for size_us, slide_us in windows]
+        self.on_records = on_records
+        self.on_windows = on_windows
+        self._queue = queue.Queue(SUBMIT_QUEUE)
+        self._thread = threading.Thread(target=self._run, name="stream", daemon=True)
+        self._thread.start()
+
+    def submit(self, records, source=None):
+        """Hand a decoded batch to the stream thread; source identifies the drone connection."""
+        if records:
+            self._queue.put(("records", source, records))
+
+    def disconnect(self, source):
+        """The source's connection closed; it no longer holds the watermark back."""
+        self._queue.put(("disconnect", source, None))
+
+    def close(self, timeout=10.0):
+        """Release everything still waiting, emit every open window and stop the thread."""
+        self._queue.put(("close", None, None))
+        self._thread.join(timeout)
+
+    def _run(self):
+        reorderer = self.reorderer
+        while True:
+            try:
+                kind, source, records = self._queue.get(timeout=TICK_INTERVAL)
+            except queue.Empty:
+                kind = "tick"
+            try:
+                late = ()
+                if kind == "records":
+                    released, late = reorderer.push(records, source)
+                elif kind == "close":
+                    released = reorderer.release(math.inf)
+                else:
+                    if kind == "disconnect":
+                        reorderer.remove(source)
+                    released = reorderer.advance()
+                if late:
+                    metrics.inc("stream.late", len(late))
+                self._emit(released, late, reorderer.watermark)
+            except Exception:
+                log.exception(f"Stream stage failed on '{kind}'")
+            if kind == "close":
+                return
+
+    def _emit(self, released, late, watermark):
+        if self.on_records:
+            if released:
+                self.on_records(released)
+            if late:
+                self.on_records(late)
+        for aggregator in self.windows:
+            if released:
+                aggregator.add(released)
+            if late:
+                dropped = aggregator.add(late)
+                if dropped:
+                    metrics.inc("stream.dropped_late", dropped)
+            closed = aggregator.advance(watermark)
+            if closed and self.on_windows:
+                self.on_windows(aggregator.size_us, aggregator.slide_us, closed)
+
+    def stats(self):
+        reorderer = self.reorderer
+        return {
+            "watermark_us": reorderer.watermark if reorderer.watermark != -math.inf else None,
+            "sources": len(reorderer.sources),
+            "waiting": len(reorderer.heap),
+            "released": reorderer.released,
+            "late": reorderer.late,
+            "pending_batches": self._queue.qsize(),
+            "windows": [{
+                "size_us": a.size_us,
+                "slide_us": a.slide_us,
+                "open_panes": a.open_panes(),
+                "emitted": a.emitted,
+                "dropped_late": a.dropped,
+            } for a in self.windows],
+        }
@@ -0,0 +1,605 @@
+"""
+Embedded time-series store for the readings received by the central server.
+
+Layout on disk:
+
+    directory/meta.json                    partition length and index block size
+    directory/<sensor>/<partition>/ts.i64            int64 epoch-micros timestamps
+                                  temperature.f32    float32
+                                  humidity.f32       float32
+                                  flags.u8           anomaly flags
+                                  index.i64          sparse time index
+
+Readings are split per sensor (the directory name is the URL-quoted sensor
+id) and per time partition (ts_us // partition_us, one hour by default).
+A partition is a set of column files that are only ever appended to, so row
+n of every column belongs to the same reading.
+
+The sparse index stores the minimum and maximum timestamp of every full block
+of block_rows rows. A range scan memory-maps the column files and copies only
+the blocks whose [min, max] overlaps the requested range. Rows that arrive
+out of order (several drones, spool replays) are still found because every
+block keeps its own bounds.
+
+write() only appends to in-memory column buffers; flush() writes them out.
+The fsync policy decides when that happens:
+
+FSYNC_ALWAYS    every write() is flushed and fsynced before it returns
+FSYNC_INTERVAL  a background thread flushes and fsyncs every fsync_interval
+                seconds, so each touched file is synced once per interval
+FSYNC_NEVER     the background thread flushes and leaves syncing to the OS
+
+With the background policies the thread is also woken early once
+max_buffered rows are waiting.
+
+A store opened with readonly=True reads a directory another process writes
+to (the central server's worker pool, see common.workers). It never
+changes the files, picks up new sensors and partitions as they appear and
+sees rows once the writer has flushed them. MergedStore reads several
+stores as one.
+"""
+import os
+import json
+import mmap
+import time
+import heapq
+import logging
+import threading
+from array import array
+from collections import namedtuple
+from urllib.parse import quote, unquote
+
+from common.protocol import Reading
+
+log = logging.getLogger(__name__)
+
+PARTITION_US = 3600 * 1000000  # one partition per sensor per hour
+BLOCK_ROWS = 4096              # rows per sparse index entry
+META = "meta.json"
+
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+
+# Column file name and array typecode, in Series order
+_COLUMNS = (("ts.i64", "q"), ("temperature.f32", "f"), ("humidity.f32", "f"), ("flags.u8", "B"))
+_INDEX = "index.i64"
+
+# Columns of the rows returned by a scan
+Series = namedtuple("Series", "ts_us temperature humidity flags")
+
+
+def _empty_columns():
+    return tuple(array(code) for _name, code in _COLUMNS)
+
+
+def _sensor_dirname(sensor_id):
+    # "." is quoted too so that no sensor id maps to "." or ".."
+    return quote(sensor_id, safe="").replace(".", "%2E") or "%"
+
+
+def _sensor_from_dirname(name):
+    return "" if name == "%" else unquote(name)
+
+
+class _Partition:
+    """In-memory state of one sensor/partition directory."""
+
+    __slots__ = ("path", "rows", "index", "tail_min", "tail_max", "buffer", "flushing", "torn")
+
+    def __init__(self, path):
+        self.path = path
+        # Rows on disk, full-block bounds (min, max pairs) and bounds of the partial last block
+        self.rows = 0
+        self.index = array("q")
+        self.tail_min = None
+        self.tail_max = None
+        # Rows written but not flushed yet, and rows a running flush is writing out
+        self.buffer = None
+        self.flushing = None
+        # A failed flush could not cut its partial rows off the files yet
+        self.torn = False
+
+
+class TimeSeriesStore:
+    """
+    Parameters:
+    directory (str): root directory of the store.
+    partition_us (int): length of a time partition in microseconds.
+    block_rows (int): rows covered by one sparse index entry.
+    fsync (str): FSYNC_ALWAYS, FSYNC_INTERVAL or FSYNC_NEVER.
+    fsync_interval (float): seconds between background flushes.
+    max_buffered (int): buffered rows that wake the background flush early.
+    readonly (bool): only read a store that another process writes to.
+
+    partition_us and block_rows are fixed when the store is created; an
+    existing store keeps the values recorded in its meta.json.
+    """
+
+    def __init__(self, directory, partition_us=PARTITION_US, block_rows=BLOCK_ROWS,
+                 fsync=FSYNC_INTERVAL, fsync_interval=1.0, max_buffered=200000, readonly=False):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_buffered = max_buffered
+        self.readonly = readonly
+        os.makedirs(directory, exist_ok=True)
+        self.partition_us, self.block_rows = self._load_meta(partition_us, block_rows)
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # sensor id -> {partition number -> _Partition, or None until first used}
+        self._sensors = self._discover()
+        self._dirty = set()
+        self._buffered = 0
+
+        # Counters
+        self.rows_written = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self.last_flush = 0.0
+
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+        self._flusher = None
+        if fsync != FSYNC_ALWAYS and not readonly:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    # --- metadata ---
+
+    def _load_meta(self, partition_us, block_rows):
+        path = os.path.join(self.directory, META)
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+            if (meta["partition_us"], meta["block_rows"]) != (partition_us, block_rows):
+                log.info(f"Using the layout of the existing store in {self.directory}: {meta}")
+            return meta["partition_us"], meta["block_rows"]
+        except FileNotFoundError:
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"partition_us": partition_us, "block_rows": block_rows}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            return partition_us, block_rows
+
+    def _discover(self):
+        sensors = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            partitions = {}
+            for part in os.scandir(entry.path):
+                if part.is_dir() and part.name.isdigit():
+                    partitions[int(part.name)] = None
+            sensors[_sensor_from_dirname(entry.name)] = partitions
+        return sensors
+
+    def _refresh(self, sensor_id=None):
+        # Read-only stores: add the sensors (or the partitions of one sensor)
+        # the writer created since the last look. Called with the lock held
+        if sensor_id is None:
+            found = self._discover()
+        else:
+            found = {sensor_id: {}}
+            try:
+                for part in os.scandir(os.path.join(self.directory, _sensor_dirname(sensor_id))):
+                    if part.is_dir() and part.name.isdigit():
+                        found[sensor_id][int(part.name)] = None
+            except FileNotFoundError:
+                return
+        for sensor, numbers in found.items():
+            partitions = self._sensors.setdefault(sensor, {})
+            for number in numbers:
+                partitions.setdefault(number, None)
+
+    def _partition(self, sensor_id, number):
+        # Called with the lock held
+        partitions = self._sensors.get(sensor_id)
+        if partitions is None:
+            partitions = self._sensors[sensor_id] = {}
+        p = partitions.get(number)
+        if p is None:
+            path = os.path.join(self.directory, _sensor_dirname(sensor_id), f"{number:012d}")
+            p = partitions[number] = _Partition(path)
+            if os.path.isdir(path):
+                self._recover(p)
+        elif self.readonly and os.path.isdir(p.path):
+            # The writer may have flushed more rows since the last read
+            self._recover(p)
+        return p
+
+    def _recover(self, p):
+        """
+        Load a partition from disk, cutting off rows torn by a crash mid-flush.
+        A read-only store ignores torn rows instead, as the writer may be
+        in the middle of a flush.
+        """
+        sizes = []
+        for name, code in _COLUMNS:
+            try:
+                sizes.append(os.path.getsize(os.path.join(p.path, name)))
+            except FileNotFoundError:
+                sizes.append(0)
+        rows = min(size // array(code).itemsize for (_name, code), size in zip(_COLUMNS, sizes))
+        if not self.readonly:
+            for (name, code), size in zip(_COLUMNS, sizes):
+                # Also cuts a partly written value off the end of a column
+                if size > rows * array(code).itemsize:
+                    os.truncate(os.path.join(p.path, name), rows * array(code).itemsize)
+
+        block_rows = self.block_rows
+        blocks = rows // block_rows
+        index = array("q")
+        try:
+            with open(os.path.join(p.path, _INDEX), "rb") as f:
+                data = f.read()
+            # Whole (min, max) entries only
+            index.frombytes(data[:len(data) // 16 * 16])
+        except FileNotFoundError:
+            pass
+        # Only the blocks the index does not cover and the partial last block are read
+        known = min(blocks, len(index) // 2)
+        ts = self._read_column(p.path, 0, known * block_rows, rows)
+        if len(index) != 2 * blocks:
+            # Rebuild entries missing after a crash between the column and index writes
+            del index[2 * known:]
+            for b in range(blocks - known):
+                block = ts[b * block_rows:(b + 1) * block_rows]
+                index.extend((min(block), max(block)))
+            if not self.readonly:
+                with open(os.path.join(p.path, _INDEX), "wb") as f:
+                    index.tofile(f)
+        tail = ts[(blocks - known) * block_rows:]
+        p.rows = rows
+        p.index = index
+        p.tail_min = min(tail) if tail else None
+        p.tail_max = max(tail) if tail else None
+
+    # --- writing ---
+
+    def write(self, readings):
+        """Append readings; with FSYNC_ALWAYS they are on disk when this returns."""
+        if not readings:
+            return
+        if self.readonly:
+            raise ValueError("Store is read-only")
+        partition_us = self.partition_us
+        with self._lock:
+            if self._closed.is_set():
+                raise ValueError("Store is closed")
+            last_key = None
+            for r in readings:
+                key = (r.sensor_id, r.ts_us // partition_us)
+                if key != last_key:
+                    p = self._partition(*key)
+                    if p.buffer is None:
+                        p.buffer = _empty_columns()
+                        self._dirty.add(p)
+                    ts, temperature, humidity, flags = p.buffer
+                    last_key = key
+                ts.append(r.ts_us)
+                temperature.append(r.temperature)
+                humidity.append(r.humidity)
+                flags.append(r.flags)
+            self._buffered += len(readings)
+            buffered = self._buffered
+        if self.fsync == FSYNC_ALWAYS:
+            self.flush(fsync=True)
+        elif buffered >= self.max_buffered:
+            self._wake.set()
+
+    def flush(self, fsync=None):
+        """
+        Write every buffered row to the column files. fsync defaults to the
+        store's policy (never for FSYNC_NEVER). If a write fails the error is
+        raised and the rows not written stay buffered for the next flush.
+        """
+        if fsync is None:
+            fsync = self.fsync != FSYNC_NEVER
+        with self._flush_lock:
+            start = time.perf_counter()
+            with self._lock:
+                dirty = list(self._dirty)
+                self._dirty = set()
+                self._buffered = 0
+                for p in dirty:
+                    p.flushing, p.buffer = p.buffer, None
+            for n, p in enumerate(dirty):
+                try:
+                    self._flush_partition(p, fsync)
+                except BaseException:
+                    self._unflush(dirty[n:])
+                    raise
+            if dirty:
+                self.flushes += 1
+                self.last_flush = time.perf_counter() - start
+
+    def _unflush(self, partitions):
+        # A flush failed at the first of partitions: cut the rows it may have
+        # appended off the files and put every unwritten row back in front of
+        # the rows buffered since, so the next flush writes them again
+        failed = partitions[0]
+        failed.torn = True
+        try:
+            self._truncate(failed)
+        except OSError as e:
+            log.error(f"Could not undo a failed flush of {failed.path}, retrying on the next flush: {e}")
+        with self._lock:
+            for p in partitions:
+                if p.buffer is not None:
+                    for column, newer in zip(p.flushing, p.buffer):
+                        column.extend(newer)
+                p.buffer, p.flushing = p.flushing, None
+                self._dirty.add(p)
+                self._buffered += len(p.buffer[0])
+
+    def _truncate(self, p):
+        # Cut the files of a partition back to the rows and index entries it has on record
+        for name, code in _COLUMNS:
+            path = os.path.join(p.path, name)
+            if os.path.exists(path):
+                os.truncate(path, p.rows * array(code).itemsize)
+        path = os.path.join(p.path, _INDEX)
+        if os.path.exists(path):
+            os.truncate(path, len(p.index) * p.index.itemsize)
+        p.torn = False
+
+    def _flush_partition(self, p, fsync):
+        # Only the flusher changes rows/index/tail, so they can be read here without the lock
+        columns = p.flushing
+        os.makedirs(p.path, exist_ok=True)
+        if p.torn:
+            self._truncate(p)
+        for (name, _code), column in zip(_COLUMNS, columns):
+            self._append_file(os.path.join(p.path, name), column, fsync)
+
+        # Extend the sparse index with every block this flush completes
+        block_rows = self.block_rows
+        ts = columns[0]
+        filled = p.rows % block_rows
+        tail_min, tail_max = p.tail_min, p.tail_max
+        entries = array("q")
+        pos = 0
+        while pos < len(ts):
+            chunk = ts[pos:pos + block_rows - filled]
+            low, high = min(chunk), max(chunk)
+            if filled:
+                low, high = min(low, tail_min), max(high, tail_max)
+            filled += len(chunk)
+            pos += len(chunk)
+            if filled == block_rows:
+                entries.extend((low, high))
+                filled = 0
+                low = high = None
+            tail_min, tail_max = low, high
+        if entries:
+            self._append_file(os.path.join(p.path, _INDEX), entries, fsync)
+
+        with self._lock:
+            p.rows += len(ts)
+            p.index.extend(entries)
+            p.tail_min, p.tail_max = tail_min, tail_max
+            p.flushing = None
+            self.rows_written += len(ts)
+
+    def _append_file(self, path, column, fsync):
+        with open(path, "ab") as f:
+            column.tofile(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+                self.fsyncs += 1
+
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.fsync_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                log.error(f"Time-series flush failed: {e}")
+
+    def close(self):
+        """Flush (and fsync, unless FSYNC_NEVER) everything and stop the background thread."""
+        self._closed.set()
+        self._wake.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    # --- reading ---
+
+    def sensors(self):
+        with self._lock:
+            if self.readonly:
+                self._refresh()
+            return sorted(self._sensors)
+
+    def scan(self, sensor_id, start_us=None, end_us=None):
+        """
+        Yield one Series per partition with the sensor's rows in
+        [start_us, end_us) (None means unbounded), oldest partition first.
+        Rows inside a partition are in the order they were written.
+        """
+        for _number, series in self._scan(sensor_id, start_us, end_us):
+            yield series
+
+    def _scan(self, sensor_id, start_us, end_us):
+        # scan() with the partition number of every Series
+        partition_us = self.partition_us
+        first = None if start_us is None else start_us // partition_us
+        last = None if end_us is None else (end_us - 1) // partition_us
+        with self._lock:
+            if self.readonly:
+                self._refresh(sensor_id)
+            numbers = sorted(self._sensors.get(sensor_id, ()))
+            snapshots = []
+            for number in numbers:
+                if (first is not None and number < first) or (last is not None and number > last):
+                    continue
+                p = self._partition(sensor_id, number)
+                pending = [tuple(column[:] for column in columns)
+                           for columns in (p.flushing, p.buffer) if columns is not None]
+                snapshots.append((number, p.path, p.rows, p.index[:], p.tail_min, p.tail_max, pending))
+
+        low = -(1 << 63) if start_us is None else start_us
+        high = (1 << 63) - 1 if end_us is None else end_us - 1
+        for number, path, rows, index, tail_min, tail_max, pending in snapshots:
+            out = _empty_columns()
+            for row_start, row_end, inside in self._runs(rows, index, tail_min, tail_max, low, high):
+                columns = [self._read_column(path, k, row_start, row_end) for k in range(len(_COLUMNS))]
+                _extend(out, columns, None if inside else (low, high))
+            for columns in pending:
+                _extend(out, columns, (low, high))
+            if len(out[0]):
+                yield number, Series(*out)
+
+    def _runs(self, rows, index, tail_min, tail_max, low, high):
+        # Merge consecutive overlapping blocks into (row_start, row_end, fully_inside) runs
+        block_rows = self.block_rows
+        bounds = [(index[2 * b], index[2 * b + 1]) for b in range(len(index) // 2)]
+        if tail_min is not None:
+            bounds.append((tail_min, tail_max))
+        runs = []
+        for b, (bmin, bmax) in enumerate(bounds):
+            if bmax < low or bmin > high:
+                continue
+            row_start, row_end = b * block_rows, min((b + 1) * block_rows, rows)
+            inside = low <= bmin and bmax <= high
+            if runs and runs[-1][1] == row_start and runs[-1][2] == inside:
+                runs[-1] = (runs[-1][0], row_end, inside)
+            else:
+                runs.append((row_start, row_end, inside))
+        return runs
+
+    def _read_column(self, path, k, row_start, row_end):
+        name, code = _COLUMNS[k]
+        column = array(code)
+        if row_end <= row_start:
+            return column
+        size = column.itemsize
+        with open(os.path.join(path, name), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                column.frombytes(mm[row_start * size:row_end * size])
+        return column
+
+    def read(self, sensor_id, start_us=None, end_us=None):
+        """All rows of scan() concatenated into a single Series."""
+        out = _empty_columns()
+        for series in self.scan(sensor_id, start_us, end_us):
+            for column, part in zip(out, series):
+                column.extend(part)
+        return Series(*out)
+
+    def query(self, sensor_id, start_us=None, end_us=None, limit=None):
+        """
+        Rows in [start_us, end_us) as Reading tuples, sorted by timestamp;
+        with a limit only the oldest limit rows. Partitions do not overlap in
+        time, so the scan stops at the partition in which limit is reached.
+        """
+        out = _empty_columns()
+        last = None
+        for number, series in self._scan(sensor_id, start_us, end_us):
+            if limit is not None and number != last and len(out[0]) >= limit:
+                break
+            last = number
+            for column, part in zip(out, series):
+                column.extend(part)
+        readings = [Reading(sensor_id, t, h, ts, f) for ts, t, h, f in zip(*out)]
+        readings.sort(key=lambda r: r.ts_us)
+        return readings if limit is None else readings[:limit]
+
+    def latest(self, sensor_id):
+        """The sensor's reading with the highest timestamp, or None."""
+        with self._lock:
+            if self.readonly:
+                self._refresh(sensor_id)
+            numbers = self._sensors.get(sensor_id)
+            if not numbers:
+                return None
+            newest = max(numbers)
+        series = self.read(sensor_id, newest * self.partition_us)
+        if not len(series.ts_us):
+            return None
+        i = max(range(len(series.ts_us)), key=series.ts_us.__getitem__)
+        return Reading(sensor_id, series.temperature[i], series.humidity[i], series.ts_us[i], series.flags[i])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sensors": len(self._sensors),
+                "partitions": sum(len(p) for p in self._sensors.values()),
+                "rows_written": self.rows_written,
+                "rows_buffered": self._buffered,
+                "flushes": self.flushes,
+                "fsyncs": self.fsyncs,
+                "last_flush_ms": round(self.last_flush * 1000, 3),
+            }
+
+
+class MergedStore:
+    """
+    Read-only view over several stores, such as the per-process stores of
+    the central server's worker pool. A sensor may have rows in more than
+    one of them; scan() yields the partitions of all of them oldest first,
+    query() and latest() merge them.
+
+    Parameters:
+    stores (list): TimeSeriesStore objects, usually opened with readonly=True.
+    """
+
+    def __init__(self, stores):
+        self.stores = list(stores)
+
+    def write(self, readings):
+        raise ValueError("Merged stores are read-only")
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+
+    def sensors(self):
+        return sorted(set().union(*(store.sensors() for store in self.stores)))
+
+    def _scan(self, sensor_id, start_us, end_us):
+        # Partitions of every store, oldest first; the stores' partitions of the same hour in turn
+        return heapq.merge(*(store._scan(sensor_id, start_us, end_us) for store in self.stores),
+                           key=lambda item: item[0])
+
+    scan = TimeSeriesStore.scan
+    read = TimeSeriesStore.read
+    query = TimeSeriesStore.query
+
+    def latest(self, sensor_id):
+        found = [r for r in (store.latest(sensor_id) for store in self.stores) if r is not None]
+        return max(found, key=lambda r: r.ts_us) if found else None
+
+    def stats(self):
+        stats = [store.stats() for store in self.stores]
+        return {
+            "stores": len(stats),
+            "sensors": len(self.sensors()),
+            "partitions": sum(s["partitions"] for s in stats),
+        }
+
+
+def _extend(out, columns, bounds):
+    """Append columns to out, keeping only rows with low <= ts <= high unless bounds is None."""
+    if bounds is None:
+        for column, part in zip(out, columns):
+            column.extend(part)
+        return
+    low, high = bounds
+    ts = columns[0]
+    keep = [i for i, t in enumerate(ts) if low <= t <= high]
+    if len(keep) == len(ts):
+        for column, part in zip(out, columns):
+            column.extend(part)
+        return
+    for column, part in zip(out, columns):
+        column.extend(part[i] for i in keep)
@@ -0,0 +1,314 @@
+import socket
+import threading
+import json
+import time
+import random
+import logging
+
+from common.framing import Framer, LINE, LENGTH, RECV_SIZE, MAX_FRAME
+from common.protocol import (BinaryEncoder, BinaryDecoder, ProtocolError, FRAME_ACK, FRAME_BATCH, FRAME_SUMMARIES,
+                             FRAME_BATCH_SEQ, FRAME_SUMMARIES_SEQ, FRAME_RESUME, FRAME_RESUME_STATE, BATCH_ID,
+                             Summary, negotiate, accept_hello, hello_reply, encode_ack, encode_resume,
+                             encode_resume_state, decode_resume_state, record_from_dict, record_to_dict)
+from common.sequence import SequenceRange
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Default number of records packed into one batch frame
+BATCH_SIZE = 500
+
+
+class Uplink:
+    """
+    Long-lived drone -> central server connection.
+
+    Records (Readings, or Summaries from the edge reduction) are sent as
+    batches: a binary FRAME_BATCH / FRAME_SUMMARIES when the server accepts
+    the handshake (see common.protocol), otherwise one JSON line per batch,
+        {"batch": <id>, "records": [...]}
+    The server answers every batch with an ack carrying its id. A batch only
+    counts as delivered once its ack has been read back. Failed connections
+    are retried with exponential backoff and jitter instead of on every cycle.
+
+    Records sent with sequence numbers (see common.sequence) carry them in
+    the batch: FRAME_BATCH_SEQ / FRAME_SUMMARIES_SEQ with a version 2
+    server, "epoch" and "seqs" keys on the JSON line. Before the first
+    such batch of an epoch on a binary connection the uplink asks the
+    server which records of that epoch it already has and leaves them out,
+    so after an outage only what the server is missing is sent again.
+
+    The object is shared by every thread that forwards data; a lock keeps
+    batches and their acks from interleaving on the socket.
+
+    on_transmit, if given, is called as on_transmit(nbytes) for every batch
+    written to the socket, acknowledged or not (the drone charges its
+    battery model with it, see common.flush).
+    """
+
+    def __init__(self, host, port, ack_timeout=10.0, min_backoff=0.5, max_backoff=30.0, binary=True,
+                 on_transmit=None):
+        self.host = host
+        self.port = port
+        self.ack_timeout = ack_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.binary = binary
+        self.on_transmit = on_transmit
+
+        self.lock = threading.Lock()
+        self.sock = None
+        self.framer = None
+        self.encoder = None
+        self.version = 0
+        # epoch -> {sensor id: SequenceRange} the server reported on this connection
+        self.resumed = {}
+        self.batch_id = 0
+        self.backoff = 0.0
+        self.next_attempt = 0.0
+        self.connects = 0
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def _connect(self):
+        if self.sock is not None:
+            return
+        now = time.monotonic()
+        if now < self.next_attempt:
+            raise ConnectionError(f"Central server unreachable, retrying in {self.next_attempt - now:.1f}s")
+        sock = socket.create_connection((self.host, self.port), timeout=self.ack_timeout)
+        try:
+            version = negotiate(sock) if self.binary else 0
+        except ProtocolError:
+            # Older servers only speak JSON lines; stay on JSON from now on
+            sock.close()
+            self.binary = False
+            sock = socket.create_connection((self.host, self.port), timeout=self.ack_timeout)
+            version = 0
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.version = version
+        self.resumed = {}
+        self.framer = Framer(LENGTH if version else LINE, recv_size=4096)
+        # Sensor indexes are per connection, so every connection gets a fresh encoder
+        self.encoder = BinaryEncoder() if version else None
+        self.connects += 1
+        metrics.inc("uplink.connects")
+        log.info(f"Uplink connected to {self.host}:{self.port} ({'binary' if version else 'JSON'})")
+
+    def _fail(self, error):
+        # Drop the socket and push the next connection attempt out
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        metrics.inc("uplink.failures")
+        self.backoff = min(self.max_backoff, self.backoff * 2 if self.backoff else self.min_backoff)
+        self.next_attempt = time.monotonic() + self.backoff * random.uniform(0.5, 1.0)
+        log.error(f"Uplink error: {error}")
+
+    def _wait_for_ack(self, batch_id):
+        while True:
+            # Stale acks for batches we already gave up on are skipped
+            for frame in self.framer.frames():
+                if self.encoder is not None:
+                    if frame[0] == FRAME_ACK and BATCH_ID.unpack_from(frame)[1] == batch_id:
+                        return
+                elif json.loads(frame).get("ack") == batch_id:
+                    return
+            if not self.framer.recv_from(self.sock):
+                raise ConnectionResetError("Central server closed the uplink.")
+
+    def _resume(self, epoch):
+        # What the server already has of an epoch, asked once per connection
+        received = self.resumed.get(epoch)
+        if received is None:
+            self.sock.sendall(encode_resume(epoch))
+            while True:
+                for frame in self.framer.frames():
+                    if frame[0] == FRAME_RESUME_STATE:
+                        reply_epoch, state = decode_resume_state(frame)
+                        if reply_epoch == epoch:
+                            received = {sensor: SequenceRange(high, [list(gap) for gap in gaps])
+                                        for sensor, (high, gaps) in state.items()}
+                            self.resumed[epoch] = received
+                            return received
+                if not self.framer.recv_from(self.sock):
+                    raise ConnectionResetError("Central server closed the uplink.")
+        return received
+
+    def send_batch(self, records, epoch=None, seqs=None):
+        """
+        Send one batch and wait for its ack. Returns True once acknowledged.
+        Binary batches hold either Readings or Summaries, see send().
+        """
+        with self.lock:
+            try:
+                self._connect()
+                if seqs is not None and self.version >= 2:
+                    received = self._resume(epoch)
+                    if received:
+                        count = len(records)
+                        kept = [i for i, (r, seq) in enumerate(zip(records, seqs))
+                                if r.sensor_id not in received or seq not in received[r.sensor_id]]
+                        if len(kept) < count:
+                            metrics.inc("uplink.resumed_records", count - len(kept))
+                            if not kept:
+                                return True
+                            records = [records[i] for i in kept]
+                            seqs = [seqs[i] for i in kept]
+                self.batch_id += 1
+                if self.encoder is not None:
+                    if self.version < 2:
+                        seqs = None
+                    frame = self.encoder.encode_batch(self.batch_id, records, epoch, seqs)
+                else:
+                    message = {"batch": self.batch_id, "records": [record_to_dict(r) for r in records]}
+                    if seqs is not None:
+                        message["epoch"] = epoch
+                        message["seqs"] = list(seqs)
+                    frame = json.dumps(message).encode() + b"\n"
+                started = time.perf_counter()
+                try:
+                    self.sock.sendall(frame)
+                finally:
+                    if self.on_transmit is not None:
+                        self.on_transmit(len(frame))
+                self._wait_for_ack(self.batch_id)
+            except (OSError, ValueError) as e:
+                self._fail(e)
+                return False
+            self.backoff = 0.0
+        metrics.observe("stage.uplink_rtt", (time.perf_counter() - started) * 1000000)
+        metrics.inc("uplink.sent_bytes", len(frame))
+        metrics.inc("uplink.sent_batches")
+        metrics.inc("uplink.sent_records", len(records))
+        return True
+
+    def send(self, records, batch_size=BATCH_SIZE, epoch=None, seqs=None):
+        """
+        Send records in batches of at most batch_size; a batch never mixes
+        Readings and Summaries. seqs, if given, holds the sequence number of
+        every record, numbered in epoch.
+
+        Returns the number of leading records that were acknowledged (or
+        that the server already had), so the caller can drop exactly those
+        from its buffer and keep the rest.
+        """
+        sent = 0
+        while sent < len(records):
+            end = min(sent + batch_size, len(records))
+            kind = type(records[sent]) is Summary
+            for i in range(sent + 1, end):
+                if (type(records[i]) is Summary) != kind:
+                    end = i
+                    break
+            if not self.send_batch(records[sent:end], epoch, None if seqs is None else seqs[sent:end]):
+                break
+            sent = end
+        return sent
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+
+def serve_uplink(conn, on_records, binary=True, recv_size=RECV_SIZE, max_frame=MAX_FRAME, sequences=None):
+    """
+    Server side of the uplink: read frames from a connected drone until it
+    disconnects.
+
+    Every batch is passed to on_records(records) as a list of Readings and/or
+    Summaries and acknowledged once that call returns. Plain
+    one-record-per-line messages from older drones are still accepted and
+    handed over as a batch of one (without an ack).
+
+    With a SequenceIndex as `sequences`, records of sequence-numbered
+    batches that were received before, or are being stored from another
+    connection, are dropped (the batch is still acknowledged) and resume
+    requests are answered from the index.
+    """
+    framer = Framer(recv_size=recv_size, max_frame=max_frame)
+    decoder = None
+    negotiated = False
+    while True:
+        n = framer.recv_from(conn)
+        if not n:
+            return  # connection closed
+        metrics.inc("uplink.recv_bytes", n)
+        if not negotiated:
+            version, consumed = accept_hello(framer.peek(), binary)
+            if version is None:
+                continue
+            if consumed:
+                conn.sendall(hello_reply(version))
+                framer.consume(consumed)
+            if version:
+                decoder = BinaryDecoder()
+                framer.mode = LENGTH
+            negotiated = True
+        if decoder is not None:
+            for payload in framer.frames():
+                metrics.inc("uplink.recv_frames")
+                try:
+                    kind, batch_id, records = decoder.decode(payload)
+                except ValueError:
+                    metrics.inc("uplink.decode_errors")
+                    raise
+                if kind == FRAME_BATCH_SEQ or kind == FRAME_SUMMARIES_SEQ:
+                    _deliver(on_records, records, sequences, *decoder.sequence)
+                    conn.sendall(encode_ack(batch_id))
+                    continue
+                if kind == FRAME_RESUME:
+                    conn.sendall(encode_resume_state(batch_id, sequences.state(batch_id) if sequences else {}))
+                    continue
+                if records:
+                    on_records(records)
+                if kind == FRAME_BATCH or kind == FRAME_SUMMARIES:
+                    conn.sendall(encode_ack(batch_id))
+            continue
+        for line in framer.frames():
+            if not line.strip():
+                continue
+            metrics.inc("uplink.recv_frames")
+            try:
+                message = json.loads(line)
+            except ValueError:
+                metrics.inc("uplink.decode_errors")
+                raise
+            if "batch" in message:
+                records = [record_from_dict(r) for r in message["records"]]
+                if "seqs" in message:
+                    if len(message["seqs"]) != len(records):
+                        raise ProtocolError("Batch has a sequence number count that does not match its records")
+                    _deliver(on_records, records, sequences, message["epoch"], message["seqs"])
+                else:
+                    on_records(records)
+                conn.sendall(json.dumps({"ack": message["batch"]}).encode() + b"\n")
+            else:
+                on_records([record_from_dict(message)])
+
+
+def _deliver(on_records, records, sequences, epoch, seqs):
+    # Hand over the records the index has not seen (reserving their numbers),
+    # then mark them received; if they could not be stored, a resend may try again
+    if sequences is None:
+        if records:
+            on_records(records)
+        return
+    records, seqs = sequences.filter(epoch, records, seqs)
+    try:
+        if records:
+            on_records(records)
+    except BaseException:
+        sequences.release(epoch, records, seqs)
+        raise
+    sequences.add(epoch, records, seqs)
@@ -0,0 +1,418 @@
+"""
+Multi-process central server.
+
+Decoding drone batches is CPU bound and holds the GIL, so one server process
+tops out at one core however many drones connect. WorkerPool serves the
+drone port from N worker processes instead. Every worker accepts drone
+connections, decodes their batches (common.uplink.serve_uplink), writes them
+to a store of its own, <data_dir>/worker-<i> (common.tsdb), and acknowledges
+them.
+
+Connections are spread across the workers
+- by the kernel where the platform has SO_REUSEPORT (Linux, BSD, macOS):
+  every worker listens on its own socket bound to the same port;
+- otherwise by the parent, which accepts and hands each socket to whichever
+  worker takes it first.
+
+Workers pass every stored batch back to the parent over a queue. The parent
+folds them into one QueryEngine over all the worker stores (MergedStore), so
+the rollups, the latest values, the query API and a GUI see one server.
+Range queries read the worker stores from disk and see rows once the worker
+has flushed them, about a second after they arrived. Every worker reports
+its connections, batches, store and metric counters once a second; stats()
+adds them up.
+
+The sequence index (common.sequence) is kept once, in the parent, and saved
+to <data_dir>/sequence.json, since a reconnecting drone may land on any
+worker. A worker asks the parent over a pipe which numbers of a batch are
+new, which reserves them, and which of an epoch's numbers a resuming drone
+can skip; after storing a batch it reports the numbers with the records
+(or releases them if the batch could not be stored). The reservations of a
+worker that exits are released. The parent only
+saves the index after every worker has flushed its store past the
+snapshot, so the file never claims rows a worker could still lose.
+
+Workers are started with the "spawn" method, which imports the main module
+again in every worker: a script using the pool must keep its start-up code
+under `if __name__ == "__main__":`.
+"""
+import os
+import time
+import queue
+import pickle
+import socket
+import logging
+import threading
+import multiprocessing
+from array import array
+from multiprocessing.connection import wait as wait_connections
+from multiprocessing.reduction import ForkingPickler
+
+from common.uplink import serve_uplink
+from common.tsdb import TimeSeriesStore, MergedStore
+from common.query import QueryEngine, split_records
+from common.sequence import SequenceIndex, persist_periodically
+from common.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# True where the kernel can spread one port over several listening sockets
+REUSE_PORT = hasattr(socket, "SO_REUSEPORT")
+
+# Batches waiting for the parent; when it falls this far behind the workers
+# stop acknowledging, which slows the drones down
+RESULT_QUEUE = 1000
+
+# Seconds between the statistics every worker reports; every worker also
+# flushes its store that often
+STATS_INTERVAL = 1.0
+
+# Seconds the parent waits for every worker to flush before saving the sequence index
+FLUSH_TIMEOUT = 10.0
+
+
+def _listen(host, port, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+
+class _SequenceClient:
+    """
+    The parent's SequenceIndex as serve_uplink uses it in a worker: filter()
+    (which reserves the new numbers) and state() ask the parent over a pipe,
+    add() and release() report the numbers of stored or failed records on
+    the results queue, add() behind the records themselves.
+    """
+
+    def __init__(self, conn, results, index):
+        self.conn = conn
+        self.results = results
+        self.index = index
+        self.lock = threading.Lock()
+
+    def _call(self, *request):
+        # One request at a time per worker; the connection threads take turns
+        with self.lock:
+            self.conn.send(request)
+            return self.conn.recv()
+
+    def filter(self, epoch, records, seqs):
+        fresh = self._call("reserve", epoch, [r.sensor_id for r in records], seqs)
+        if fresh is None:
+            return records, seqs
+        return ([r for r, keep in zip(records, fresh) if keep],
+                array("I", [seq for seq, keep in zip(seqs, fresh) if keep]))
+
+    def add(self, epoch, records, seqs):
+        if records:
+            self.results.put(("sequences", self.index, (epoch, [r.sensor_id for r in records], seqs)))
+
+    def release(self, epoch, records, seqs):
+        if records:
+            self.results.put(("release", self.index, (epoch, [r.sensor_id for r in records], seqs)))
+
+    def state(self, epoch):
+        return self._call("state", epoch)
+
+
+class _Worker:
+    """What one worker process runs: connection threads over its own store."""
+
+    def __init__(self, index, store_dir, results, sequences, on_batch, binary):
+        self.index = index
+        self.store = TimeSeriesStore(store_dir)
+        self.sequences = _SequenceClient(sequences, results, index)
+        self.results = results
+        self.on_batch = on_batch
+        self.binary = binary
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.batches = 0
+        self.records = 0
+
+    def serve(self, conn, addr):
+        with conn:
+            self.results.put(("connect", self.index, addr))
+            with self.lock:
+                self.connections += 1
+            reason = None
+            try:
+                # Batches are acknowledged once handle_records returns
+                serve_uplink(conn, lambda records: self.handle_records(records, addr), self.binary,
+                             sequences=self.sequences)
+            except Exception as e:
+                reason = str(e) or type(e).__name__
+            with self.lock:
+                self.connections -= 1
+            self.results.put(("disconnect", self.index, (addr, reason)))
+
+    def handle_records(self, records, addr):
+        started = time.perf_counter()
+        self.store.write(split_records(records)[2])
+        metrics.observe("stage.store_write", (time.perf_counter() - started) * 1000000)
+        if self.on_batch is not None:
+            self.on_batch(records)
+        # Blocks while the parent is RESULT_QUEUE batches behind
+        self.results.put(("records", self.index, (records, addr)))
+        with self.lock:
+            self.batches += 1
+            self.records += len(records)
+
+    def report(self, stopped):
+        while not stopped.wait(STATS_INTERVAL):
+            # Everything stored before this time is on disk once the flush returns
+            flushed = time.time()
+            try:
+                self.store.flush()
+            except OSError as e:
+                log.error(f"Worker {self.index} could not flush its store: {e}")
+                flushed = None
+            with self.lock:
+                stats = {
+                    "pid": os.getpid(),
+                    "connections": self.connections,
+                    "batches": self.batches,
+                    "records": self.records,
+                }
+            stats["store"] = self.store.stats()
+            stats["flushed"] = flushed
+            stats["counters"] = dict(metrics.counters)
+            self.results.put(("stats", self.index, stats))
+
+
+def _worker_main(index, listener, handoff, store_dir, results, sequences, stopped, on_batch, binary):
+    worker = _Worker(index, store_dir, results, sequences, on_batch, binary)
+    threading.Thread(target=worker.report, args=(stopped,), name="stats", daemon=True).start()
+    # A parent killed without stop() must not leave workers holding the port
+    parent = multiprocessing.parent_process()
+    try:
+        if listener is not None:
+            listener.settimeout(1.0)
+        while not stopped.is_set() and parent.is_alive():
+            if listener is not None:
+                try:
+                    conn, addr = listener.accept()
+                except socket.timeout:
+                    continue
+                conn.setblocking(True)
+            else:
+                try:
+                    data = handoff.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                conn, addr = pickle.loads(data)
+            threading.Thread(target=worker.serve, args=(conn, addr), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Flush what this worker has acknowledged
+        worker.store.close()
+
+
+class WorkerPool:
+    """
+    Parameters:
+    port (int): drone port shared by the workers.
+    workers (int): number of worker processes.
+    data_dir (str): root of the per-worker stores.
+    on_records (callable): optional, called in this process as on_records(records, addr)
+        for every stored batch, after the merged QueryEngine has seen it; addr
+        is the address of the drone connection it came in on.
+    on_connect (callable): optional, called as on_connect(addr, worker).
+    on_disconnect (callable): optional, called as on_disconnect(addr, worker, reason);
+        reason is None when the drone closed the connection.
+    on_batch (callable): optional, called inside the worker as on_batch(records)
+        after a batch is stored. It is sent to the worker processes, so it
+        must be a module-level function.
+    reuse_port (bool): let the kernel spread connections (SO_REUSEPORT); False
+        makes this process accept them and hand them over.
+    binary (bool): accept the binary uplink handshake.
+    """
+
+    def __init__(self, port, workers, data_dir, on_records=None, on_connect=None, on_disconnect=None,
+                 on_batch=None, host="", reuse_port=REUSE_PORT, binary=True):
+        self.port = port
+        self.workers = max(1, workers)
+        self.data_dir = data_dir
+        self.on_records = on_records
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.on_batch = on_batch
+        self.host = host
+        self.reuse_port = reuse_port and REUSE_PORT
+        self.binary = binary
+
+        self._context = multiprocessing.get_context("spawn")
+        self.results = self._context.Queue(RESULT_QUEUE)
+        self.stopped = self._context.Event()
+        self.handoff = None if self.reuse_port else self._context.Queue()
+        self.listener = None
+        self.processes = []
+        self.worker_stats = [None] * self.workers
+        self._collector = None
+
+        # Stores of earlier runs with more workers stay part of the view
+        os.makedirs(data_dir, exist_ok=True)
+        names = {f"worker-{i}" for i in range(self.workers)}
+        names.update(entry.name for entry in os.scandir(data_dir)
+                     if entry.is_dir() and entry.name.startswith("worker-"))
+        self.store = MergedStore(TimeSeriesStore(os.path.join(data_dir, name), readonly=True)
+                                 for name in sorted(names))
+        self.queries = QueryEngine(self.store, cache_ranges=False)
+        self.sequences = SequenceIndex(os.path.join(data_dir, "sequence.json"))
+        # Parent ends of the workers' sequence index pipes
+        self._sequence_conns = []
+
+    def start(self):
+        """Start the worker processes and return self."""
+        for i in range(self.workers):
+            listener = _listen(self.host, self.port, True) if self.reuse_port else None
+            conn, worker_conn = self._context.Pipe()
+            process = self._context.Process(
+                target=_worker_main, name=f"central-worker-{i}", daemon=True,
+                args=(i, listener, self.handoff, os.path.join(self.data_dir, f"worker-{i}"), self.results,
+                      worker_conn, self.stopped, self.on_batch, self.binary))
+            process.start()
+            if listener is not None:
+                # The worker has its own copy
+                listener.close()
+            worker_conn.close()
+            self._sequence_conns.append(conn)
+            self.processes.append(process)
+        self._collector = threading.Thread(target=self._collect, name="workers", daemon=True)
+        self._collector.start()
+        threading.Thread(target=self._serve_sequences, name="sequences", daemon=True).start()
+        persist_periodically(self.sequences, self)
+        if not self.reuse_port:
+            self.listener = _listen(self.host, self.port, False)
+            threading.Thread(target=self._accept, name="acceptor", daemon=True).start()
+        return self
+
+    def _accept(self):
+        self.listener.settimeout(1.0)
+        while not self.stopped.is_set():
+            try:
+                conn, addr = self.listener.accept()
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self.stopped.is_set():
+                    log.error(f"Accept failed: {e}")
+                return
+            # Pickling duplicates the descriptor for the worker that picks it up
+            self.handoff.put(bytes(ForkingPickler.dumps((conn, addr))))
+            conn.close()
+
+    def _collect(self):
+        reported = set()
+        while True:
+            try:
+                kind, index, data = self.results.get(timeout=1.0)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    return
+                for process in self.processes:
+                    if process.exitcode is not None and process.name not in reported:
+                        reported.add(process.name)
+                        log.error(f"{process.name} exited with code {process.exitcode}")
+                continue
+            except (EOFError, OSError):
+                return
+            try:
+                if kind == "records":
+                    records, addr = data
+                    self.queries.apply(records)
+                    if self.on_records:
+                        self.on_records(records, addr)
+                elif kind == "sequences":
+                    self.sequences.add_numbers(*data)
+                elif kind == "release":
+                    self.sequences.release_numbers(*data)
+                elif kind == "connect":
+                    if self.on_connect:
+                        self.on_connect(data, index)
+                elif kind == "disconnect":
+                    if self.on_disconnect:
+                        self.on_disconnect(data[0], index, data[1])
+                elif kind == "stats":
+                    self.worker_stats[index] = data
+            except Exception:
+                log.exception(f"Handling '{kind}' from worker {index} failed")
+
+    def _serve_sequences(self):
+        # Answer the workers' index requests (see _SequenceClient). A batch
+        # that waits for another worker to store the same numbers holds up
+        # the others' requests until then
+        workers = {conn: i for i, conn in enumerate(self._sequence_conns)}
+        while workers and not self.stopped.is_set():
+            for conn in wait_connections(list(workers), timeout=1.0):
+                try:
+                    kind, *args = conn.recv()
+                    if kind == "reserve":
+                        conn.send(self.sequences.reserve(*args, owner=workers[conn]))
+                    else:
+                        conn.send(self.sequences.state(*args))
+                except (EOFError, OSError):
+                    # The worker exited; whatever it had not stored can come again
+                    self.sequences.release_owner(workers.pop(conn))
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """
+        Wait until every running worker has flushed its store past this
+        call, so whatever the workers had stored by then is on disk. Used
+        before the sequence index is saved (persist_periodically).
+        """
+        started = time.time()
+        deadline = time.monotonic() + timeout
+        while True:
+            behind = [i for i, (process, stats) in enumerate(zip(self.processes, self.worker_stats))
+                      if process.is_alive() and ((stats or {}).get("flushed") or 0) < started]
+            if not behind:
+                return
+            if time.monotonic() > deadline or self.stopped.is_set():
+                raise TimeoutError(f"Workers {behind} did not flush their stores")
+            time.sleep(STATS_INTERVAL / 4)
+
+    def wait(self):
+        """Block until stop() is called."""
+        while not self.stopped.wait(1.0):
+            pass
+
+    def stop(self, timeout=10.0):
+        """Stop the workers; each flushes its store before it exits."""
+        self.stopped.set()
+        if self.listener is not None:
+            self.listener.close()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                log.error(f"{process.name} did not stop, terminating it")
+                process.terminate()
+        # The numbers the workers reported last are still queued
+        if self._collector is not None:
+            self._collector.join(timeout)
+        self.store.close()
+        self.sequences.save()
+
+    def stats(self):
+        workers = []
+        counters = {}
+        for process, stats in zip(self.processes, self.worker_stats):
+            stats = dict(stats or {}, alive=process.is_alive())
+            for name, value in stats.pop("counters", {}).items():
+                counters[name] = counters.get(name, 0) + value
+            workers.append(stats)
+        return {
+            "workers": len(workers),
+            "reuse_port": self.reuse_port,
+            "connections": sum(s.get("connections", 0) for s in workers),
+            "batches": sum(s.get("batches", 0) for s in workers),
+            "records": sum(s.get("records", 0) for s in workers),
+            "counters": counters,
+            "per_worker": workers,
+        }
@@ -1,68 +1,106 @@
-import socket
-import threading
-import json
-import time
+import os
+import sys
+
+# Make the shared modules in common/ importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.drone_core import DroneCore
+from common.metrics import metrics, MetricsServer
 
 # Port for receiving data from sensors
 DRONE_PORT = 5000
 
+# Number of event loops sharing the sensor connections
+INGEST_WORKERS = 1
+
 # Central server address and port
 CENTRAL_SERVER_IP = "127.0.0.1"
 CENTRAL_SERVER_PORT = 6000
 
-# Buffer to temporarily store incoming sensor data
-sensor_data_buffer = []
-
-# Handle incoming connection from a single sensor node
-def handle_sensor_connection(conn, addr):
-    with conn:
-        print(f"[DRONE] Sensor connected from {addr}")
-        buffer = b""
-        while True:
-            try:
-                chunk = conn.recv(1024)
-                if not chunk:
-                    break  # connection closed
-                buffer += chunk
-                while b"\n" in buffer:
-                    line, buffer = buffer.split(b"\n", 1)
-                    data = json.loads(line.decode())
-                    print(f"[DRONE] Received from {addr}: {data}")
-                    sensor_data_buffer.append(data)
-            except Exception as e:
-                print(f"[DRONE] Connection error with {addr}: {e}")
-                break
-
-# Start a TCP server to listen for sensor connections
-def drone_tcp_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.bind(("", DRONE_PORT))
-        server_socket.listen()
-        print(f"[DRONE] Listening for sensors on port {DRONE_PORT}")
-        while True:
-            conn, addr = server_socket.accept()
-            # Start a new thread to handle each sensor connection
-            threading.Thread(target=handle_sensor_connection, args=(conn, addr), daemon=True).start()
-
-# Periodically forward buffered sensor data to the central server
-def forward_to_central():
-    while True:
-        if sensor_data_buffer:
-            try:
-                # Establish connection with central server
-                with socket.create_connection((CENTRAL_SERVER_IP, CENTRAL_SERVER_PORT)) as central_sock:
-                    for data in sensor_data_buffer:
-                        # Send each sensor data as JSON over TCP
-                        central_sock.sendall(json.dumps(data).encode() + b"\n")
-                        print(f"[DRONE] Forwarded to Central: {data}")
-                    # Clear the buffer after sending
-                    sensor_data_buffer.clear()
-            except Exception as e:
-                print(f"[DRONE] Could not connect to Central Server: {e}")
-        # Wait 5 seconds before next attempt
-        time.sleep(5)
-
-# Entry point: start TCP server in a separate thread and begin forwarding loop
+# Maximum number of readings held between forwarding cycles
+BUFFER_CAPACITY = 100000
+
+# Anomaly thresholds, edge reduction and flush policy settings, shared with the GUI drone
+ANOMALY_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "anomaly_config.json")
+EDGE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "edge_config.json")
+FLUSH_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flush_config.json")
+
+# Local metrics endpoint (JSON at /metrics); None turns the instrumentation off
+METRICS_PORT = 5100
+
+# Data queued while returning to base is spooled here
+SPOOL_DIR = "spool"
+
+# Percent of battery used every 5 seconds. The headless drone runs on an edge
+# box without the simulated battery by default; set to 1.0 to drain like the GUI
+BATTERY_DRAIN = 0.0
+
+
+def on_sensor_connect(addr):
+    print(f"[DRONE] Sensor connected from {addr}")
+
+def on_sensor_disconnect(addr, reason):
+    print(f"[DRONE] Connection error with {addr}: {reason}")
+
+def on_readings(readings):
+    for reading in readings:
+        print(f"[DRONE] Received: {reading}")
+
+def on_anomalies(alerts):
+    for msg in alerts:
+        print(f"[DRONE] {msg}")
+
+def on_status(returning_to_base):
+    if returning_to_base:
+        print("[DRONE] Battery low! Returning to base")
+    else:
+        print("[DRONE] Battery restored! Resuming normal operation")
+
+def on_forwarded(records):
+    for record in records:
+        print(f"[DRONE] Forwarded to Central: {record}")
+
+def on_undelivered(count):
+    print(f"[DRONE] Could not deliver {count} records to Central Server, will retry")
+
+def on_queued(count):
+    print(f"[DRONE] Queued {count} records during low battery")
+
+def on_flush_failed(flushed):
+    print(f"[DRONE] Flush failed after {flushed} records, the rest stays spooled")
+
+def on_dropped(drops):
+    print(f"[DRONE] Buffer full, {drops} readings dropped so far")
+
+def on_depleted(refused):
+    print(f"[DRONE] Battery depleted, {refused} incoming readings dropped so far")
+
+
+# Entry point: the core serves sensors and forwards on its own threads; this
+# script only prints what it reports
 if __name__ == "__main__":
-    threading.Thread(target=drone_tcp_server, daemon=True).start()
-    forward_to_central()
+    core = DroneCore(DRONE_PORT, CENTRAL_SERVER_IP, CENTRAL_SERVER_PORT, workers=INGEST_WORKERS,
+                     buffer_capacity=BUFFER_CAPACITY, anomaly_config=ANOMALY_CONFIG, edge_config=EDGE_CONFIG,
+                     flush_config=FLUSH_CONFIG, spool_dir=SPOOL_DIR, battery_drain=BATTERY_DRAIN)
+    core.subscribe("connect", on_sensor_connect)
+    core.subscribe("disconnect", on_sensor_disconnect)
+    core.subscribe("readings", on_readings)
+    core.subscribe("anomalies", on_anomalies)
+    core.subscribe("status", on_status)
+    core.subscribe("forwarded", on_forwarded)
+    core.subscribe("undelivered", on_undelivered)
+    core.subscribe("queued", on_queued)
+    core.subscribe("flush_failed", on_flush_failed)
+    core.subscribe("dropped", on_dropped)
+    core.subscribe("depleted", on_depleted)
+    if METRICS_PORT:
+        MetricsServer(metrics, METRICS_PORT).start()
+        print(f"[DRONE] Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    else:
+        metrics.enabled = False
+    core.start()
+    print(f"[DRONE] Listening for sensors on port {DRONE_PORT}")
+    try:
+        core.wait()
+    except KeyboardInterrupt:
+        core.stop()
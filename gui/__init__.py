@@ -0,0 +1 @@
+# Tk programs of the drone and the central server and their shared dashboard widgets.
@@ -0,0 +1,244 @@
+"""
+Coalesced, bounded rendering for the Tk dashboards.
+
+Worker threads never touch Tk widgets. They hand readings (or anomaly
+messages) to submit(), which only appends to a deque. A repaint scheduled on
+the Tk thread with root.after() runs at a fixed frame rate, takes everything
+submitted since the last frame and updates the widgets once per frame:
+
+LiveDashboard     a "Latest" tab with one row per sensor, updated in place,
+                  and a "History" tab that shows a fixed number of Treeview
+                  rows as a virtual window over a bounded HistoryStore
+BoundedListbox    a Listbox that keeps at most max_items lines
+"""
+import tkinter as tk
+from tkinter import ttk
+from collections import deque
+
+from common.protocol import Summary, us_to_iso
+
+FPS = 10
+HISTORY_ROWS = 10000
+VISIBLE_ROWS = 25
+MAX_ANOMALIES = 500
+
+
+# Columns and row formatting shared by the drone and server dashboards
+READING_COLUMNS = ("Sensor ID", "Temperature", "Humidity", "Timestamp")
+
+
+def reading_row(reading):
+    if type(reading) is Summary:
+        # Window summary from the drone's edge reduction: mean [min..max]
+        return (reading.sensor_id,
+                f"{reading.temperature_mean:.2f} [{reading.temperature_min:g}..{reading.temperature_max:g}]",
+                f"{reading.humidity_mean:.2f} [{reading.humidity_min:g}..{reading.humidity_max:g}]",
+                f"{us_to_iso(reading.ts_us)} ({reading.count} readings)")
+    return (reading.sensor_id, f"{reading.temperature:g}", f"{reading.humidity:g}", us_to_iso(reading.ts_us))
+
+
+def reading_key(reading):
+    return reading.sensor_id
+
+
+def reading_tag(reading):
+    if type(reading) is Summary:
+        return "summary"
+    return "anomaly" if reading.flags else ""
+
+
+class HistoryStore:
+    """Fixed-capacity ring of items; the oldest items are overwritten."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def extend(self, items):
+        capacity = self.capacity
+        if len(items) > capacity:
+            items = items[-capacity:]
+        for item in items:
+            end = (self._start + self._len) % capacity
+            self._items[end] = item
+            if self._len < capacity:
+                self._len += 1
+            else:
+                self._start = (self._start + 1) % capacity
+
+    def window(self, offset, count):
+        """Items offset .. offset + count - 1, oldest first."""
+        end = min(offset + count, self._len)
+        return [self._items[(self._start + i) % self.capacity] for i in range(max(offset, 0), end)]
+
+
+class LiveDashboard:
+    """
+    Parameters:
+    root (tk.Tk): the application root, used to schedule repaints.
+    columns (tuple): column headings.
+    row_of (callable): item -> tuple of column values; only called for rows on screen.
+    key_of (callable): item -> sensor key for the "Latest" view.
+    tag_of (callable): optional, item -> Treeview tag name ("" for none).
+    """
+
+    def __init__(self, root, columns, row_of, key_of, tag_of=None,
+                 history=HISTORY_ROWS, visible_rows=VISIBLE_ROWS, fps=FPS):
+        self.root = root
+        self.row_of = row_of
+        self.key_of = key_of
+        self.tag_of = tag_of or (lambda item: "")
+        self.interval = max(1, int(1000 / fps))
+        self.visible_rows = visible_rows
+
+        self._pending = deque()
+        self.history = HistoryStore(history)
+        self._latest = {}
+        self._dirty = set()
+        self._offset = 0
+        self._follow = True
+
+        self.notebook = ttk.Notebook(root)
+
+        # Latest value per sensor
+        self.latest_tree = ttk.Treeview(self.notebook, columns=columns, show="headings")
+        self.notebook.add(self.latest_tree, text="Latest")
+
+        # Virtualised history: a fixed set of rows re-filled from the store
+        history_frame = ttk.Frame(self.notebook)
+        self.history_tree = ttk.Treeview(history_frame, columns=columns, show="headings", height=visible_rows)
+        self.scrollbar = ttk.Scrollbar(history_frame, orient=tk.VERTICAL, command=self._on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.history_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.history_tree.bind("<MouseWheel>", self._on_wheel)
+        self.history_tree.bind("<Button-4>", lambda e: self._scroll_by(-3))
+        self.history_tree.bind("<Button-5>", lambda e: self._scroll_by(3))
+        self._rows = [self.history_tree.insert("", tk.END, values=()) for _ in range(visible_rows)]
+        self.notebook.add(history_frame, text="History")
+
+        for tree in (self.latest_tree, self.history_tree):
+            for col in columns:
+                tree.heading(col, text=col)
+            tree.tag_configure("anomaly", background="lightcoral")
+            tree.tag_configure("summary", background="lightblue")
+
+        self.notebook.bind("<<NotebookTabChanged>>", lambda e: self._render())
+        self.root.after(self.interval, self._repaint)
+
+    def pack(self, **kwargs):
+        self.notebook.pack(**kwargs)
+
+    def tag_configure(self, tag, **options):
+        for tree in (self.latest_tree, self.history_tree):
+            tree.tag_configure(tag, **options)
+
+    # Safe to call from any thread
+    def submit(self, items):
+        if items:
+            self._pending.append(items)
+
+    def _repaint(self):
+        try:
+            batches = []
+            pending = self._pending
+            while pending:
+                batches.append(pending.popleft())
+            if batches:
+                items = batches[0] if len(batches) == 1 else [i for batch in batches for i in batch]
+                key_of = self.key_of
+                for item in items:
+                    key = key_of(item)
+                    self._latest[key] = item
+                    self._dirty.add(key)
+                self.history.extend(items)
+                self._render()
+        finally:
+            self.root.after(self.interval, self._repaint)
+
+    def _render(self):
+        # Only the visible tab is redrawn; the other one catches up when selected
+        if self.notebook.index("current") == 0:
+            self._render_latest()
+        else:
+            self._render_history()
+
+    def _render_latest(self):
+        tree = self.latest_tree
+        for key in self._dirty:
+            item = self._latest[key]
+            iid = str(key)
+            if tree.exists(iid):
+                tree.item(iid, values=self.row_of(item), tags=(self.tag_of(item),))
+            else:
+                tree.insert("", tk.END, iid=iid, values=self.row_of(item), tags=(self.tag_of(item),))
+        self._dirty.clear()
+
+    def _render_history(self):
+        total = len(self.history)
+        last_offset = max(0, total - self.visible_rows)
+        if self._follow or self._offset > last_offset:
+            self._offset = last_offset
+        window = self.history.window(self._offset, self.visible_rows)
+        for iid, item in zip(self._rows, window):
+            self.history_tree.item(iid, values=self.row_of(item), tags=(self.tag_of(item),))
+        for iid in self._rows[len(window):]:
+            self.history_tree.item(iid, values=(), tags=())
+        if total:
+            self.scrollbar.set(self._offset / total, min(1.0, (self._offset + self.visible_rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _scroll_to(self, offset):
+        last_offset = max(0, len(self.history) - self.visible_rows)
+        self._offset = min(max(0, int(offset)), last_offset)
+        self._follow = self._offset >= last_offset
+        self._render_history()
+
+    def _scroll_by(self, rows):
+        self._scroll_to(self._offset + rows)
+
+    def _on_scroll(self, action, value, unit=None):
+        if action == "moveto":
+            self._scroll_to(float(value) * len(self.history))
+        elif action == "scroll":
+            step = self.visible_rows if unit == "pages" else 1
+            self._scroll_by(int(value) * step)
+
+    def _on_wheel(self, event):
+        self._scroll_by(-3 if event.delta > 0 else 3)
+
+
+class BoundedListbox(tk.Listbox):
+    """Listbox that keeps at most max_items lines and accepts lines from any thread."""
+
+    def __init__(self, root, max_items=MAX_ANOMALIES, fps=FPS, **kwargs):
+        super().__init__(root, **kwargs)
+        self.max_items = max_items
+        self.interval = max(1, int(1000 / fps))
+        self._pending = deque()
+        self.after(self.interval, self._repaint)
+
+    # Safe to call from any thread
+    def submit(self, lines):
+        if lines:
+            self._pending.append(lines)
+
+    def _repaint(self):
+        try:
+            lines = []
+            while self._pending:
+                lines.extend(self._pending.popleft())
+            if lines:
+                lines = lines[-self.max_items:]
+                self.insert(tk.END, *lines)
+                overflow = self.size() - self.max_items
+                if overflow > 0:
+                    self.delete(0, overflow - 1)
+                self.see(tk.END)
+        finally:
+            self.after(self.interval, self._repaint)
@@ -1,198 +1,193 @@
 import tkinter as tk
-from tkinter import ttk
-import threading
-import socket
-import json
-import time
 import logging
 import os
+import sys
+
+# Make the shared modules in common/ importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.drone_core import DroneCore
+from common.metrics import metrics, MetricsServer
+from common.logsetup import setup_logging, load_config as load_log_config, DataLogger
+from gui.dashboard import LiveDashboard, BoundedListbox, READING_COLUMNS, reading_row, reading_key, reading_tag
 
 # Drone listens on this port for incoming sensor connections
 DRONE_PORT = 5000
 
+# Number of event loops sharing the sensor connections
+INGEST_WORKERS = 1
+
 # Central server connection details
 CENTRAL_SERVER_IP = "127.0.0.1"
 CENTRAL_SERVER_PORT = 6000
 
-# Buffer to hold incoming sensor data temporarily
-sensor_data_buffer = []
-
-# Setup logging: both to file and console
-os.makedirs("logs", exist_ok=True)
-logging.basicConfig(
-    filename="logs/drone.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+# Capacity of the live buffer (in readings)
+BUFFER_CAPACITY = 100000
+
+# Anomaly thresholds and how often the incoming readings are scored (seconds)
+ANOMALY_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "drone",
+                              "anomaly_config.json")
+DETECT_INTERVAL = 0.2
+
+# Edge reduction applied before forwarding: "raw", "deadband" or "summary"
+EDGE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "drone",
+                           "edge_config.json")
+
+# When buffered data is forwarded (batch size, latency target, anomalies at
+# once) and what each transmission costs the battery
+FLUSH_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "drone",
+                            "flush_config.json")
+
+# Local metrics endpoint (JSON at /metrics); None turns the instrumentation off
+METRICS_PORT = 5100
+
+# Data queued while returning to base is spooled to disk here and replayed in
+# chunks of FLUSH_CHUNK readings once the battery has recovered
+SPOOL_DIR = "spool"
+FLUSH_CHUNK = 5000
+
+# Shared logging settings
+LOG_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logging_config.json")
+
+# How often the battery and status labels are refreshed (milliseconds)
+STATUS_INTERVAL = 500
+
+# Logging goes through a queue to logs/drone.log and the console; per-reading
+# messages are sampled (see common/logsetup.py and logging_config.json)
+setup_logging("drone", load_log_config(LOG_CONFIG))
+
+# Per-reading (data plane) loggers, sampled separately from the control plane
+received_log = DataLogger("data.received")
+forwarded_log = DataLogger("data.forwarded")
+flushed_log = DataLogger("data.flushed")
 
 class DroneGUI:
-    def __init__(self, root):
+    """
+    Tk front end of a DroneCore. The GUI is only a subscriber: event
+    callbacks queue data for the dashboard widgets, which paint it from the
+    Tk thread, and the labels are polled from the Tk thread as well, so a
+    busy GUI never holds up ingest, detection or forwarding.
+    """
+
+    def __init__(self, root, core):
         self.root = root
         self.root.title("Drone Dashboard")
+        self.core = core
 
-        # GUI component to display live sensor data
-        self.tree = ttk.Treeview(root, columns=("Sensor ID", "Temperature", "Humidity", "Timestamp"), show="headings")
-        for col in ("Sensor ID", "Temperature", "Humidity", "Timestamp"):
-            self.tree.heading(col, text=col)
-        self.tree.pack(fill=tk.BOTH, expand=True)
+        # GUI component to display live sensor data; readings are queued by the
+        # worker threads and painted in batches at a fixed frame rate
+        self.dashboard = LiveDashboard(root, READING_COLUMNS, reading_row, reading_key, reading_tag)
+        self.dashboard.pack(fill=tk.BOTH, expand=True)
 
         # Status label to indicate operational state
         self.status_label = tk.Label(root, text="Status: Normal", fg="green")
         self.status_label.pack()
 
-        # Battery simulation parameters
-        self.battery_level = 100.0
-        self.returning_to_base = False
-        self.queued_data = []
-
         # Battery level indicator
-        self.battery_label = tk.Label(root, text=f"Battery: {self.battery_level:.1f}%", fg="blue")
+        self.battery_label = tk.Label(root, text=f"Battery: {core.battery_level:.1f}%", fg="blue")
         self.battery_label.pack()
 
         # Anomaly list label and component
         self.anomaly_list_label = tk.Label(root, text="Anomalies", fg="darkred")
         self.anomaly_list_label.pack()
 
-        self.anomaly_listbox = tk.Listbox(root, height=6)
+        self.anomaly_listbox = BoundedListbox(root, height=6)
         self.anomaly_listbox.pack(fill=tk.BOTH, expand=True)
 
-        # Start threads for TCP server, data forwarding, and battery drain
-        threading.Thread(target=self.start_server, daemon=True).start()
-        threading.Thread(target=self.forward_to_central, daemon=True).start()
-        threading.Thread(target=self.battery_drain_loop, daemon=True).start()
-
-    # Detect anomalies based on predefined thresholds
-    def is_anomaly(self, data):
-        temp = data.get("temperature")
-        hum = data.get("humidity")
-        anomalies = []
-
-        if temp is not None:
-            if temp > 60.0 or temp < -10.0:
-                anomalies.append(f"Temperature anomaly: {temp}°C")
-        if hum is not None:
-            if hum > 90.0 or hum < 10.0:
-                anomalies.append(f"Humidity anomaly: {hum}%")
-
-        return anomalies
-
-    # Simulate battery consumption over time
-    def battery_drain_loop(self):
-        while True:
-            time.sleep(5)
-            self.battery_level -= 1.0
-            if self.battery_level < 0:
-                self.battery_level = 0
-            self.root.after(0, self.update_battery_label)
-
-            # Enter low battery mode
-            if self.battery_level < 20.0 and not self.returning_to_base:
-                self.returning_to_base = True
-                logging.warning("Battery low! Returning to base.")
-                self.root.after(0, lambda: self.status_label.config(text="Status: Returning to Base", fg="red"))
-
-            # Restore to normal if battery recharges
-            elif self.battery_level >= 90.0 and self.returning_to_base:
-                self.returning_to_base = False
-                logging.info("Battery restored! Resuming normal operation.")
-                self.root.after(0, lambda: self.status_label.config(text="Status: Normal", fg="green"))
-                self.flush_queued_data()
-
-    # Send queued data to server after battery recovers
-    def flush_queued_data(self):
-        try:
-            with socket.create_connection((CENTRAL_SERVER_IP, CENTRAL_SERVER_PORT)) as central_sock:
-                for data in self.queued_data:
-                    central_sock.sendall(json.dumps(data).encode() + b"\n")
-                    logging.info(f"[QUEUE-FLUSH] Sent: {data}")
-                self.queued_data.clear()
-        except Exception as e:
-            logging.error(f"Flush failed: {e}")
-
-    # Update battery level on the GUI
-    def update_battery_label(self):
-        self.battery_label.config(text=f"Battery: {self.battery_level:.1f}%")
-
-    # Start TCP server to accept sensor connections
-    def start_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-            server_socket.bind(("", DRONE_PORT))
-            server_socket.listen()
-            logging.info(f"Drone listening for sensors on port {DRONE_PORT}")
-            while True:
-                conn, addr = server_socket.accept()
-                threading.Thread(target=self.handle_sensor, args=(conn, addr), daemon=True).start()
-
-    # Handle incoming data from each connected sensor
-    def handle_sensor(self, conn, addr):
-        with conn:
-            logging.info(f"Sensor connected from {addr}")
-            buffer = b""
-            while True:
-                try:
-                    chunk = conn.recv(1024)
-                    if not chunk:
-                        raise ConnectionResetError("Sensor disconnected cleanly.")
-                    buffer += chunk
-                    while b"\n" in buffer:
-                        line, buffer = buffer.split(b"\n", 1)
-
-                        # If battery is dead, drop incoming data
-                        if self.battery_level <= 0:
-                            logging.warning("Battery depleted. Dropping incoming data.")
-                            continue
-
-                        data = json.loads(line.decode())
-                        self.root.after(0, self.update_gui, data)
-
-                        # Check for anomalies
-                        anomalies = self.is_anomaly(data)
-                        if anomalies:
-                            for a in anomalies:
-                                msg = f"[ANOMALY] {data['sensor_id']} - {a}"
-                                self.root.after(0, self.anomaly_listbox.insert, tk.END, msg)
-                                logging.warning(msg)
-                            data["anomaly"] = anomalies
-
-                        sensor_data_buffer.append(data)
-                        logging.info(f"Received data: {data}")
-                except Exception as e:
-                    msg = f"[DISCONNECT] Sensor at {addr} disconnected: {e}"
-                    self.root.after(0, self.anomaly_listbox.insert, tk.END, msg)
-                    logging.warning(msg)
-                    break
-
-    # Add new row to GUI table
-    def update_gui(self, data):
-        self.tree.insert("", tk.END, values=(data["sensor_id"], data["temperature"], data["humidity"], data["timestamp"]))
-
-    # Periodically forward buffered sensor data to the central server
-    def forward_to_central(self):
-        while True:
-            if sensor_data_buffer:
-                if self.returning_to_base:
-                    # Queue data while returning to base
-                    self.queued_data.extend(sensor_data_buffer)
-                    logging.warning(f"[QUEUE] Queued {len(sensor_data_buffer)} items during low battery.")
-                    sensor_data_buffer.clear()
-                else:
-                    try:
-                        with socket.create_connection((CENTRAL_SERVER_IP, CENTRAL_SERVER_PORT)) as central_sock:
-                            for data in sensor_data_buffer:
-                                central_sock.sendall(json.dumps(data).encode() + b"\n")
-                                logging.info(f"Forwarded to Central Server: {data}")
-                            sensor_data_buffer.clear()
-                    except Exception as e:
-                        logging.error(f"Could not connect to Central Server: {e}")
-            time.sleep(5)
+        core.subscribe("connect", self.on_sensor_connect)
+        core.subscribe("disconnect", self.on_sensor_disconnect)
+        core.subscribe("readings", self.on_readings)
+        core.subscribe("anomalies", self.on_anomalies)
+        core.subscribe("status", self.on_status)
+        core.subscribe("forwarded", self.on_forwarded)
+        core.subscribe("undelivered", self.on_undelivered)
+        core.subscribe("queued", self.on_queued)
+        core.subscribe("flushed", self.on_flushed)
+        core.subscribe("flush_failed", self.on_flush_failed)
+        core.subscribe("dropped", self.on_dropped)
+        core.subscribe("depleted", self.on_depleted)
+        core.subscribe("stats", self.on_stats)
+
+        self.root.after(STATUS_INTERVAL, self.refresh_status)
+
+    # Runs on the Tk thread; the core's state is read, never written
+    def refresh_status(self):
+        self.battery_label.config(text=f"Battery: {self.core.battery_level:.1f}%")
+        if self.core.returning_to_base:
+            self.status_label.config(text="Status: Returning to Base", fg="red")
+        else:
+            self.status_label.config(text="Status: Normal", fg="green")
+        self.root.after(STATUS_INTERVAL, self.refresh_status)
+
+    # Event callbacks below run on the core's threads: queue and log only
+    def on_sensor_connect(self, addr):
+        logging.info(f"Sensor connected from {addr}")
+
+    def on_sensor_disconnect(self, addr, reason):
+        msg = f"[DISCONNECT] Sensor at {addr} disconnected: {reason}"
+        self.anomaly_listbox.submit([msg])
+        logging.warning(msg)
+
+    def on_readings(self, readings):
+        for reading in readings:
+            received_log.info("Received data: %s", reading)
+        self.dashboard.submit(readings)
+
+    def on_anomalies(self, alerts):
+        for msg in alerts:
+            logging.warning(msg)
+        self.anomaly_listbox.submit(alerts)
+
+    def on_status(self, returning_to_base):
+        if returning_to_base:
+            logging.warning("Battery low! Returning to base.")
+        else:
+            logging.info("Battery restored! Resuming normal operation.")
+
+    def on_forwarded(self, records):
+        for record in records:
+            forwarded_log.info("Forwarded to Central Server: %s", record)
+
+    def on_undelivered(self, count):
+        logging.error(f"Could not deliver {count} items to Central Server, will retry.")
+
+    def on_queued(self, count):
+        logging.warning(f"[QUEUE] Queued {count} items during low battery.")
+
+    def on_flushed(self, records):
+        for reading in records:
+            flushed_log.info("[QUEUE-FLUSH] Sent: %s", reading)
+        logging.info(f"[QUEUE-FLUSH] Flushed {len(records)} queued items.")
+
+    def on_flush_failed(self, flushed):
+        logging.error(f"Flush failed after {flushed} items, the rest stays spooled.")
+
+    def on_dropped(self, drops):
+        logging.warning(f"Buffers full, {drops} readings dropped so far.")
+
+    def on_depleted(self, refused):
+        logging.warning(f"Battery depleted. {refused} incoming readings dropped so far.")
+
+    def on_stats(self, stats):
+        if stats["anomaly"]:
+            logging.info(f"Anomaly scoring: {stats['anomaly']}")
+        if stats["edge"]["readings_in"]:
+            logging.info(f"Edge reduction: {stats['edge']}")
 
 # Entry point to launch the Drone GUI
 if __name__ == "__main__":
+    core = DroneCore(DRONE_PORT, CENTRAL_SERVER_IP, CENTRAL_SERVER_PORT, workers=INGEST_WORKERS,
+                     buffer_capacity=BUFFER_CAPACITY, anomaly_config=ANOMALY_CONFIG, edge_config=EDGE_CONFIG,
+                     flush_config=FLUSH_CONFIG, spool_dir=SPOOL_DIR, flush_chunk=FLUSH_CHUNK,
+                     detect_interval=DETECT_INTERVAL)
     root = tk.Tk()
-    app = DroneGUI(root)
+    app = DroneGUI(root, core)
+    if METRICS_PORT:
+        MetricsServer(metrics, METRICS_PORT).start()
+        logging.info(f"Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    else:
+        metrics.enabled = False
+    core.start()
+    logging.info(f"Drone listening for sensors on port {DRONE_PORT}")
     root.mainloop()
+    core.stop()
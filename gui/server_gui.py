@@ -1,50 +1,130 @@
 import tkinter as tk
-from tkinter import ttk
 import threading
 import socket
-import json
 import logging
+import time
 import os
+import sys
+
+# Make the shared modules in common/ importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.uplink import serve_uplink
+from common.protocol import Summary, anomaly_messages
+from common.tsdb import TimeSeriesStore
+from common.query import QueryEngine, QueryServer, parse_duration
+from common.metrics import metrics, MetricsServer
+from common.workers import WorkerPool
+from common.sequence import SequenceIndex, persist_periodically
+from common.feed import LiveFeed, FeedServer
+from common.stream import StreamProcessor
+from common.logsetup import setup_logging, load_config as load_log_config, DataLogger
+from gui.dashboard import LiveDashboard, BoundedListbox, READING_COLUMNS, reading_row, reading_key, reading_tag
 
 # TCP port for incoming drone data
 CENTRAL_PORT = 6000
 
-# Logging configuration: file + console output
-os.makedirs("logs", exist_ok=True)
-logging.basicConfig(
-    filename="logs/server.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+# Time-series store for every received reading
+DATA_DIR = "data"
+
+# Local HTTP query API (range, latest and aggregate queries)
+QUERY_PORT = 6100
+
+# Local metrics endpoint (JSON at /metrics); None turns the instrumentation off
+METRICS_PORT = 6200
+
+# Live feed of received records for other viewers (see common/feed.py); None turns it off
+FEED_PORT = 6300
+
+# Processes serving CENTRAL_PORT. With more than one, every worker decodes
+# and stores its own drones' batches in WORKERS_DATA_DIR/worker-<i> and the
+# dashboard shows the merged result (see common/workers.py)
+SERVER_WORKERS = 1
+WORKERS_DATA_DIR = "data_workers"
+
+# Event-time stage (see common/stream.py): records are put back in timestamp
+# order across drones, up to STREAM_DELAY behind each drone's newest
+# reading, and per-sensor aggregates over STREAM_WINDOWS ((size, slide),
+# slide None for tumbling windows) are logged once the watermark has passed
+# their end by STREAM_LATENESS. The dashboard shows every reading as soon
+# as it is stored, late ones included
+STREAM_WINDOWS = (("1m", None), ("5m", "1m"))
+STREAM_DELAY = "2s"
+STREAM_LATENESS = "10s"
+
+# Shared logging settings
+LOG_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logging_config.json")
+
+# Per-reading (data plane) logger, sampled separately from the control plane
+received_log = DataLogger("data.received")
 
 class ServerGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Central Server Dashboard")
 
-        # Create a Treeview widget to display incoming sensor data
-        self.tree = ttk.Treeview(root, columns=("Sensor ID", "Temperature", "Humidity", "Timestamp"), show="headings")
-        for col in ("Sensor ID", "Temperature", "Humidity", "Timestamp"):
-            self.tree.heading(col, text=col)
+        # Every received reading is stored on disk; rows are flushed and
+        # fsynced in the background about once a second
+        self.pool = None
+        self.sequences = None
+        if SERVER_WORKERS > 1:
+            self.pool = WorkerPool(CENTRAL_PORT, SERVER_WORKERS, WORKERS_DATA_DIR, on_records=self.show_records,
+                                   on_connect=self.worker_connected, on_disconnect=self.worker_disconnected)
+            self.store, self.queries, self.sequences = self.pool.store, self.pool.queries, self.pool.sequences
+        else:
+            self.store = TimeSeriesStore(DATA_DIR)
+            self.queries = QueryEngine(self.store)
+            # Sequence numbers already stored, to drop records a drone sends again
+            self.sequences = SequenceIndex(os.path.join(DATA_DIR, "sequence.json"))
+            persist_periodically(self.sequences, self.store)
 
-        # Tag to highlight anomalous rows in red
-        self.tree.tag_configure("anomaly", background="lightcoral")
-        self.tree.pack(fill=tk.BOTH, expand=True)
+        # Live view of incoming sensor data (latest value per sensor plus a
+        # bounded, scrollable history), repainted in batches at a fixed frame rate.
+        # Anomalous rows are highlighted in red.
+        self.dashboard = LiveDashboard(root, READING_COLUMNS, reading_row, reading_key, reading_tag)
+        self.dashboard.pack(fill=tk.BOTH, expand=True)
+        self.stream = StreamProcessor(
+            [(parse_duration(size), slide and parse_duration(slide)) for size, slide in STREAM_WINDOWS],
+            parse_duration(STREAM_DELAY), parse_duration(STREAM_LATENESS), on_windows=self.show_windows)
 
         # Label and Listbox to display detected anomalies separately
         self.anomaly_label = tk.Label(root, text="Anomalies", fg="darkred")
         self.anomaly_label.pack(pady=(10, 0))  # spacing above the label
 
-        self.anomaly_listbox = tk.Listbox(root, height=6)
+        self.anomaly_listbox = BoundedListbox(root, height=6)
         self.anomaly_listbox.pack(fill=tk.BOTH, expand=True)
 
-        # Start the TCP server thread to listen for Drone connections
-        threading.Thread(target=self.start_server, daemon=True).start()
+        # Answer range/latest/aggregate queries over HTTP
+        QueryServer(self.queries, QUERY_PORT).start()
+        logging.info(f"Query API on http://127.0.0.1:{QUERY_PORT}")
+
+        # Stream every stored batch to other dashboards
+        self.feed = LiveFeed()
+        if FEED_PORT:
+            FeedServer(self.feed, FEED_PORT).start()
+            logging.info(f"Live feed on http://127.0.0.1:{FEED_PORT}/feed")
+
+        # Counters and per-hop latency histograms (see common/metrics.py)
+        if METRICS_PORT:
+            metrics.gauge("store", self.store.stats)
+            metrics.gauge("feed", self.feed.stats)
+            metrics.gauge("stream", self.stream.stats)
+            if self.sequences is not None:
+                metrics.gauge("sequences", self.sequences.stats)
+            if self.pool is not None:
+                metrics.gauge("workers", self.pool.stats)
+            MetricsServer(metrics, METRICS_PORT).start()
+            logging.info(f"Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+        else:
+            metrics.enabled = False
+
+        # Start the TCP server thread to listen for Drone connections, or
+        # the worker processes that do it
+        if self.pool is not None:
+            self.pool.start()
+            logging.info(f"Central Server listening on port {CENTRAL_PORT} with {SERVER_WORKERS} worker processes")
+        else:
+            threading.Thread(target=self.start_server, daemon=True).start()
 
     # TCP server to listen for connections from the drone
     def start_server(self):
@@ -56,49 +136,77 @@ class ServerGUI:
                 conn, addr = server_socket.accept()
                 threading.Thread(target=self.handle_drone, args=(conn, addr), daemon=True).start()
 
-    # Handle data from a connected drone client
+    # Handle data from a connected drone client; the connection stays open
+    # and every batch is acknowledged after it has been processed
     def handle_drone(self, conn, addr):
         with conn:
             logging.info(f"Drone connected from {addr}")
-            buffer = b""
-            while True:
-                try:
-                    chunk = conn.recv(1024)
-                    if not chunk:
-                        break  # connection closed
-                    buffer += chunk
-                    while b"\n" in buffer:
-                        line, buffer = buffer.split(b"\n", 1)
-                        data = json.loads(line.decode())
-
-                        # GUI update must be done in the main thread
-                        self.root.after(0, self.update_gui, data)
-                        logging.info(f"Received data from Drone: {data}")
-                except Exception as e:
-                    logging.error(f"Connection error with Drone: {e}")
-                    break
-
-    # Update GUI with new data and mark anomalies
-    def update_gui(self, data):
-        tag = "anomaly" if "anomaly" in data else ""
-
-        # Insert sensor data into the main table
-        self.tree.insert("", tk.END, values=(
-            data.get("sensor_id", ""),
-            data.get("temperature", ""),
-            data.get("humidity", ""),
-            data.get("timestamp", "")
-        ), tags=(tag,))
-
-        # If anomaly detected, log and display it in the anomaly listbox
-        if "anomaly" in data:
-            for a in data["anomaly"]:
-                msg = f"[ANOMALY] {data['sensor_id']} - {a}"
-                self.anomaly_listbox.insert(tk.END, msg)
+            try:
+                serve_uplink(conn, lambda records: self.handle_records(records, addr), sequences=self.sequences)
+            except Exception as e:
+                logging.error(f"Connection error with Drone: {e}")
+            self.stream.disconnect(addr)
+            logging.info(f"Drone disconnected from {addr}")
+
+    # Process one batch of records received from the drone: raw readings
+    # and, when the drone reduces data at the edge, window summaries.
+    # source is the drone's address
+    def handle_records(self, records, source=None):
+        metrics.observe_ages("age.central_received", records)
+        started = time.perf_counter()
+        self.queries.write(records)
+        metrics.observe("stage.store_write", (time.perf_counter() - started) * 1000000)
+        self.show_records(records, source)
+
+    # Log and display one stored batch; with worker processes the pool
+    # calls this for every batch a worker stored. source is the drone's
+    # address
+    def show_records(self, records, source=None):
+        if self.pool is not None:
+            metrics.observe_ages("age.central_received", records)
+        self.feed.publish(records)
+        alerts = []
+        for record in records:
+            if type(record) is Summary:
+                received_log.info("Received summary from Drone: %s", record)
+                continue
+            received_log.info("Received data from Drone: %s", record)
+            # If anomaly detected, log and display it in the anomaly listbox
+            for a in anomaly_messages(record):
+                msg = f"[ANOMALY] {record.sensor_id} - {a}"
+                alerts.append(msg)
                 logging.warning(msg)
+        # The GUI repaints from these queues on the main thread; the stream
+        # stage only feeds the window aggregates
+        self.dashboard.submit(records)
+        self.anomaly_listbox.submit(alerts)
+        self.stream.submit(records, source)
+
+    # Log the window aggregates the stream stage closed
+    def show_windows(self, size_us, slide_us, summaries):
+        for summary in summaries:
+            received_log.info("Window of %ds every %ds: %s", size_us // 1000000, slide_us // 1000000, summary)
+
+    def worker_connected(self, addr, worker):
+        logging.info(f"Drone connected from {addr} (worker {worker})")
+
+    def worker_disconnected(self, addr, worker, reason):
+        if reason:
+            logging.error(f"Connection error with Drone: {reason}")
+        self.stream.disconnect(addr)
+        logging.info(f"Drone disconnected from {addr}")
 
 # Start the application
 if __name__ == "__main__":
+    # Logging goes through a queue to logs/server.log and the console; per-reading
+    # messages are sampled (see common/logsetup.py and logging_config.json)
+    setup_logging("server", load_log_config(LOG_CONFIG))
     root = tk.Tk()
     app = ServerGUI(root)
     root.mainloop()
+    app.stream.close()
+    if app.pool is not None:
+        app.pool.stop()  # Workers flush their stores before exiting
+    else:
+        app.store.close()
+        app.sequences.save()
@@ -0,0 +1,181 @@
+"""
+Replay recorded sensor traffic into the drone.
+
+Sources are sensor or drone logs (the "Sent:" / "Received data:" lines,
+text or JSONL) and pcapng captures of sensor -> drone traffic; see
+common/recordings.py. Files are read as streams and merged by time, so
+large recordings are never loaded whole. Every recorded sensor gets its own
+connection to the drone, like the real sensor did.
+
+Pacing:
+--speed 1      original pace (default)
+--speed 10     ten times faster
+--speed 0      as fast as the drone accepts
+--max-gap 5    shorten idle periods (e.g. between recording sessions) to 5 s
+
+--copies N replays every sensor N times over N connections (as
+<sensor_id>-0 ... <sensor_id>-N-1) to scale a recording up. Readings get
+the replay time as their timestamp, keeping the recorded spacing, unless
+--keep-timestamps is given. Above --speed 1 the replayed timestamps are
+closer together than recorded, so the drone's rate-of-change rule sees
+faster changes; --keep-timestamps scores the recorded spacing instead.
+
+Usage:
+python sensor/replay.py gui/logs/drone.log --speed 10
+python sensor/replay.py sensor/logs/sensor1.log sensor/logs/sensor2.log --max-gap 5
+python sensor/replay.py wireshark/wireshark_data.pcapng --speed 0 --copies 200 --protocol binary
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+# Make the shared modules in common/ importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import BinaryEncoder, ProtocolError, negotiate, reading_to_dict
+from common.recordings import DRONE_PORT, ReadErrors, read_source, merge
+
+# Pending bytes per connection before the replay waits for the socket to drain
+HIGH_WATER = 64 * 1024
+
+# At full speed, let the event loop run after this many readings
+YIELD_EVERY = 256
+
+
+class Replay:
+    def __init__(self, args):
+        self.args = args
+        self.connections = {}
+        self.sent = 0
+        self.connects = 0
+        self.failures = 0
+        self.max_lag = 0.0
+
+    def _open(self):
+        # Blocking connect and handshake; runs in the default executor
+        args = self.args
+        sock = socket.create_connection((args.drone_ip, args.drone_port))
+        encoder = None
+        if args.protocol != "json":
+            try:
+                if negotiate(sock):
+                    encoder = BinaryEncoder()
+            except ProtocolError:
+                if args.protocol == "binary":
+                    sock.close()
+                    raise
+                sock.close()
+                sock = socket.create_connection((args.drone_ip, args.drone_port))
+        sock.setblocking(False)
+        return sock, encoder
+
+    async def connection(self, sensor_id):
+        conn = self.connections.get(sensor_id)
+        if conn is None:
+            sock, encoder = await asyncio.get_running_loop().run_in_executor(None, self._open)
+            _reader, writer = await asyncio.open_connection(sock=sock)
+            conn = self.connections[sensor_id] = (writer, encoder)
+            self.connects += 1
+        return conn
+
+    async def send(self, reading):
+        try:
+            writer, encoder = await self.connection(reading.sensor_id)
+            if encoder is not None:
+                writer.write(encoder.encode([reading]))
+            else:
+                writer.write(json.dumps(reading_to_dict(reading)).encode() + b"\n")
+            if writer.transport.get_write_buffer_size() > HIGH_WATER:
+                await writer.drain()
+        except OSError as e:
+            if not self.connects:
+                raise  # the drone is not there at all
+            # Reconnect on the sensor's next reading
+            self.failures += 1
+            conn = self.connections.pop(reading.sensor_id, None)
+            if conn is not None:
+                conn[0].close()
+            print(f"[REPLAY] {reading.sensor_id}: {e}")
+            return
+        self.sent += 1
+
+    async def run(self, stream):
+        args = self.args
+        speed = args.speed
+        max_gap_us = int(args.max_gap * 1000000) if args.max_gap else None
+        first = previous = None
+        skipped_us = 0
+        start = time.monotonic()
+        for n, (time_us, reading) in enumerate(stream):
+            if first is None:
+                first = previous = time_us
+            if max_gap_us is not None and time_us - previous > max_gap_us:
+                skipped_us += time_us - previous - max_gap_us
+            previous = max(previous, time_us)
+            if speed:
+                due = start + (time_us - first - skipped_us) / 1000000 / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+            elif n % YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+            # Readings go out as the sensor sent them: fresh timestamp, no drone flags
+            if args.keep_timestamps:
+                reading = reading._replace(flags=0)
+            else:
+                reading = reading._replace(ts_us=int(time.time() * 1000000), flags=0)
+            if args.copies == 1:
+                await self.send(reading)
+            else:
+                for k in range(args.copies):
+                    await self.send(reading._replace(sensor_id=f"{reading.sensor_id}-{k}"))
+        for writer, _encoder in self.connections.values():
+            try:
+                await writer.drain()
+            except OSError:
+                pass
+            writer.close()
+        return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded sensor traffic into the drone")
+    parser.add_argument("sources", nargs="+", help="log files and/or pcapng captures")
+    parser.add_argument("--drone_ip", type=str, default="127.0.0.1")
+    parser.add_argument("--drone_port", type=int, default=DRONE_PORT)
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = original pace, N = N times faster, 0 = max")
+    parser.add_argument("--max-gap", type=float, default=None, help="shorten idle periods to this many seconds")
+    parser.add_argument("--copies", type=int, default=1, help="replay every sensor this many times")
+    parser.add_argument("--protocol", choices=["auto", "binary", "json"], default="auto")
+    parser.add_argument("--capture-port", type=int, default=DRONE_PORT, help="drone port in the pcapng captures")
+    parser.add_argument("--keep-timestamps", action="store_true", help="send the recorded timestamps")
+    args = parser.parse_args()
+
+    errors = ReadErrors()
+    stream = merge([read_source(path, args.capture_port, errors) for path in args.sources])
+    replay = Replay(args)
+    try:
+        elapsed = asyncio.run(replay.run(stream))
+    except KeyboardInterrupt:
+        elapsed = None
+    except OSError as e:
+        sys.exit(f"[REPLAY] Cannot reach the drone at {args.drone_ip}:{args.drone_port}: {e}")
+
+    print(f"[REPLAY] Sent {replay.sent} readings over {replay.connects} connections"
+          + (f" in {elapsed:.1f}s ({replay.sent / elapsed:,.0f}/s)" if elapsed else ""))
+    if args.speed:
+        print(f"[REPLAY] Fell behind the schedule by at most {replay.max_lag * 1000:.0f} ms")
+    if replay.failures:
+        print(f"[REPLAY] {replay.failures} readings could not be sent")
+    if errors.skipped:
+        print(f"[REPLAY] Skipped {errors.skipped} unreadable records (last: {errors.last})")
+
+
+if __name__ == "__main__":
+    main()
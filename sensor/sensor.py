@@ -3,74 +3,133 @@ import json
 import time
 import argparse
 import logging
-from datetime import datetime, timezone, timedelta
+import threading
 import os
+import sys
 
-# Create logs directory if it doesn't exist
-os.makedirs("logs", exist_ok=True)
+# Make the shared modules in common/ importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import BinaryEncoder, ProtocolError, negotiate, reading_from_dict
+from common.logsetup import setup_logging, load_config as load_log_config, DataLogger
+from common.metrics import metrics, dump_periodically
+from common import simulator
+
+# Shared logging settings
+LOG_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logging_config.json")
 
 # Command-line arguments to configure sensor behavior
 parser = argparse.ArgumentParser()
 parser.add_argument("--drone_ip", type=str, default="127.0.0.1")  # IP of the drone
 parser.add_argument("--drone_port", type=int, default=5000)       # Port the drone listens on
-parser.add_argument("--interval", type=int, default=2)            # Time interval between messages
+parser.add_argument("--interval", type=float, default=2)          # Time interval between messages
 parser.add_argument("--sensor_id", type=str, default="sensor1")   # Unique ID of this sensor
+parser.add_argument("--profile", choices=sorted(simulator.PROFILES), default="normal")  # Normal or anomalous readings
+parser.add_argument("--protocol", choices=["auto", "binary", "json"], default="auto")  # Wire format to the drone
+parser.add_argument("--metrics_interval", type=float, default=10)  # Seconds between metrics dumps (0 = off)
+# Field mode: one process simulates many sensors (see run_field below)
+parser.add_argument("--sensors", type=str, default=None)          # Sensor ids, e.g. sensor1-5000, a,b,c or @ids.txt
+parser.add_argument("--anomaly_sensors", type=str, default="")    # Sensors of the field that use the anomaly profile
+parser.add_argument("--connections", type=int, default=1)         # Drone connections shared by the field's sensors
+parser.add_argument("--jitter", type=float, default=0.1)          # Random +- fraction of every interval
+parser.add_argument("--nagle", action="store_true")               # Leave Nagle's algorithm on (no TCP_NODELAY)
 args, unknown = parser.parse_known_args()
 
-# Configure logging for this specific sensor
-logging.basicConfig(
-    filename=f"logs/{args.sensor_id}.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+sensor_ids = simulator.parse_sensor_ids(args.sensors) if args.sensors else None
+log_name = f"field-{sensor_ids[0]}" if sensor_ids else args.sensor_id
 
-# --- SENSOR DATA GENERATION FUNCTIONS ---
+# Configure logging for this specific sensor: queued writes to logs/<sensor_id>.log
+# (logs/field-<first id>.log in field mode) and the console, with the
+# per-message "Sent" lines sampled (see logging_config.json)
+setup_logging(log_name, load_log_config(LOG_CONFIG))
+sent_log = DataLogger("data.sent")
 
-# ❗ For anomaly testing (comment this in for testing anomalies)
-def get_sensor_data(sensor_id):
-    turkey_tz = timezone(timedelta(hours=3))  # Use UTC+3 timezone (Turkey time)
-    return {
-        "sensor_id": sensor_id,
-        "temperature": 100.0,      # Anomalous high temperature
-        "humidity": 85.0,          # Still within normal humidity
-        "timestamp": datetime.now(turkey_tz).isoformat()
-    }
+# Seconds between the field's throughput reports
+FIELD_REPORT_INTERVAL = 10
+
+# --- SENSOR DATA GENERATION ---
 
-"""
-# ✅ For normal operation (use this instead of above for non-anomaly test)
+# Readings follow the profile chosen with --profile: "normal" values, or an
+# "anomaly" (100 C) for testing the drone's anomaly detection (see common/simulator.py)
 def get_sensor_data(sensor_id):
-    turkey_tz = timezone(timedelta(hours=3))  # Use UTC+3 timezone (Turkey time)
-    return {
-        "sensor_id": sensor_id,
-        "temperature": round(20 + 5 * (0.5 - time.time() % 1), 2),  # Simulate small variation
-        "humidity": round(50 + 10 * (0.5 - time.time() % 1), 2),
-        "timestamp": datetime.now(turkey_tz).isoformat()
-    }
-"""
+    return simulator.get_sensor_data(sensor_id, args.profile)
 
 # --- MAIN FUNCTION ---
 
 def main():
+    # "auto" tries the binary handshake and falls back to JSON lines for drones that don't answer it
+    use_binary = args.protocol != "json"
+    # Counters and send latency are written to logs/<sensor_id>.metrics.json
+    if args.metrics_interval:
+        dump_periodically(metrics, f"logs/{log_name}.metrics.json", args.metrics_interval)
+    else:
+        metrics.enabled = False
+    if sensor_ids:
+        run_field()
+        return
     while True:
         try:
             # Try to connect to the drone
             with socket.create_connection((args.drone_ip, args.drone_port)) as sock:
-                logging.info(f"Connected to Drone at {args.drone_ip}:{args.drone_port}")
+                encoder = None
+                if use_binary:
+                    try:
+                        if negotiate(sock):
+                            encoder = BinaryEncoder()
+                    except ProtocolError as e:
+                        if args.protocol == "binary":
+                            raise
+                        logging.warning(f"{e}, switching to JSON")
+                        use_binary = False
+                        continue
+                metrics.inc("sensor.connects")
+                logging.info(f"Connected to Drone at {args.drone_ip}:{args.drone_port} "
+                             f"({'binary' if encoder else 'JSON'})")
                 while True:
                     # Generate and send sensor data
                     data = get_sensor_data(args.sensor_id)
-                    sock.sendall(json.dumps(data).encode() + b"\n")
-                    logging.info(f"Sent: {data}")
+                    if encoder:
+                        message = encoder.encode([reading_from_dict(data)])
+                    else:
+                        message = json.dumps(data).encode() + b"\n"
+                    started = time.perf_counter()
+                    sock.sendall(message)
+                    metrics.observe("stage.sensor_send", (time.perf_counter() - started) * 1000000)
+                    metrics.inc("sensor.sent")
+                    metrics.inc("sensor.sent_bytes", len(message))
+                    sent_log.info("Sent: %s", data)
                     time.sleep(args.interval)
         except Exception as e:
+            metrics.inc("sensor.connection_errors")
             logging.error(f"Connection failed: {e}, retrying in 5 seconds...")
             time.sleep(5)
 
+def log_sent(readings):
+    for reading in readings:
+        sent_log.info("Sent: %s", reading)
+
+def run_field():
+    """
+    Simulate every sensor of --sensors in this process: a timer wheel
+    schedules each sensor's readings, and the sensors share --connections
+    connections with one batched write per connection and tick.
+    """
+    profiles = {s: "anomaly" for s in simulator.parse_sensor_ids(args.anomaly_sensors)}
+    field = simulator.SensorField(sensor_ids, args.drone_ip, args.drone_port, interval=args.interval,
+                                  jitter=args.jitter, connections=args.connections, profile=args.profile,
+                                  profiles=profiles, protocol=args.protocol, nagle=args.nagle, on_sent=log_sent)
+    logging.info(f"Simulating {len(sensor_ids)} sensors every {args.interval:g}s over "
+                 f"{len(field.links)} connections ({len(profiles)} with the anomaly profile)")
+    threading.Thread(target=field.run, name="field", daemon=True).start()
+    sent = 0
+    while True:
+        time.sleep(FIELD_REPORT_INTERVAL)
+        stats = field.stats()
+        logging.info(f"{(stats['sent'] - sent) / FIELD_REPORT_INTERVAL:.0f} readings/s, "
+                     f"{stats['connections']} connections up, {stats['dropped']} dropped, "
+                     f"max lag {stats['max_lag_ms']} ms")
+        sent = stats["sent"]
+
 # Entry point
 if __name__ == "__main__":
     main()
@@ -1,8 +1,55 @@
+import argparse
 import socket
 import threading
-import json
+import time
+import os
+import sys
+
+# Make the shared modules in common/ importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.uplink import serve_uplink
+from common.protocol import Summary
+from common.tsdb import TimeSeriesStore
+from common.query import QueryEngine, QueryServer, parse_duration
+from common.metrics import metrics, MetricsServer
+from common.workers import WorkerPool
+from common.sequence import SequenceIndex, persist_periodically
+from common.feed import LiveFeed, FeedServer
+from common.stream import StreamProcessor
 
 CENTRAL_PORT = 6000  # Port number on which the central server listens for drone connections
+DATA_DIR = "data"    # Time-series store for every received reading
+QUERY_PORT = 6100    # Local HTTP query API (range, latest and aggregate queries)
+METRICS_PORT = 6200  # Local metrics endpoint (JSON at /metrics); None turns the instrumentation off
+FEED_PORT = 6300     # Live feed of received records for other viewers (see common/feed.py); None turns it off
+
+# Processes serving CENTRAL_PORT (--workers). With 1 everything runs in this
+# process; with more, every worker decodes and stores its own drones'
+# batches in WORKERS_DATA_DIR/worker-<i> (see common/workers.py)
+WORKERS = 1
+WORKERS_DATA_DIR = "data_workers"
+
+# Event-time stage after decoding (see common/stream.py): records are put
+# back in timestamp order across drones, waiting up to STREAM_DELAY behind
+# each drone's newest record, and aggregated per sensor over STREAM_WINDOWS,
+# (size, slide) pairs with slide None for tumbling windows. A window is
+# printed once the watermark has passed its end by STREAM_LATENESS
+STREAM_WINDOWS = (("1m", None), ("5m", "1m"))
+STREAM_DELAY = "2s"
+STREAM_LATENESS = "10s"
+
+# Set up by central_server(). Rows are flushed and fsynced in the background
+# about once a second; the query engine keeps rollups and cached results up
+# to date as they arrive. The sequence index (saved next to the rows, in
+# DATA_DIR or WORKERS_DATA_DIR) drops records a drone sends again and tells
+# reconnecting drones what not to resend. Every stored batch is published to
+# the live feed's subscribers and goes through the event-time stage
+store = None
+queries = None
+sequences = None
+feed = None
+stream = None
 
 def handle_drone_connection(conn, addr):
     """
@@ -14,29 +61,132 @@ def handle_drone_connection(conn, addr):
     """
     with conn:
         print(f"[CENTRAL] Drone connected from {addr}")
-        buffer = b""  # Buffer to accumulate incoming bytes until a full JSON message is received
-        while True:
-            try:
-                chunk = conn.recv(1024)  # Receive up to 1024 bytes from the drone
-                if not chunk:
-                    # Connection closed by drone
-                    break
-                buffer += chunk  # Append received bytes to the buffer
-                # Process all complete messages delimited by newline character '\n'
-                while b"\n" in buffer:
-                    line, buffer = buffer.split(b"\n", 1)  # Extract one message
-                    data = json.loads(line.decode())  # Decode JSON message
-                    print(f"[CENTRAL] Received: {data}")
-            except Exception as e:
-                # Handle any errors during receiving or decoding
-                print(f"[CENTRAL] Connection error with {addr}: {e}")
-                break
-
-def central_server():
+        try:
+            # Batches are acknowledged by serve_uplink once handle_records returns
+            serve_uplink(conn, lambda records: handle_records(records, addr), sequences=sequences)
+        except Exception as e:
+            # Handle any errors during receiving or decoding
+            print(f"[CENTRAL] Connection error with {addr}: {e}")
+        finally:
+            stream.disconnect(addr)
+
+def handle_records(records, source=None):
+    """
+    Process one batch of records received from a drone.
+
+    Parameters:
+    records (list): Decoded Reading tuples, and Summary tuples when the drone
+        reduces data at the edge, in the order the drone sent them.
+    source: the drone connection's address, for the event-time stage.
+    """
+    metrics.observe_ages("age.central_received", records)
+    started = time.perf_counter()
+    queries.write(records)
+    metrics.observe("stage.store_write", (time.perf_counter() - started) * 1000000)
+    feed.publish(records)
+    stream.submit(records, source)
+    print_records(records)
+
+def print_records(records):
+    """
+    Print one batch of records. With worker processes this runs in the
+    worker that received the batch.
+
+    Parameters:
+    records (list): Reading and Summary tuples.
+    """
+    # One write per line, so lines printed by several worker processes never mix
+    for record in records:
+        if type(record) is Summary:
+            sys.stdout.write(f"[CENTRAL] Received summary: {record}\n")
+        else:
+            sys.stdout.write(f"[CENTRAL] Received: {record}\n")
+
+def on_worker_records(records, addr):
+    """
+    Called for every batch a worker process stored, after it has been
+    merged into the query engine.
+
+    Parameters:
+    records (list): Reading and Summary tuples.
+    addr (tuple): the address of the drone that sent them.
+    """
+    metrics.observe_ages("age.central_received", records)
+    feed.publish(records)
+    stream.submit(records, addr)
+
+def print_windows(size_us, slide_us, summaries):
+    """
+    Print the window aggregates the event-time stage closed.
+
+    Parameters:
+    size_us (int): window length in microseconds.
+    slide_us (int): distance between window starts (equal to size_us for tumbling windows).
+    summaries (list): one Summary per sensor and window.
+    """
+    def label(us):
+        return f"{us // 60000000}m" if us % 60000000 == 0 else f"{us / 1000000:g}s"
+    kind = label(size_us) + ("" if slide_us == size_us else f" every {label(slide_us)}")
+    for summary in summaries:
+        sys.stdout.write(f"[CENTRAL] Window {kind}: {summary}\n")
+
+def on_worker_connect(addr, worker):
+    print(f"[CENTRAL] Drone connected from {addr} (worker {worker})")
+
+def on_worker_disconnect(addr, worker, reason):
+    if reason:
+        print(f"[CENTRAL] Connection error with {addr}: {reason}")
+    stream.disconnect(addr)
+
+def central_server(workers=WORKERS):
     """
     Main server function that listens for incoming drone connections
     and spawns a new thread to handle each connection concurrently.
+
+    Parameters:
+    workers (int): number of processes serving the drone port.
     """
+    global store, queries, sequences, feed, stream
+    feed = LiveFeed()
+    stream = StreamProcessor([(parse_duration(size), slide and parse_duration(slide)) for size, slide in STREAM_WINDOWS],
+                             parse_duration(STREAM_DELAY), parse_duration(STREAM_LATENESS), on_windows=print_windows)
+    pool = None
+    if workers > 1:
+        pool = WorkerPool(CENTRAL_PORT, workers, WORKERS_DATA_DIR, on_records=on_worker_records,
+                          on_connect=on_worker_connect, on_disconnect=on_worker_disconnect,
+                          on_batch=print_records)
+        store, queries, sequences = pool.store, pool.queries, pool.sequences
+    else:
+        store = TimeSeriesStore(DATA_DIR)
+        queries = QueryEngine(store)
+        sequences = SequenceIndex(os.path.join(DATA_DIR, "sequence.json"))
+        persist_periodically(sequences, store)
+    QueryServer(queries, QUERY_PORT).start()
+    print(f"[CENTRAL] Query API on http://127.0.0.1:{QUERY_PORT}")
+    if FEED_PORT:
+        FeedServer(feed, FEED_PORT).start()
+        print(f"[CENTRAL] Live feed on http://127.0.0.1:{FEED_PORT}/feed")
+    if METRICS_PORT:
+        metrics.gauge("store", store.stats)
+        metrics.gauge("feed", feed.stats)
+        metrics.gauge("stream", stream.stats)
+        if sequences is not None:
+            metrics.gauge("sequences", sequences.stats)
+        if pool is not None:
+            metrics.gauge("workers", pool.stats)
+        MetricsServer(metrics, METRICS_PORT).start()
+        print(f"[CENTRAL] Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    else:
+        metrics.enabled = False
+    if pool is not None:
+        pool.start()
+        print(f"[CENTRAL] Listening on port {CENTRAL_PORT} with {workers} worker processes"
+              + (" (SO_REUSEPORT)" if pool.reuse_port else ""))
+        try:
+            pool.wait()
+        finally:
+            pool.stop()  # Workers flush their stores before exiting
+        return
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
         server_socket.bind(("", CENTRAL_PORT))  # Bind to all network interfaces on CENTRAL_PORT
         server_socket.listen()  # Start listening for incoming connections
@@ -47,5 +197,17 @@ def central_server():
             threading.Thread(target=handle_drone_connection, args=(conn, addr), daemon=True).start()
 
 if __name__ == "__main__":
-    central_server()  # Run the central server when the script is executed
+    parser = argparse.ArgumentParser(description="Central server")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processes serving the drone port")
+    args = parser.parse_args()
+    try:
+        central_server(args.workers)  # Run the central server when the script is executed
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if stream is not None:
+            stream.close()  # Emit the windows still open
+        if store is not None and args.workers <= 1:
+            store.close()  # Flush rows still buffered in memory
+            sequences.save()
 
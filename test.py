@@ -29,9 +29,10 @@ if __name__ == "__main__":
     sensor1_proc = start_process("Sensor 1", ["python", "sensor/sensor.py", "--sensor_id", "sensor1"])
     time.sleep(1)
 
-    # Start Sensor 2 (anomaly mode if implemented)
+    # Start Sensor 2 with anomalous readings
     print("Injecting anomaly...")
-    sensor2_proc = start_process("Sensor 2", ["python", "sensor/sensor.py", "--sensor_id", "sensor2"])
+    sensor2_proc = start_process("Sensor 2", ["python", "sensor/sensor.py", "--sensor_id", "sensor2",
+                                              "--profile", "anomaly"])
     time.sleep(1)
 
     # Wait for sensors to run
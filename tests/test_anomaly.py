@@ -0,0 +1,44 @@
+import math
+import random
+
+import pytest
+
+from common.anomaly import AnomalyEngine, MIN_ROUND, np
+from common.protocol import Reading
+
+
+def batches(sensors, size, count, seed=3):
+    rng = random.Random(seed)
+    ts = 1_700_000_000_000_000
+    out = []
+    for _ in range(count):
+        readings = []
+        for _ in range(size):
+            ts += rng.randint(0, 500000)
+            temp = 100.0 if rng.random() < 0.01 else 20 + rng.gauss(0, 1)
+            hum = math.nan if rng.random() < 0.05 else 50 + rng.gauss(0, 3)
+            readings.append(Reading(f"sensor{rng.randrange(sensors)}", temp, hum, ts))
+        out.append(readings)
+    return out
+
+
+@pytest.mark.skipif(np is None, reason="NumPy is not installed")
+@pytest.mark.parametrize("sensors", [1, 3, MIN_ROUND + 1, 2000])
+def test_numpy_flags_match_python(sensors):
+    vectorised = AnomalyEngine(use_numpy=True)
+    plain = AnomalyEngine(use_numpy=False)
+    for readings in batches(sensors, 3000, 4):
+        assert [r.flags for r in vectorised.score(readings)] == [r.flags for r in plain.score(readings)]
+    for field in ("temperature", "humidity"):
+        for got, want in zip(vectorised._state[field], plain._state[field]):
+            assert np.allclose(got[:len(want)], want)
+
+
+def test_static_and_rate_flags():
+    engine = AnomalyEngine(use_numpy=False)
+    flags = [r.flags for r in engine.score([
+        Reading("s", 20.0, 50.0, 0),
+        Reading("s", 70.0, 50.0, 60_000_000),
+        Reading("s", 40.0, 50.0, 61_000_000),
+    ])]
+    assert flags == [0, 0x01, 0x10]
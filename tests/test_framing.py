@@ -0,0 +1,84 @@
+import socket
+import struct
+
+import pytest
+
+from common.framing import Framer, FrameTooLarge, LINE, LENGTH
+
+
+def length_frame(payload):
+    return struct.pack("<I", len(payload)) + payload
+
+
+def test_line_frames_split_across_reads():
+    framer = Framer(LINE)
+    framer.feed(b'{"a": 1}\n{"b"')
+    assert framer.frames() == [b'{"a": 1}']
+    assert framer.pending == 4
+    framer.feed(b': 2}')
+    assert framer.frames() == []
+    framer.feed(b'\n\n')
+    assert framer.frames() == [b'{"b": 2}', b""]
+    assert framer.pending == 0
+
+
+def test_length_frames_byte_by_byte():
+    data = length_frame(b"hello") + length_frame(b"") + length_frame(b"x" * 300)
+    framer = Framer(LENGTH)
+    frames = []
+    for i in range(len(data)):
+        framer.feed(data[i:i + 1])
+        frames += framer.frames()
+    assert frames == [b"hello", b"", b"x" * 300]
+    assert framer.pending == 0
+
+
+def test_partial_frame_survives_buffer_compaction_and_growth():
+    # Small buffer, so the unread tail is moved to the front and the buffer grows
+    framer = Framer(LENGTH, recv_size=16)
+    big = b"y" * 10000
+    framer.feed(length_frame(b"first") + length_frame(big)[:7])
+    assert framer.frames() == [b"first"]
+    framer.feed(length_frame(big)[7:5000])
+    assert framer.frames() == []
+    framer.feed(length_frame(big)[5000:] + length_frame(b"last")[:2])
+    assert framer.frames() == [big]
+    framer.feed(length_frame(b"last")[2:])
+    assert framer.frames() == [b"last"]
+
+
+def test_recv_from_socket_in_pieces():
+    a, b = socket.socketpair()
+    with a, b:
+        framer = Framer(LINE, recv_size=4)
+        a.sendall(b"one\ntw")
+        frames = []
+        while len(frames) < 1:
+            framer.recv_from(b)
+            frames += framer.frames()
+        a.sendall(b"o\n")
+        while len(frames) < 2:
+            framer.recv_from(b)
+            frames += framer.frames()
+        assert frames == [b"one", b"two"]
+        a.close()
+        assert framer.recv_from(b) == 0
+
+
+def test_frames_too_large():
+    framer = Framer(LENGTH, max_frame=100)
+    framer.feed(struct.pack("<I", 101))
+    with pytest.raises(FrameTooLarge):
+        framer.frames()
+    framer = Framer(LINE, max_frame=100)
+    framer.feed(b"z" * 200)
+    with pytest.raises(FrameTooLarge):
+        framer.frames()
+
+
+def test_peek_and_consume_handshake():
+    framer = Framer(LINE)
+    framer.feed(b"HELLO 2\n{}\n")
+    assert framer.peek().startswith(b"HELLO")
+    framer.consume(len(b"HELLO 2\n"))
+    assert framer.frames() == [b"{}"]
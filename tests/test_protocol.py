@@ -0,0 +1,133 @@
+import socket
+import threading
+
+import pytest
+
+from common.protocol import (Reading, Summary, ProtocolError, BinaryEncoder, BinaryDecoder, LENGTH, HELLO, HELLO_SIZE,
+                             MAGIC, VERSION, FRAME_SENSOR, FRAME_READINGS, FRAME_BATCH, FRAME_SUMMARIES,
+                             FRAME_BATCH_SEQ, FRAME_SUMMARIES_SEQ, FRAME_ACK, FRAME_RESUME, FRAME_RESUME_STATE,
+                             accept_hello, hello_reply, negotiate, encode_ack, encode_resume, encode_resume_state,
+                             decode_resume_state)
+
+# Values a float32 holds exactly, so decoded records compare equal
+READINGS = [Reading("s1", 20.5, 50.25, 1_700_000_000_000_000, 0),
+            Reading("ünïcode", -3.75, 99.5, 1_700_000_000_000_001, 0x21),
+            Reading("s1", 21.0, 49.0, 1_700_000_000_500_000, 0)]
+SUMMARIES = [Summary("s1", 0, 10_000_000, 4, 1.0, 9.0, 5.0, 9.0, 40.0, 60.0, 50.0, 60.0, 9_000_000),
+             Summary("s2", 0, 10_000_000, 1, 2.5, 2.5, 2.5, 2.5, 30.0, 30.0, 30.0, 30.0, 1_000_000)]
+
+
+def payloads(data):
+    """Split length-prefixed frames, as the Framer does in LENGTH mode."""
+    out, pos = [], 0
+    while pos < len(data):
+        (size,) = LENGTH.unpack_from(data, pos)
+        out.append(data[pos + LENGTH.size:pos + LENGTH.size + size])
+        pos += LENGTH.size + size
+    return out
+
+
+def decode_all(decoder, data):
+    return [decoder.decode(payload) for payload in payloads(data)]
+
+
+def test_readings_define_each_sensor_once_per_connection():
+    encoder, decoder = BinaryEncoder(), BinaryDecoder()
+    frames = decode_all(decoder, encoder.encode(READINGS))
+    assert [kind for kind, _, _ in frames] == [FRAME_SENSOR, FRAME_SENSOR, FRAME_READINGS]
+    assert frames[-1] == (FRAME_READINGS, None, READINGS)
+    (frame,) = decode_all(decoder, encoder.encode(READINGS[:1]))
+    assert frame == (FRAME_READINGS, None, READINGS[:1])
+
+
+def test_batches_round_trip():
+    encoder, decoder = BinaryEncoder(), BinaryDecoder()
+    assert decode_all(decoder, encoder.encode_batch(7, READINGS))[-1] == (FRAME_BATCH, 7, READINGS)
+    assert decode_all(decoder, encoder.encode_batch(8, SUMMARIES))[-1] == (FRAME_SUMMARIES, 8, SUMMARIES)
+    assert decoder.sequence is None
+
+
+def test_sequence_numbered_batches_round_trip():
+    encoder, decoder = BinaryEncoder(), BinaryDecoder()
+    epoch = 1_700_000_000_123_456
+    frame = decode_all(decoder, encoder.encode_batch(9, READINGS, epoch, [1, 2, 4_000_000_000]))[-1]
+    assert frame == (FRAME_BATCH_SEQ, 9, READINGS)
+    assert decoder.sequence == (epoch, (1, 2, 4_000_000_000))
+    frame = decode_all(decoder, encoder.encode_batch(10, SUMMARIES, epoch, [5, 1]))[-1]
+    assert frame == (FRAME_SUMMARIES_SEQ, 10, SUMMARIES)
+    assert decoder.sequence == (epoch, (5, 1))
+
+
+def test_control_frames_round_trip():
+    decoder = BinaryDecoder()
+    assert decode_all(decoder, encode_ack(2 ** 64 - 1)) == [(FRAME_ACK, 2 ** 64 - 1, [])]
+    assert decode_all(decoder, encode_resume(123)) == [(FRAME_RESUME, 123, [])]
+    state = {"s1": (10, [(2, 3), (7, 7)]), "ünïcode": (4, []), "s3": (0, [])}
+    (payload,) = payloads(encode_resume_state(123, state))
+    assert payload[0] == FRAME_RESUME_STATE
+    assert decode_resume_state(payload) == (123, state)
+    assert decode_resume_state(payloads(encode_resume_state(5, {}))[0]) == (5, {})
+
+
+def test_truncated_and_unknown_frames_are_rejected():
+    encoder, decoder = BinaryEncoder(), BinaryDecoder()
+    *sensors, batch = payloads(encoder.encode_batch(1, READINGS, 42, [1, 2, 3]))
+    for payload in sensors:
+        decoder.decode(payload)
+    with pytest.raises(ProtocolError):
+        decoder.decode(batch[:-1])
+    (state,) = payloads(encode_resume_state(1, {"s1": (3, [(1, 2)])}))
+    with pytest.raises(ProtocolError):
+        decode_resume_state(state[:-2])
+    with pytest.raises(ProtocolError):
+        BinaryDecoder().decode(payloads(BinaryEncoder().encode(READINGS))[-1])  # sensors never defined
+    with pytest.raises(ProtocolError):
+        decoder.decode(b"\xff")
+    with pytest.raises(ProtocolError):
+        decoder.decode(b"")
+
+
+def test_receiver_tells_json_from_the_handshake():
+    assert accept_hello(b"") == (None, 0)
+    assert accept_hello(b'{"sensor_id": "s1"}') == (0, 0)
+    assert accept_hello(HELLO[:3]) == (None, 0)
+    assert accept_hello(HELLO + b"rest") == (VERSION, HELLO_SIZE)
+    # A newer client gets the newest version this side knows; a JSON-only receiver answers 0
+    assert accept_hello(MAGIC + bytes([VERSION + 5])) == (VERSION, HELLO_SIZE)
+    assert accept_hello(HELLO, binary=False) == (0, HELLO_SIZE)
+    with pytest.raises(ProtocolError):
+        accept_hello(b"\x00BAD!")
+
+
+def answer_hello(conn, binary):
+    with conn:
+        hello = conn.recv(HELLO_SIZE)
+        version, _ = accept_hello(hello, binary)
+        conn.sendall(hello_reply(version))
+
+
+@pytest.mark.parametrize("binary, version", [(True, VERSION), (False, 0)])
+def test_negotiate_agrees_on_a_version(binary, version):
+    client, conn = socket.socketpair()
+    thread = threading.Thread(target=answer_hello, args=(conn, binary))
+    thread.start()
+    with client:
+        assert negotiate(client) == version
+    thread.join(5)
+
+
+def test_negotiate_fails_when_the_peer_does_not_answer():
+    client, conn = socket.socketpair()
+    with client, conn:
+        with pytest.raises(ProtocolError):
+            negotiate(client, timeout=0.1)
+        # The handshake timeout does not stay on the socket
+        assert client.gettimeout() is None
+    # An older receiver that hangs up on the handshake
+    client, conn = socket.socketpair()
+    thread = threading.Thread(target=lambda: (conn.recv(HELLO_SIZE), conn.close()))
+    thread.start()
+    with client:
+        with pytest.raises(ProtocolError):
+            negotiate(client)
+    thread.join(5)
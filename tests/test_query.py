@@ -0,0 +1,49 @@
+from common.protocol import Reading
+from common.query import QueryEngine, PAGE_BYTES, MINUTE_US, ROLLUP_MEMORY
+from common.tsdb import TimeSeriesStore, FSYNC_NEVER
+
+HOUR_US = 60 * MINUTE_US
+START = 1_700_000_000 * 1000000 // HOUR_US * HOUR_US
+
+
+def engine(path, rollup_memory=ROLLUP_MEMORY):
+    store = TimeSeriesStore(str(path), fsync=FSYNC_NEVER, fsync_interval=3600)
+    return QueryEngine(store, rollup_memory=rollup_memory)
+
+
+def minutes(sensor, count, offset=0):
+    return [Reading(sensor, 20.0 + (i % 7), 50.0, START + (offset + i) * MINUTE_US + 5000000, i % 3 == 0)
+            for i in range(count)]
+
+
+def test_freed_rollups_are_served_from_the_store(tmp_path):
+    full = engine(tmp_path / "full")
+    small = engine(tmp_path / "small", rollup_memory=6 * PAGE_BYTES)
+    for sensor in ("a", "b", "c"):
+        readings = minutes(sensor, 6 * 60)
+        full.write(readings)
+        small.write(readings)
+    assert small.rollups.freed > 0
+    assert small.rollups.kept_from("a", MINUTE_US, START, START + 6 * HOUR_US) > START
+    assert len(small.rollups._pages) <= 6
+    for step in (MINUTE_US, 10 * MINUTE_US, HOUR_US):
+        for field in ("temperature", "humidity"):
+            expected = full.aggregate(None, field, step, START, START + 6 * HOUR_US)
+            assert small.aggregate(None, field, step, START, START + 6 * HOUR_US) == expected
+            assert small.aggregate(["b"], field, step, START + HOUR_US, START + 2 * HOUR_US) == \
+                full.aggregate(["b"], field, step, START + HOUR_US, START + 2 * HOUR_US)
+    assert small.stats()["rollups"]["bytes"] <= 6 * PAGE_BYTES
+
+
+def test_range_limit_and_open_ended_ranges(tmp_path):
+    queries = engine(tmp_path)
+    readings = minutes("a", 3 * 60)
+    queries.write(readings[::-1])
+    assert queries.range("a", START, START + 3 * HOUR_US, limit=10) == readings[:10]
+    assert queries.store.query("a", limit=70) == readings[:70]
+
+    entries = len(queries.cache._entries)
+    queries.range("a", START, START + HOUR_US, cache=False)
+    assert len(queries.cache._entries) == entries
+    queries.range("a", START, START + HOUR_US)
+    assert len(queries.cache._entries) == entries + 1
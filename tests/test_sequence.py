@@ -0,0 +1,125 @@
+import threading
+
+from common.protocol import Reading
+from common.sequence import SequenceRange, SequenceIndex, Sequencer, MAX_GAPS
+
+
+def received(r, upto):
+    return [seq for seq in range(1, upto + 1) if seq in r]
+
+
+def test_in_order_numbers_leave_no_gaps():
+    r = SequenceRange()
+    assert all(r.add(seq) for seq in range(1, 6))
+    assert (r.high, r.gaps) == (5, [])
+    assert 5 in r and 6 not in r and 0 in r
+    assert not r.add(3)
+
+
+def test_skipped_numbers_become_gaps_and_fill_in():
+    r = SequenceRange()
+    for seq in (1, 2, 6, 7, 12):
+        r.add(seq)
+    assert r.gaps == [[3, 5], [8, 11]]
+    assert received(r, 13) == [1, 2, 6, 7, 12]
+
+    assert r.add(3)          # start of a gap
+    assert r.add(11)         # end of a gap
+    assert r.add(9)          # middle: the gap splits
+    assert r.gaps == [[4, 5], [8, 8], [10, 10]]
+    assert r.add(8) and r.add(10)   # single-number gaps disappear
+    assert r.gaps == [[4, 5]]
+    assert not r.add(9)
+    assert r.add(4) and r.add(5)
+    assert r.gaps == [] and received(r, 13) == list(range(1, 13))
+
+
+def test_too_many_gaps_merge_the_oldest_two():
+    r = SequenceRange()
+    for k in range(MAX_GAPS + 2):
+        r.add(3 * k + 1)
+    assert len(r.gaps) == MAX_GAPS
+    # 4, between the first two gaps, counts as missing again: it may be
+    # accepted twice, but a missing number is never taken for received
+    assert r.gaps[0] == [2, 6]
+    assert 4 not in r
+    assert r.add(4)
+    assert all(3 * k + 1 in r for k in range(MAX_GAPS + 2))
+    assert not any(seq in r for start, end in r.gaps for seq in range(start, end + 1))
+
+
+def test_restored_range_matches_saved_one():
+    r = SequenceRange(10, [[2, 3], [7, 7]])
+    assert received(r, 11) == [1, 4, 5, 6, 8, 9, 10]
+
+
+def test_index_drops_duplicates_and_keeps_state(tmp_path):
+    path = str(tmp_path / "sequence.json")
+    index = SequenceIndex(path)
+    sequencer = Sequencer(epoch=42)
+    records = [Reading(f"s{i % 2}", 20.0, 50.0, i) for i in range(6)]
+    seqs = sequencer.number(records)
+    assert list(seqs) == [1, 1, 2, 2, 3, 3]
+
+    first, first_seqs = records[:2] + records[4:], seqs[:2] + seqs[4:]
+    index.add(42, *index.filter(42, first, first_seqs))
+    fresh, fresh_seqs = index.filter(42, records, seqs)
+    assert fresh == records[2:4] and list(fresh_seqs) == [2, 2]
+    assert index.state(42) == {"s0": (3, [(2, 2)]), "s1": (3, [(2, 2)])}
+    assert index.filter(7, records, seqs)[0] == records
+
+    index.save()
+    assert SequenceIndex(path).state(42) == index.state(42)
+
+
+def deliver_in_thread(index, epoch, records, seqs, out):
+    thread = threading.Thread(target=lambda: out.append(index.filter(epoch, records, seqs)))
+    thread.start()
+    return thread
+
+
+def test_second_delivery_waits_for_the_first_and_is_dropped(tmp_path):
+    index = SequenceIndex(str(tmp_path / "sequence.json"))
+    records = [Reading(f"s{i % 2}", 20.0, 50.0, i) for i in range(4)]
+    seqs = Sequencer(epoch=42).number(records)
+    # The first copy is being stored when the drone resends it on another connection
+    first, first_seqs = index.filter(42, records, seqs)
+    assert first == records
+    second = []
+    thread = deliver_in_thread(index, 42, records, seqs, second)
+    thread.join(0.2)
+    assert thread.is_alive() and second == []
+    # Numbers being stored are neither saved nor reported to a resuming drone
+    assert index.snapshot() == {"epochs": {}} and index.state(42) == {}
+    index.add(42, first, first_seqs)
+    thread.join(5)
+    assert second[0][0] == [] and index.duplicates == 4
+    assert index.reserved == {}
+
+
+def test_released_numbers_go_to_the_waiting_delivery():
+    index = SequenceIndex()
+    records = [Reading("s0", 20.0, 50.0, i) for i in range(3)]
+    seqs = Sequencer(epoch=7).number(records)
+    first, first_seqs = index.filter(7, records, seqs)
+    second = []
+    thread = deliver_in_thread(index, 7, records, seqs, second)
+    thread.join(0.2)
+    assert thread.is_alive()
+    # Storing the first copy failed
+    index.release(7, first, first_seqs)
+    thread.join(5)
+    assert second[0][0] == records
+    index.add(7, *second[0])
+    assert index.state(7) == {"s0": (3, [])} and index.reserved == {}
+
+
+def test_reservations_of_an_exited_owner_are_released():
+    index = SequenceIndex()
+    records = [Reading("s0", 20.0, 50.0, i) for i in range(3)]
+    seqs = Sequencer(epoch=7).number(records)
+    assert index.reserve(7, ["s0"] * 3, seqs, owner=1) is None
+    index.reserve(7, ["s1"], [1], owner=2)
+    index.release_owner(1)
+    assert list(index.reserved) == [(7, "s1", 1)]
+    assert index.filter(7, records, seqs)[0] == records
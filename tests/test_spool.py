@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from common.protocol import Reading, Summary, ProtocolError, encode_sensor_id, reading_from_dict
+from common.spool import Spool
+
+
+def readings(n, sensor="s1", start=0):
+    return [Reading(sensor, 20.0 + i, 50.0, start + i, i % 2) for i in range(n)]
+
+
+def replayed(spool, chunk_size=5000):
+    return [r for chunk in spool.replay(chunk_size) for r in chunk.readings]
+
+
+def test_replay_returns_appended_records_in_order(tmp_path):
+    spool = Spool(str(tmp_path))
+    summary = Summary("s2", 0, 10, 3, 1.0, 3.0, 2.0, 3.0, 40.0, 60.0, 50.0, 60.0, 9)
+    spool.append(readings(3))
+    spool.append([summary])
+    spool.append(readings(2, "ünïcode", start=100))
+    assert replayed(spool) == readings(3) + [summary] + readings(2, "ünïcode", start=100)
+
+
+def test_commit_all_deletes_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=100)
+    spool.append(readings(10))
+    spool.append(readings(10, start=10))
+    for chunk in spool.replay():
+        spool.commit(chunk, len(chunk.readings))
+    assert spool.pending_bytes() == 0
+    assert replayed(spool) == []
+    assert "000000000000.seg" not in os.listdir(tmp_path)
+
+
+def test_partial_commit_resumes_after_reopen(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(readings(10))
+    chunk = next(spool.replay(chunk_size=4))
+    spool.commit(chunk, 3)
+    assert replayed(Spool(str(tmp_path))) == readings(10)[3:]
+
+
+def test_torn_record_at_segment_end_is_skipped(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(readings(5))
+    replayed(spool)  # closes the segment
+    (segment,) = [name for name in os.listdir(tmp_path) if name.endswith(".seg")]
+    with open(os.path.join(tmp_path, segment), "ab") as f:
+        f.write(b"\x02\x00\x00")
+    assert replayed(Spool(str(tmp_path))) == readings(5)
+
+
+def test_sequenced_segments_keep_epoch_and_numbers(tmp_path):
+    spool = Spool(str(tmp_path), epoch=7)
+    spool.append(readings(3), [5, 6, 9])
+    with pytest.raises(ValueError):
+        spool.append(readings(1))
+    (chunk,) = spool.replay()
+    assert chunk.epoch == 7
+    assert list(chunk.seqs) == [5, 6, 9]
+    assert chunk.readings == readings(3)
+
+
+def test_sensor_id_longer_than_255_bytes_is_rejected_not_truncated(tmp_path):
+    spool = Spool(str(tmp_path))
+    # 128 two-byte characters: truncating to 255 bytes would split the last one
+    long_id = "é" * 128
+    with pytest.raises(ProtocolError):
+        spool.append(readings(1) + readings(1, long_id))
+    assert spool.pending_bytes() == 0
+    fits = "é" * 127 + "x"
+    assert len(encode_sensor_id(fits)) == 255
+    spool.append(readings(2, fits))
+    assert replayed(Spool(str(tmp_path))) == readings(2, fits)
+
+
+def test_ingest_rejects_long_and_empty_ids():
+    message = {"sensor_id": "é" * 128, "temperature": 20.0, "humidity": 50.0,
+               "timestamp": "2024-01-01T00:00:00Z"}
+    with pytest.raises(ProtocolError):
+        reading_from_dict(message)
+    with pytest.raises(ProtocolError):
+        reading_from_dict(dict(message, sensor_id=""))
+    assert reading_from_dict(dict(message, sensor_id="é" * 127)).sensor_id == "é" * 127
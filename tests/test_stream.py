@@ -0,0 +1,81 @@
+import math
+
+from common.protocol import Reading, Summary
+from common.stream import Reorderer, WindowAggregator, StreamProcessor
+
+S = 1000000
+
+
+def reading(sensor, second, temperature=20.0):
+    return Reading(sensor, temperature, 50.0, second * S, 0)
+
+
+def test_reorderer_releases_in_event_time_order_behind_the_slowest_source():
+    reorderer = Reorderer(2 * S, idle_timeout=30)
+    out, late = reorderer.push([reading("a", 10), reading("a", 5)], "d1", now=0)
+    assert out == [reading("a", 5)] and late == []
+    assert reorderer.watermark == 8 * S
+    # d2 is behind d1 and holds the watermark back
+    assert reorderer.push([reading("b", 9)], "d2", now=1) == ([], [])
+    assert reorderer.push([reading("a", 20)], "d1", now=2) == ([], [])
+    out, _ = reorderer.push([reading("b", 15)], "d2", now=3)
+    assert out == [reading("b", 9), reading("a", 10)]
+    out, late = reorderer.push([reading("b", 3)], "d2", now=4)
+    assert out == [] and late == [reading("b", 3)]
+    # Without d1 and with d2 idle, everything waiting goes
+    reorderer.remove("d1")
+    assert reorderer.advance(now=40) == [reading("b", 15), reading("a", 20)]
+    assert reorderer.heap == []
+
+
+def test_tumbling_windows_close_after_lateness_and_free_their_panes():
+    windows = WindowAggregator(60 * S, lateness_us=10 * S)
+    windows.add([reading("a", 1, 10.0), reading("a", 59, 30.0), reading("a", 61, 40.0), reading("b", 5)])
+    assert windows.open_panes() == 3
+    # The first window ends at 60 s and stays open until the watermark reaches 70 s
+    assert windows.advance(69 * S) == []
+    closed = windows.advance(70 * S)
+    assert [(s.sensor_id, s.start_us, s.end_us, s.count) for s in closed] == [("a", 0, 60 * S, 2), ("b", 0, 60 * S, 1)]
+    a = closed[0]
+    assert (a.temperature_min, a.temperature_max, a.temperature_mean, a.temperature_last) == (10.0, 30.0, 20.0, 30.0)
+    # Only the pane of the open window is kept; b has no panes left at all
+    assert windows.panes == {"a": {1: windows.panes["a"][1]}}
+    assert windows.add([reading("a", 30)]) == 1
+    assert windows.dropped == 1
+    assert [s.start_us for s in windows.advance(math.inf)] == [60 * S]
+    assert windows.panes == {}
+
+
+def test_sliding_windows_share_panes_and_drop_them_once_no_window_needs_them():
+    windows = WindowAggregator(3 * 60 * S, 60 * S)
+    windows.add([reading("a", 30), reading("a", 90), reading("a", 150)])
+    closed = windows.advance(180 * S)
+    # The window [0, 180 s) holds all three; the earlier ones reach back before 0
+    assert [(s.start_us // S, s.count) for s in closed] == [(-120, 1), (-60, 2), (0, 3)]
+    # Pane 0 is no longer part of any open window, panes 1 and 2 still are
+    assert sorted(windows.panes["a"]) == [1, 2]
+    closed = windows.advance(240 * S)
+    assert [(s.start_us // S, s.count) for s in closed] == [(60, 2)]
+    assert sorted(windows.panes["a"]) == [2]
+    assert windows.open_panes() == 1
+
+
+def test_summaries_count_with_their_statistics():
+    windows = WindowAggregator(60 * S)
+    summary = Summary("a", 0, 10 * S, 4, 1.0, 9.0, 5.0, 9.0, 40.0, 60.0, 50.0, 60.0, 9 * S)
+    windows.add([summary, reading("a", 20, 10.0)])
+    (s,) = windows.advance(math.inf)
+    assert s.count == 5
+    assert (s.temperature_min, s.temperature_max, s.temperature_mean, s.temperature_last) == (1.0, 10.0, 6.0, 10.0)
+
+
+def test_processor_passes_late_records_on():
+    seen = []
+    processor = StreamProcessor([(60 * S, None)], 2 * S, on_records=seen.append)
+    processor.submit([reading("a", 100), reading("a", 95)], "d1")
+    # A spool replay from before the watermark
+    processor.submit([reading("a", 10), reading("a", 20)], "d2")
+    processor.close()
+    assert [reading("a", 95)] in seen
+    assert [reading("a", 10), reading("a", 20)] in seen
+    assert sorted(r.ts_us for batch in seen for r in batch) == [10 * S, 20 * S, 95 * S, 100 * S]
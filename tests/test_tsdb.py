@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from common.protocol import Reading
+from common.tsdb import TimeSeriesStore, FSYNC_NEVER
+
+
+def open_store(path, **kwargs):
+    # Flushed by the tests only
+    return TimeSeriesStore(str(path), block_rows=4, fsync=FSYNC_NEVER, fsync_interval=3600, **kwargs)
+
+
+def readings(n, start=0, sensor="s1"):
+    return [Reading(sensor, 20.0 + i, 50.0 + i, 1_000_000 * i, i % 4) for i in range(start, start + n)]
+
+
+def partition_dir(path, sensor="s1"):
+    (partition,) = os.listdir(os.path.join(path, sensor))
+    return os.path.join(path, sensor, partition)
+
+
+def test_rows_survive_reopen(tmp_path):
+    store = open_store(tmp_path)
+    store.write(readings(10))
+    store.close()
+    store = open_store(tmp_path)
+    assert store.query("s1") == readings(10)
+    assert store.query("s1", 3_000_000, 6_000_000) == readings(10)[3:6]
+
+
+def test_recover_cuts_torn_rows_and_rebuilds_index(tmp_path):
+    store = open_store(tmp_path)
+    store.write(readings(10))
+    store.close()
+    path = partition_dir(tmp_path)
+    # A crash mid-flush: half a timestamp and one temperature more, the index lost
+    with open(os.path.join(path, "ts.i64"), "ab") as f:
+        f.write(b"\x01\x02\x03\x04")
+    with open(os.path.join(path, "temperature.f32"), "ab") as f:
+        f.write(b"\x00\x00\xa0\x41")
+    os.remove(os.path.join(path, "index.i64"))
+
+    store = open_store(tmp_path)
+    assert store.query("s1") == readings(10)
+    assert os.path.getsize(os.path.join(path, "ts.i64")) == 10 * 8
+    assert os.path.getsize(os.path.join(path, "temperature.f32")) == 10 * 4
+    assert os.path.getsize(os.path.join(path, "index.i64")) == 2 * 2 * 8
+    store.write(readings(5, start=10))
+    store.close()
+    assert open_store(tmp_path).query("s1") == readings(15)
+
+
+def test_failed_flush_keeps_rows_and_files_aligned(tmp_path):
+    store = open_store(tmp_path)
+    store.write(readings(3))
+    store.flush()
+    append_file = store._append_file
+    calls = []
+
+    def failing(path, column, fsync):
+        calls.append(path)
+        if len(calls) == 2:
+            # The timestamps are written, the temperatures are not
+            raise OSError("disk full")
+        append_file(path, column, fsync)
+
+    store._append_file = failing
+    store.write(readings(6, start=3))
+    with pytest.raises(OSError):
+        store.flush()
+    path = partition_dir(tmp_path)
+    assert os.path.getsize(os.path.join(path, "ts.i64")) == 3 * 8
+    # Nothing is lost while the rows wait for the next flush
+    assert store.query("s1") == readings(9)
+
+    store.write(readings(5, start=9))
+    store.flush()
+    assert store.query("s1") == readings(14)
+    store.close()
+    reopened = open_store(tmp_path)
+    assert reopened.query("s1") == readings(14)
+    assert reopened.query("s1", 8_000_000, 12_000_000) == readings(14)[8:12]
+
+
+def test_failed_flush_puts_every_unwritten_partition_back(tmp_path):
+    store = open_store(tmp_path)
+    append_file = store._append_file
+    failed = []
+
+    def failing(path, column, fsync):
+        if not failed:
+            failed.append(path)
+            raise OSError("disk full")
+        append_file(path, column, fsync)
+
+    store._append_file = failing
+    store.write(readings(3, sensor="a") + readings(3, sensor="b") + readings(3, sensor="c"))
+    with pytest.raises(OSError):
+        store.flush()
+    assert store.stats()["rows_buffered"] == 9
+    store.close()
+    reopened = open_store(tmp_path)
+    for sensor in "abc":
+        assert reopened.query(sensor) == readings(3, sensor=sensor)
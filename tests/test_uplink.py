@@ -0,0 +1,126 @@
+import socket
+import threading
+
+import pytest
+
+from common import uplink
+from common.protocol import Reading, Summary, HELLO_SIZE
+from common.sequence import SequenceIndex, Sequencer
+from common.uplink import Uplink, serve_uplink
+
+
+class Server:
+    """Serves every connection the uplink opens over a socketpair, as the central server would."""
+
+    def __init__(self, binary=True, sequences=None):
+        self.binary = binary
+        self.sequences = sequences
+        self.stored = []
+        self.connections = 0
+        self.threads = []
+        # Called with the server end before records are stored; may drop the connection
+        self.before_store = None
+
+    def connect(self, address, timeout=None):
+        client, conn = socket.socketpair()
+        client.settimeout(timeout)
+        self.connections += 1
+        thread = threading.Thread(target=self.serve, args=(conn,), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return client
+
+    def serve(self, conn):
+        def handle(records):
+            if self.before_store is not None:
+                self.before_store(conn)
+            self.stored.extend(records)
+        with conn:
+            try:
+                serve_uplink(conn, handle, self.binary, sequences=self.sequences)
+            except OSError:
+                pass
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(5)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = Server(sequences=SequenceIndex())
+    monkeypatch.setattr(uplink.socket, "create_connection", server.connect)
+    return server
+
+
+def open_uplink(**kwargs):
+    return Uplink("127.0.0.1", 0, ack_timeout=5.0, min_backoff=0.0, **kwargs)
+
+
+def readings(n, sensors=3):
+    return [Reading(f"s{i % sensors}", 20.5, 50.25, 1_000_000 * i, i % 2) for i in range(n)]
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_batches_are_acknowledged_on_one_connection(server, binary):
+    server.binary = binary
+    link = open_uplink(binary=binary)
+    summary = Summary("s1", 0, 10, 2, 1.0, 2.0, 1.5, 2.0, 40.0, 50.0, 45.0, 50.0, 9)
+    records = readings(5) + [summary] + readings(3)
+    # Readings and summaries go in separate batches
+    assert link.send(records, batch_size=4) == len(records)
+    assert link.send(readings(2)) == 2
+    link.close()
+    server.join()
+    assert server.stored == records + readings(2)
+    assert server.connections == 1 and link.version == (2 if binary else 0)
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_unacknowledged_batch_is_resent_and_stored_once(server, binary):
+    server.binary = binary
+    link = open_uplink(binary=binary)
+    sequencer = Sequencer()
+    records = readings(10)
+    seqs = sequencer.number(records)
+
+    def lose_ack(conn):
+        # The batch gets stored but the connection drops before its ack goes out
+        server.before_store = None
+        conn.shutdown(socket.SHUT_RDWR)
+
+    server.before_store = lose_ack
+    assert link.send(records, epoch=sequencer.epoch, seqs=seqs) == 0
+    assert not link.connected
+    assert link.send(records, epoch=sequencer.epoch, seqs=seqs) == len(records)
+    link.close()
+    server.join()
+    assert server.connections == 2
+    assert server.stored == records
+    assert server.sequences.state(sequencer.epoch) == {f"s{i}": (4 if i == 0 else 3, []) for i in range(3)}
+
+
+def test_server_that_does_not_answer_the_handshake_gets_json_lines(monkeypatch):
+    server = Server()
+    connect = server.connect
+
+    def old_server(address, timeout=None):
+        if server.connections:
+            return connect(address, timeout)
+        # The first connection closes on the binary handshake
+        client, conn = socket.socketpair()
+        server.connections += 1
+
+        def close_on_hello():
+            with conn:
+                conn.recv(HELLO_SIZE)
+        threading.Thread(target=close_on_hello, daemon=True).start()
+        return client
+
+    monkeypatch.setattr(uplink.socket, "create_connection", old_server)
+    link = open_uplink()
+    assert link.send(readings(4)) == 4
+    assert (link.binary, link.version, server.connections) == (False, 0, 2)
+    link.close()
+    server.join()
+    assert server.stored == readings(4)